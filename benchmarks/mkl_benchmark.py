@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import torch
+from torch.autograd import Variable
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'kernet'))
+import backend as K
+from datasets import list_mkl, load_mkl, random_index
+from models.mlkn import MLKN, MLKNClassifier
+from layers.kerlinear import kerLinear
+from utils import aggregate, make_tasks, peak_rss, run_parallel
+
+def get_split(name, subset_size, dtype):
+    """
+    A random subset of the dataset, standardized with the statistics of its
+    training half and split evenly into training and test sets.
+    """
+    x, y = load_mkl(name)
+    index = random_index(x.shape[0], min(subset_size or x.shape[0], x.shape[0]))
+    x, y = x[index].type(dtype), y[index].type(dtype)
+    n_train = x.shape[0] // 2
+    mean, std = x[:n_train].mean(0), x[:n_train].std(0)
+    std[std==0] = 1
+    x = (x - mean.view(1, -1)) / std.view(1, -1)
+    X = Variable(x, requires_grad=False)
+    Y = Variable(y, requires_grad=False)
+    return X[:n_train], Y[:n_train], X[n_train:], Y[n_train:]
+
+def parse_precision(precision):
+    """
+    (compute, storage) of a precision mode 'compute[/storage]', e.g.,
+    'float/half', see baseMLKN.set_precision.
+    """
+    compute, _, storage = precision.partition('/')
+    return compute, storage or None
+
+def build(model, n_train, n_class, args, precision='float'):
+    """
+    Two-layer MLKN as in examples/mlkn_classification.py.
+    """
+    mlkn = MLKNClassifier() if model=='MLKNClassifier' else MLKN()
+    mlkn.add_layer(kerLinear(ker_dim=n_train, out_dim=args.hidden,
+        sigma=args.sigma[0], bias=True))
+    mlkn.add_layer(kerLinear(ker_dim=n_train, out_dim=n_class,
+        sigma=args.sigma[1], bias=True))
+    mlkn.set_precision(*parse_precision(precision))
+    if model=='MLKNClassifier':
+        for _ in range(2):
+            mlkn.add_optimizer(torch.optim.Adam(params=mlkn.parameters(),
+                lr=args.lr, weight_decay=args.weight_decay))
+    else:
+        mlkn.add_optimizer(torch.optim.Adam(params=mlkn.parameters(),
+            lr=args.lr, weight_decay=args.weight_decay))
+    mlkn.add_loss(torch.nn.CrossEntropyLoss())
+    mlkn.callbacks = [] # NOTE: no loss line per batch in the timings
+    return mlkn
+
+def gram_throughput(X, sigma, n_repeat=3):
+    """
+    Entries of the Gram matrix of X computed per second (best of n_repeat).
+    """
+    best = float('inf')
+    for _ in range(n_repeat):
+        start = time.time()
+        K.kerMap(X, X, sigma)
+        best = min(best, time.time() - start)
+    return X.shape[0]**2 / max(best, 1e-9)
+
+def run(name, model, args, precision='float'):
+    """
+    One run of a model on a random split of a dataset.
+    """
+    x_train, y_train, x_test, y_test = get_split(
+        name, args.subset_size, torch.FloatTensor)
+    n_class = int(torch.max(y_train.data)) + 1
+    n_class = max(n_class, int(torch.max(y_test.data)) + 1)
+    mlkn = build(model, x_train.shape[0], n_class, args, precision)
+    compute, storage = parse_precision(precision)
+    itemsize = {'half': 2, 'bfloat16': 2, 'float': 4, 'double': 8}
+
+    start = time.time()
+    if model=='MLKNClassifier':
+        mlkn.fit(n_epoch=(args.n_epoch, args.n_epoch),
+            X=x_train, Y=y_train, n_class=n_class,
+            batch_size=args.batch_size, shuffle=True, accumulate_grad=False)
+        n_epoch = 2 * args.n_epoch
+    else:
+        mlkn.fit(n_epoch=args.n_epoch, X=x_train, Y=y_train,
+            batch_size=args.batch_size, shuffle=True, accumulate_grad=False)
+        n_epoch = args.n_epoch
+    fit_time = time.time() - start
+
+    start = time.time()
+    y_raw = mlkn.evaluate(x_test, x_train, batch_size=args.batch_size)
+    inference_time = time.time() - start
+    _, y_pred = torch.max(y_raw, dim=1)
+    err = (y_pred.data.type_as(y_test.data)!=y_test.data).sum() / \
+    y_test.shape[0]
+
+    return {
+        'dataset': name,
+        'model': model,
+        'precision': precision,
+        'n_train': x_train.shape[0],
+        'n_test': x_test.shape[0],
+        'error_rate': float(err),
+        'fit_time': fit_time,
+        'epoch_time': fit_time / n_epoch,
+        'gram_entries_per_sec': gram_throughput(
+            x_train.type(K.tensor_type(compute)), args.sigma[0]
+            ),
+        'kernel_map_mb': min(args.batch_size or x_train.shape[0],
+            x_train.shape[0]) * x_train.shape[0] * \
+        itemsize[storage or compute] / 2**20,
+        # NOTE: held for backward per layer and batch, peak_rss_mb is a
+        # maximum over the whole process
+        'inference_latency_per_example': inference_time / x_test.shape[0],
+        'peak_rss_mb': peak_rss()
+        }
+
+def run_task(name, model, args, precision='float', **task):
+    """
+    One run in a worker process, see utils.run_parallel.
+    """
+    r = run(name, model, args, precision)
+    r['run'] = task['run']
+    return r
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MLKN and '
+        'MLKNClassifier on the bundled MKL datasets: error rates, time per '
+        'epoch, Gram throughput, peak RSS and inference latency.')
+    parser.add_argument('--datasets', nargs='+', default=list_mkl())
+    parser.add_argument('--models', nargs='+',
+        default=['MLKN', 'MLKNClassifier'],
+        choices=['MLKN', 'MLKNClassifier'])
+    parser.add_argument('--n-run', type=int, default=20)
+    parser.add_argument('--subset-size', type=int, default=None,
+        help='size of the random subset used at each run (default: all)')
+    parser.add_argument('--n-epoch', type=int, default=30,
+        help='epochs per layer')
+    parser.add_argument('--batch-size', type=int, default=30)
+    parser.add_argument('--hidden', type=int, default=15)
+    parser.add_argument('--sigma', type=float, nargs=2, default=[5., .1])
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--weight-decay', type=float, default=.1)
+    parser.add_argument('--precision', nargs='+', default=['float'],
+        help='precision modes compute[/storage] to compare, e.g., float '
+        'double float/half float/bfloat16 (see baseMLKN.set_precision); '
+        'peak RSS is only comparable across modes run in separate processes')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--n-worker', type=int, default=1,
+        help='number of runs fitted in parallel, each in its own process '
+        '(timings are then measured under contention)')
+    parser.add_argument('--output', default='mkl_benchmark.json')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.n_worker > 1:
+        tasks = make_tasks(
+            {
+                'name': args.datasets,
+                'model': args.models,
+                'precision': args.precision
+                },
+            n_run=args.n_run,
+            seed=args.seed
+            )
+        for task in tasks: task['args'] = args
+        results = run_parallel(run_task, tasks, n_worker=args.n_worker)
+        for r in results:
+            print('{} {} {} run {}/{}: error {:.2f}%, {:.3f}s/epoch'.format(
+                r['dataset'], r['model'], r['precision'], r['run']+1,
+                args.n_run, r['error_rate'] * 100, r['epoch_time']))
+    else:
+        results = []
+        for name in args.datasets:
+            for model in args.models:
+                for precision in args.precision:
+                    for i in range(args.n_run):
+                        r = run(name, model, args, precision)
+                        r['run'] = i
+                        results.append(r)
+                        print('{} {} {} run {}/{}: error {:.2f}%, '
+                            '{:.3f}s/epoch'.format(name, model, precision,
+                            i+1, args.n_run, r['error_rate'] * 100,
+                            r['epoch_time']))
+
+    report = {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'args': vars(args)
+            },
+        'summary': aggregate(results, by=['dataset', 'model', 'precision']),
+        'results': results
+        }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(args.output))
+
+if __name__=='__main__':
+    main()
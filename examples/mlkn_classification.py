@@ -29,8 +29,12 @@ if __name__=='__main__':
 
     # for other Multiple Kernel Learning benchmarks used in the paper, you could
     # do:
-    # x = np.load('../kernet/datasets/mkl/name_of_dataset.npy')
-    # y = np.load('../kernet/datasets/mkl/name_of_dataset_labels.npy')
+    # from datasets import load_mkl
+    # x, y = load_mkl('name_of_dataset', mmap=False)
+    # x, y = x.numpy(), y.numpy()
+    # (see datasets.list_mkl() for the names available and
+    # datasets.MKLDataset for a memory-mapped torch Dataset with cheap random
+    # subsets)
     # note that for some of the datasets, the results reported are only on a
     # subset of the data with size given in Table 1. This is to keep consistency
     # with the original paper that reported most of the results.
@@ -1 +1,3 @@
 from .torch_backend import *
+from .solvers import *
+from .kernels import *
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import math as m
+import torch
+from torch.autograd import Variable
+
+from .torch_backend import gaussianKer, kernel_radius, sq_dist, _itemsize, \
+    _tile_size
+
+_KERNELS = {}
+
+def register_kernel(cls):
+    """
+    Add the Kernel subclass cls to the registry under cls.name, so that
+    get_kernel (and thus the kernel argument of kerLinear) accepts that name.
+    Can be used as a class decorator.
+    """
+    assert cls.name is not None, 'a registered kernel needs a name'
+    _KERNELS[cls.name] = cls
+    return cls
+
+def get_kernel(kernel='gaussian', sigma=None, **params):
+    """
+    Parameters
+    ----------
+    kernel (optional) : str or Kernel
+        Name of a registered kernel (see list_kernels) or a Kernel, which is
+        returned as is.
+
+    sigma (optional) : scalar
+        Width of the kernel, for the kernels that have one.
+
+    **params
+        Further arguments of the kernel, e.g., nu for 'matern' or degree for
+        'polynomial'.
+
+    Returns
+    -------
+    kernel : Kernel
+    """
+    if isinstance(kernel, Kernel):
+        assert sigma is None and not params, \
+        'pass the parameters of a Kernel to its constructor'
+        return kernel
+    if kernel not in _KERNELS:
+        raise ValueError('unknown kernel: {}, choose from {}'.format(
+            kernel, list_kernels()
+            ))
+    cls = _KERNELS[kernel]
+    if sigma is not None:
+        if not cls.has_sigma:
+            raise ValueError('kernel {} has no sigma'.format(kernel))
+        params['sigma'] = sigma
+    return cls(**params)
+
+def list_kernels():
+    """
+    Names of the registered kernels.
+    """
+    return sorted(_KERNELS)
+
+class Kernel(object):
+    """
+    Base class of the kernels of the registry. A kernel is called on two sets
+    of examples and returns their Gram matrix:
+        kernel(x, y, mem_budget=None, recompute=False, symmetric=None)
+    with x of shape (n1_example, dim) and y of shape (n2_example, dim), see
+    gaussianKer for the keyword arguments, which a kernel may ignore. It is
+    differentiable w.r.t. x and y.
+    """
+    name = None
+    has_sigma = False
+
+    def __call__(self, x, y, mem_budget=None, recompute=False,
+        symmetric=None):
+        raise NotImplementedError
+
+    def radius(self, tol):
+        """
+        Distance beyond which the kernel is below tol, None if the kernel is
+        not a decreasing function of the distance (see
+        kerLinear.sparse_forward).
+        """
+        return None
+
+    def params(self):
+        """
+        Parameters of the kernel as a dict of scalars, e.g., to tell whether
+        a cached Gram matrix is still valid.
+        """
+        return dict(self.__dict__)
+
+    def key(self):
+        return (self.name,) + tuple(sorted(self.params().items()))
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={}'.format(k, v) for k, v in sorted(self.params().items())
+            ))
+
+class RadialKernel(Kernel):
+    """
+    Kernel of the form k(x, y) = phi(||x-y||_2^2). Subclasses define phi and
+    its derivative dphi on Tensors of squared distances D and value, phi as a
+    function of the distance on floats. The Gram matrix is computed tile by
+    tile with the analytic gradient of _RadialKernel.
+    """
+    has_sigma = True
+
+    def __init__(self, sigma=1.):
+        self.sigma = sigma
+
+    def phi(self, D):
+        raise NotImplementedError
+
+    def dphi(self, D):
+        raise NotImplementedError
+
+    def value(self, r):
+        raise NotImplementedError
+
+    def __call__(self, x, y, mem_budget=None, recompute=False,
+        symmetric=None):
+        if len(x.shape)==1: x = x.unsqueeze(0)
+        if len(y.shape)==1: y = y.unsqueeze(0)
+        assert len(x.shape)==2 and len(y.shape)==2 and x.shape[1]==y.shape[1]
+        return _RadialKernel.apply(x, y, self, mem_budget)
+
+    def radius(self, tol):
+        """
+        Found by bisection on value, which must be decreasing.
+        """
+        assert 0 < tol < 1
+        lo, hi = 0., float(self.sigma)
+        if self.value(lo) <= tol: return 0.
+        while self.value(hi) > tol: lo, hi = hi, 2 * hi
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            if self.value(mid) > tol: lo = mid
+            else: hi = mid
+        return hi
+
+class _RadialKernel(torch.autograd.Function):
+    """
+    Gram matrix of a RadialKernel with analytic gradients. With
+    A = grad_gram * dphi(D), where D holds the squared distances,
+        grad_x = 2 (diag(A 1) x - A y),
+        grad_y = 2 (diag(A^T 1) y - A^T x).
+    Only x and y are saved for backward, D is recomputed tile by tile.
+    """
+    @staticmethod
+    def forward(ctx, x, y, kernel, mem_budget):
+        rows = _tile_size(x.shape[0], y.shape[0], _itemsize(x), mem_budget,
+            name=kernel.name)
+        gram = x.new(x.shape[0], y.shape[0])
+        for i in range(0, x.shape[0], rows):
+            gram[i: i+rows] = kernel.phi(sq_dist(x[i: i+rows], y))
+
+        ctx.kernel, ctx.rows = kernel, rows
+        ctx.save_for_backward(x, y)
+        return gram
+
+    @staticmethod
+    def backward(ctx, grad_gram):
+        x, y = ctx.saved_tensors if hasattr(ctx, 'saved_tensors') \
+        else ctx.saved_variables
+        rows = ctx.rows
+
+        grad_x, grad_y = [], 0
+        for i in range(0, x.shape[0], rows):
+            x_ = x[i: i+rows]
+            A = ctx.kernel.dphi(sq_dist(x_, y)).mul_(grad_gram[i: i+rows])
+            if ctx.needs_input_grad[0]:
+                grad_x.append(
+                    (A.sum(dim=1).view(-1, 1).mul(x_) - A.mm(y)).mul(2)
+                    )
+            if ctx.needs_input_grad[1]:
+                grad_y = grad_y + \
+                (A.sum(dim=0).view(-1, 1).mul(y) - A.t().mm(x_)).mul(2)
+
+        grad_x = torch.cat(grad_x, dim=0) if grad_x else None
+        if not ctx.needs_input_grad[1]: grad_y = None
+        return grad_x, grad_y, None, None
+
+@register_kernel
+class GaussianKernel(RadialKernel):
+    """
+    k(x, y) = exp(-||x-y||_2^2 / (2 * sigma^2)), computed by gaussianKer,
+    which also supports recompute and symmetric.
+    """
+    name = 'gaussian'
+
+    def __call__(self, x, y, mem_budget=None, recompute=False,
+        symmetric=None):
+        return gaussianKer(
+            x, y, self.sigma,
+            mem_budget=mem_budget,
+            recompute=recompute,
+            symmetric=symmetric
+            )
+
+    def phi(self, D):
+        return D.mul(-1./(2*self.sigma**2)).exp()
+
+    def dphi(self, D):
+        return self.phi(D).mul_(-1./(2*self.sigma**2))
+
+    def value(self, r):
+        return m.exp(-r**2 / (2*self.sigma**2))
+
+    def radius(self, tol):
+        return kernel_radius(self.sigma, tol)
+
+@register_kernel
+class LaplacianKernel(RadialKernel):
+    """
+    k(x, y) = exp(-||x-y||_2 / sigma). Its gradient w.r.t. x at x=y is taken
+    to be 0.
+    """
+    name = 'laplacian'
+
+    def phi(self, D):
+        return D.sqrt().mul_(-1./self.sigma).exp_()
+
+    def dphi(self, D):
+        r = D.sqrt()
+        dphi = r.mul(-1./self.sigma).exp_()\
+        .div_(r.clamp(min=1e-12)).mul_(-1./(2*self.sigma))
+        return dphi.mul_((r > 0).type_as(r))
+        # NOTE: the terms of coincident points would otherwise not cancel out
+
+    def value(self, r):
+        return m.exp(-r / self.sigma)
+
+@register_kernel
+class MaternKernel(RadialKernel):
+    """
+    Matérn kernel of smoothness nu in {0.5, 1.5, 2.5}, with a = sqrt(2 nu) /
+    sigma and r = ||x-y||_2:
+        nu=0.5: k(x, y) = exp(-a r) (Laplacian),
+        nu=1.5: k(x, y) = (1 + a r) exp(-a r),
+        nu=2.5: k(x, y) = (1 + a r + a^2 r^2 / 3) exp(-a r).
+    """
+    name = 'matern'
+
+    def __init__(self, sigma=1., nu=1.5):
+        if nu not in (.5, 1.5, 2.5):
+            raise ValueError('nu must be 0.5, 1.5 or 2.5, got {}'.format(nu))
+        self.sigma = sigma
+        self.nu = nu
+
+    def phi(self, D):
+        a = m.sqrt(2 * self.nu) / self.sigma
+        r = D.sqrt()
+        e = r.mul(-a).exp()
+        if self.nu==.5: return e
+        if self.nu==1.5: return r.mul_(a).add_(1).mul_(e)
+        return r.mul_(a).add_(D.mul(a**2 / 3)).add_(1).mul_(e)
+
+    def dphi(self, D):
+        a = m.sqrt(2 * self.nu) / self.sigma
+        r = D.sqrt()
+        e = r.mul(-a).exp()
+        if self.nu==.5:
+            dphi = e.div_(r.clamp(min=1e-12)).mul_(-a/2)
+            return dphi.mul_((r > 0).type_as(r))
+            # NOTE: see LaplacianKernel.dphi
+        if self.nu==1.5: return e.mul_(-a**2 / 2)
+        return r.mul_(a).add_(1).mul_(e).mul_(-a**2 / 6)
+
+    def value(self, r):
+        a = m.sqrt(2 * self.nu) / self.sigma
+        if self.nu==.5: return m.exp(-a * r)
+        if self.nu==1.5: return (1 + a * r) * m.exp(-a * r)
+        return (1 + a * r + (a * r)**2 / 3) * m.exp(-a * r)
+
+@register_kernel
+class ARDGaussianKernel(Kernel):
+    """
+    Gaussian kernel with a lengthscale per dimension (automatic relevance
+    determination):
+        k(x, y) = exp(-sum_d (x_d - y_d)^2 / (2 * lengthscales_d^2)),
+    i.e., the Gaussian kernel of width 1 between x / lengthscales and
+    y / lengthscales, computed by gaussianKer.
+    """
+    name = 'ard'
+    has_sigma = True
+
+    def __init__(self, lengthscales=None, sigma=1.):
+        """
+        Parameters
+        ----------
+        lengthscales (optional) : sequence of scalars, Tensor or Variable
+            Of length dim. If a Variable requiring grad, the Gram matrix is
+            differentiable w.r.t. it. Defaults to sigma in every dimension
+            (set on the first call).
+
+        sigma (optional) : scalar
+        """
+        self.lengthscales = lengthscales
+        self.sigma = sigma
+
+    def _scale(self, x):
+        l = self.lengthscales
+        if l is None:
+            l = self.lengthscales = [float(self.sigma)] * x.shape[1]
+        if not torch.is_tensor(l) and not isinstance(l, Variable):
+            l = (x.data if isinstance(x, Variable) else x).new(l)
+        if isinstance(x, Variable) and not isinstance(l, Variable):
+            l = Variable(l, requires_grad=False)
+        assert l.shape[0]==x.shape[1], \
+        'expected {} lengthscales, got {}'.format(x.shape[1], l.shape[0])
+        return x / l.view(1, -1)
+
+    def __call__(self, x, y, mem_budget=None, recompute=False,
+        symmetric=None):
+        if symmetric is None: symmetric = x is y
+        assert not symmetric or y is x, 'symmetric=True requires y to be x'
+        x_ = self._scale(x)
+        y_ = x_ if symmetric else self._scale(y)
+        return gaussianKer(
+            x_, y_, 1.,
+            mem_budget=mem_budget,
+            recompute=recompute,
+            symmetric=symmetric
+            )
+
+    def params(self):
+        l = self.lengthscales
+        if isinstance(l, Variable): l = l.data
+        if torch.is_tensor(l): l = l.tolist()
+        return {
+            'lengthscales': tuple(l) if l is not None else None,
+            'sigma': self.sigma
+            }
+
+class _PolynomialKernel(torch.autograd.Function):
+    """
+    k(x, y) = (gamma <x, y> + coef0)^degree with analytic gradients. With
+    A = grad_gram * degree * gamma * (gamma <x, y> + coef0)^(degree-1),
+        grad_x = A y,
+        grad_y = A^T x.
+    Only x and y are saved for backward, the inner products are recomputed
+    tile by tile.
+    """
+    @staticmethod
+    def forward(ctx, x, y, kernel, mem_budget):
+        rows = _tile_size(x.shape[0], y.shape[0], _itemsize(x), mem_budget,
+            name=kernel.name)
+        gram = x.new(x.shape[0], y.shape[0])
+        for i in range(0, x.shape[0], rows):
+            gram[i: i+rows] = x[i: i+rows].mm(y.t())\
+            .mul_(kernel.gamma).add_(kernel.coef0).pow_(kernel.degree)
+
+        ctx.kernel, ctx.rows = kernel, rows
+        ctx.save_for_backward(x, y)
+        return gram
+
+    @staticmethod
+    def backward(ctx, grad_gram):
+        x, y = ctx.saved_tensors if hasattr(ctx, 'saved_tensors') \
+        else ctx.saved_variables
+        k, rows = ctx.kernel, ctx.rows
+
+        grad_x, grad_y = [], 0
+        for i in range(0, x.shape[0], rows):
+            x_ = x[i: i+rows]
+            A = x_.mm(y.t()).mul_(k.gamma).add_(k.coef0)
+            A = A.pow_(k.degree - 1) if k.degree > 1 else A.fill_(1)
+            A = A.mul_(grad_gram[i: i+rows]).mul_(k.degree * k.gamma)
+            if ctx.needs_input_grad[0]: grad_x.append(A.mm(y))
+            if ctx.needs_input_grad[1]: grad_y = grad_y + A.t().mm(x_)
+
+        grad_x = torch.cat(grad_x, dim=0) if grad_x else None
+        if not ctx.needs_input_grad[1]: grad_y = None
+        return grad_x, grad_y, None, None
+
+@register_kernel
+class PolynomialKernel(Kernel):
+    """
+    k(x, y) = (gamma <x, y> + coef0)^degree, see _PolynomialKernel.
+    """
+    name = 'polynomial'
+
+    def __init__(self, degree=2, gamma=1., coef0=1.):
+        assert int(degree)==degree and degree >= 1
+        self.degree = int(degree)
+        self.gamma = gamma
+        self.coef0 = coef0
+
+    def __call__(self, x, y, mem_budget=None, recompute=False,
+        symmetric=None):
+        return _PolynomialKernel.apply(x, y, self, mem_budget)
+
+def _normalize(x):
+    """
+    Rows of x scaled to unit norm, and their norms.
+    """
+    norm = x.norm(2, 1, keepdim=True).clamp(min=1e-12)
+    return x / norm, norm
+
+class _CosineKernel(torch.autograd.Function):
+    """
+    k(x, y) = <x, y> / (||x||_2 ||y||_2) with analytic gradients. With
+    x_, y_ the normalized examples and
+        B = grad_gram y_, B' = grad_gram^T x_,
+    the gradients are those of the normalized examples projected onto the
+    tangent space of the sphere,
+        grad_x = (B - diag(<B, x_>) x_) / ||x||_2,
+        grad_y = (B' - diag(<B', y_>) y_) / ||y||_2.
+    Only x and y are saved for backward, the normalized examples are
+    recomputed.
+    """
+    @staticmethod
+    def forward(ctx, x, y, kernel, mem_budget):
+        rows = _tile_size(x.shape[0], y.shape[0], _itemsize(x), mem_budget,
+            name=kernel.name)
+        x_, y_ = _normalize(x)[0], _normalize(y)[0]
+        gram = x.new(x.shape[0], y.shape[0])
+        for i in range(0, x.shape[0], rows):
+            gram[i: i+rows] = x_[i: i+rows].mm(y_.t())
+
+        ctx.kernel, ctx.rows = kernel, rows
+        ctx.save_for_backward(x, y)
+        return gram
+
+    @staticmethod
+    def backward(ctx, grad_gram):
+        x, y = ctx.saved_tensors if hasattr(ctx, 'saved_tensors') \
+        else ctx.saved_variables
+        rows = ctx.rows
+        (x_, x_norm), (y_, y_norm) = _normalize(x), _normalize(y)
+
+        grad_x, grad_y = [], 0
+        for i in range(0, x.shape[0], rows):
+            G = grad_gram[i: i+rows]
+            if ctx.needs_input_grad[0]: grad_x.append(G.mm(y_))
+            if ctx.needs_input_grad[1]:
+                grad_y = grad_y + G.t().mm(x_[i: i+rows])
+
+        project = lambda g, u, norm: (g - u * (g * u).sum(1, keepdim=True)) \
+        / norm
+        grad_x = project(torch.cat(grad_x, dim=0), x_, x_norm) \
+        if grad_x else None
+        grad_y = project(grad_y, y_, y_norm) \
+        if ctx.needs_input_grad[1] else None
+        return grad_x, grad_y, None, None
+
+@register_kernel
+class CosineKernel(Kernel):
+    """
+    k(x, y) = <x, y> / (||x||_2 ||y||_2), the inner product of the
+    normalized examples, see _CosineKernel.
+    """
+    name = 'cosine'
+
+    def __call__(self, x, y, mem_budget=None, recompute=False,
+        symmetric=None):
+        if symmetric is None: symmetric = x is y
+        assert not symmetric or y is x, 'symmetric=True requires y to be x'
+        return _CosineKernel.apply(x, y, self, mem_budget)
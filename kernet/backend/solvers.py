@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import math as m
+import warnings
+import torch
+from torch.autograd import Variable
+
+from .torch_backend import _solve, _symeig, _cholesky, _cholesky_solve, \
+    _qr, inv_sqrt
+
+def conjugate_gradient(matvec, b, precond=None, max_iter=100, tol=1e-6):
+    """
+    Preconditioned conjugate gradient for Ax = b with A symmetric positive
+    definite. Each column of b is solved for independently (but in one pass).
+
+    Parameters
+    ----------
+    matvec : callable
+        Computes AX for a Tensor X of shape (dim, n_col).
+
+    b : Tensor, shape (dim, n_col)
+
+    precond (optional) : callable
+        Computes P^(-1)X for a preconditioner P ~= A.
+
+    max_iter (optional) : int
+
+    tol (optional) : scalar
+        Stop once the residual of every column is below tol times the norm of
+        the corresponding column of b.
+
+    Returns
+    -------
+    x : Tensor, shape (dim, n_col)
+
+    Raises
+    ------
+    RuntimeError
+        If A or the preconditioner turns out not to be positive definite or
+        the residual is not finite.
+    """
+    if precond is None: precond = lambda r: r
+    x = b.clone().zero_()
+    r = b.clone()
+    z = precond(r)
+    p = z.clone()
+    rz = r.mul(z).sum(0)
+    threshold = b.norm(2, 0).mul(tol)
+
+    for _ in range(max_iter):
+        if (rz < 0).any() or (rz!=rz).any():
+            raise RuntimeError('conjugate_gradient: the preconditioner is '
+                'not positive definite')
+        Ap = matvec(p)
+        pAp = p.mul(Ap).sum(0)
+        done = (rz==0).type_as(rz)
+        # NOTE: the columns whose residual is exactly 0 have p = 0
+        if ((pAp <= 0).type_as(rz) * (1 - done)).sum() > 0:
+            raise RuntimeError('conjugate_gradient: the matrix is not '
+                'positive definite')
+        alpha = rz / (pAp + done)
+        x.add_(p.mul(alpha.view(1, -1)))
+        r.sub_(Ap.mul(alpha.view(1, -1)))
+        res = r.norm(2, 0)
+        if (res!=res).any() or (res==float('inf')).any():
+            raise RuntimeError('conjugate_gradient: the residual is not '
+                'finite')
+        if (res <= threshold).all(): break
+
+        z = precond(r)
+        rz_new = r.mul(z).sum(0)
+        p = z + p.mul((rz_new / (rz + done)).view(1, -1))
+        rz = rz_new
+
+    return x
+
+def nystrom_preconditioner(phi, reg, gram=None, n_precond=100):
+    """
+    Falkon-style preconditioner for the system solved by ridge_solve,
+        H = phi^T phi + reg * n_example * G,
+    see https://arxiv.org/abs/1705.10958.
+
+    If G (gram) is the Gram matrix of the centers, phi^T phi ~=
+    n_example / n_center * G^2 (which holds when the centers are a sample of
+    the training set), so P = n_example / n_center * G^2 +
+    reg * n_example * G is used. P is inverted through the eigendecomposition
+    of G, or of its rank-n_precond Nystrom approximation
+    G ~= G_ms G_ss^(-1/2) (G_ms G_ss^(-1/2))^T for a random subset s of the
+    centers if n_precond < n_center (the complement of the approximated
+    eigenspace is scaled by the smallest approximated eigenvalue of P).
+
+    Otherwise (G = I), phi^T phi is estimated by LL^T with L the transpose of
+    n_precond random rows of phi (rescaled), and
+    P = reg * n_example * I + LL^T is inverted with the Woodbury identity.
+
+    Parameters
+    ----------
+    phi : Tensor, shape (n_example, n_center)
+
+    reg : scalar
+
+    gram (optional) : Tensor, shape (n_center, n_center)
+
+    n_precond (optional) : int
+        Rank of the approximation.
+
+    Returns
+    -------
+    precond : callable
+        Computes P^(-1)X for a Tensor X of shape (n_center, n_col).
+    """
+    n_example, n_center = phi.shape
+    delta = reg * n_example
+
+    if gram is not None:
+        if n_precond >= n_center:
+            e, U = _symeig(gram)
+        else:
+            index = torch.randperm(n_center)[:n_precond]
+            if phi.is_cuda: index = index.cuda()
+            gram_ms = gram.index_select(1, index)
+            L = gram_ms.mm(inv_sqrt(gram_ms.index_select(0, index)))
+            e, V = _symeig(L.t().mm(L))
+            # NOTE: L = U diag(e)^(1/2) V^T
+            keep = e > 1e-10 * e.max()
+            e, V = e[keep], V[:, keep]
+            U, _ = _qr(L.mm(V))
+            # NOTE: L V = U diag(e)^(1/2) in exact arithmetic, but the
+            # normalized columns of L V are not orthonormal in finite
+            # precision, which would make the preconditioner indefinite
+        e = e.clamp(min=0)
+        d = e.pow(2).mul(n_example / n_center) + e.mul(delta)
+        d += 1e-7 * d.max()
+        d_min = d.min()
+
+        def precond(r):
+            Ur = U.t().mm(r)
+            return U.mm(Ur.div(d.view(-1, 1))) + (r - U.mm(Ur)).div(d_min)
+        return precond
+
+    n_precond = min(n_precond, n_example)
+    index = torch.randperm(n_example)[:n_precond]
+    if phi.is_cuda: index = index.cuda()
+    L = phi.index_select(0, index).t().mul(m.sqrt(n_example / n_precond))
+    inner = L.t().mm(L) + delta * torch.eye(n_precond).type_as(L)
+
+    def precond(r):
+        return (r - L.mm(_solve(inner, L.t().mm(r)))).div(delta)
+    return precond
+
+def ridge_solve(
+    phi,
+    target,
+    reg,
+    gram=None,
+    solver='cholesky',
+    n_precond=100,
+    max_iter=100,
+    tol=1e-6):
+    """
+    Solve the regularized least squares problem
+        min_w ||phi w - target||_F^2 + reg * n_example * tr(w^T G w),
+    i.e., (phi^T phi + reg * n_example * G) w = phi^T target, where G is gram
+    or the identity. With phi = K(X, C) and gram = K(C, C), this is kernel
+    ridge regression expanded on the centers C (and standard kernel ridge
+    regression when C = X).
+
+    Parameters
+    ----------
+    phi : Tensor, shape (n_example, n_center)
+
+    target : Tensor, shape (n_example, out_dim)
+
+    reg : scalar
+
+    gram (optional) : Tensor, shape (n_center, n_center)
+
+    solver (optional) : str
+        'cholesky': direct solve, O(n_center^3), for small problems.
+        'cg': conjugate gradient with nystrom_preconditioner, for large
+        ones. Both run in double precision on the same (jittered) system.
+        If the conjugate gradient breaks down, ridge_solve warns and falls
+        back to 'cholesky'.
+
+    n_precond, max_iter, tol (optional)
+        Parameters of the 'cg' solver, see nystrom_preconditioner and
+        conjugate_gradient.
+
+    Returns
+    -------
+    w : Tensor, shape (n_center, out_dim)
+    """
+    if isinstance(phi, Variable): phi = phi.data
+    if isinstance(target, Variable): target = target.data
+    if isinstance(gram, Variable): gram = gram.data
+    n_example, n_center = phi.shape
+    delta = reg * n_example
+
+    if solver not in ('cholesky', 'cg'):
+        raise ValueError('unknown solver: {}'.format(solver))
+
+    phi_ = phi.double()
+    gram_ = gram.double() if gram is not None else None
+    rhs = phi_.t().mm(target.double())
+    # NOTE: H is often too ill-conditioned for single precision
+    jitter = 1e-10 if 'Double' in phi.type() else 1e-6
+    # NOTE: G may be (numerically) singular and, if computed in single
+    # precision, slightly indefinite
+
+    if solver=='cg':
+        diag_mean = phi_.pow(2).sum(0).mean() + delta * \
+        (gram_.diag().mean() if gram_ is not None else 1)
+        shift = jitter * diag_mean
+        def matvec(v):
+            Hv = phi_.t().mm(phi_.mm(v))
+            Hv += delta * (gram_.mm(v) if gram_ is not None else v)
+            return Hv + shift * v
+        try:
+            precond = nystrom_preconditioner(phi_, reg, gram_, n_precond)
+            w = conjugate_gradient(matvec, rhs, precond, max_iter, tol)
+        except RuntimeError as e:
+            warnings.warn('{}, falling back to cholesky'.format(e))
+            solver = 'cholesky'
+
+    if solver=='cholesky':
+        H = phi_.t().mm(phi_)
+        H += delta * gram_ if gram_ is not None else \
+        delta * torch.eye(n_center).type_as(H)
+        H += jitter * H.diag().mean() * torch.eye(n_center).type_as(H)
+        w = _cholesky_solve(rhs, _cholesky(H))
+
+    return w.type_as(phi)
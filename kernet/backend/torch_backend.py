@@ -3,11 +3,326 @@
 
 from __future__ import division, print_function
 
+import contextlib
 import math as m
+import warnings
+
+import numpy as np
 import torch
 from torch.autograd import Variable
+from torch.utils.data import Dataset, DataLoader
+
+try: from sklearn.neighbors import BallTree, KDTree
+except ImportError: BallTree = KDTree = None
+# NOTE: optional, only used by build_index
+
+_TENSOR_TYPES = {
+    'half': 'HalfTensor',
+    'bfloat16': 'BFloat16Tensor',
+    'float': 'FloatTensor',
+    'double': 'DoubleTensor'
+    }
+_ITEMSIZES = {'Half': 2, 'BFloat16': 2, 'Double': 8}
+
+def tensor_type(precision, cuda=False):
+    """
+    Name of the tensor type of a precision, 'half', 'bfloat16' (if supported
+    by the installed torch), 'float' or 'double', for Tensor.type, e.g.,
+    tensor_type('double', cuda=True) is 'torch.cuda.DoubleTensor'.
+    """
+    if precision not in _TENSOR_TYPES:
+        raise ValueError('unknown precision: {}'.format(precision))
+    return 'torch.' + ('cuda.' if cuda else '') + _TENSOR_TYPES[precision]
+
+def itemsize(precision):
+    """
+    Size in bytes of an element of a precision, see tensor_type.
+    """
+    return _type_itemsize(tensor_type(precision))
+
+def _needs_graph(*tensors):
+    """
+    Whether autograd records the operations on any of tensors.
+    """
+    if hasattr(torch, 'is_grad_enabled') and not torch.is_grad_enabled():
+        return False
+    return any(getattr(t, 'requires_grad', False) for t in tensors)
+
+def _itemsize(x):
+    """
+    Size in bytes of an element of the floating point Tensor x.
+    """
+    return _type_itemsize(x.type())
+
+def _type_itemsize(name):
+    for key, size in _ITEMSIZES.items():
+        if key in name: return size
+    return 4
+
+_mem_budget = None # NOTE: see set_memory_budget
+_reported = set()
+
+_UNITS = {'': 1, 'B': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+def parse_memory(size):
+    """
+    Number of bytes in size, an int or a str such as '4GB', '512 MB', '1.5G'
+    or '2GiB'. Units are powers of 1024.
+    """
+    if size is None or isinstance(size, (int, float)): return size
+    s = size.strip().upper()
+    for suffix in ('IB', 'B'):
+        if s.endswith(suffix) and s[:-len(suffix)][-1:] in _UNITS:
+            s = s[:-len(suffix)]
+            break
+    unit = s[-1:] if s[-1:] in _UNITS and not s[-1:].isdigit() else ''
+    try: value = float(s[:len(s)-len(unit)])
+    except ValueError:
+        raise ValueError('cannot parse memory size: {}'.format(size))
+    return int(value * _UNITS[unit])
+
+def set_memory_budget(budget):
+    """
+    Memory budget used by every kernel computation that is not given one
+    explicitly (see sq_dist, sym_sq_dist, gaussianKer, kerMap, sigma_sweep)
+    and by the inference passes of the models (see baseMLKN.get_repr): the
+    Gram-shaped temporaries are then processed in tiles and the test sets in
+    chunks sized to fit in budget. A warning is issued the first time a
+    computation has to be split because of it. Tiles are made as large as
+    the budget allows, so that throughput stays close to that of a single
+    tile.
+
+    Parameters
+    ----------
+    budget : int, str or None
+        In bytes, or a str such as '4GB' (see parse_memory). None removes
+        the budget.
+    """
+    global _mem_budget
+    _mem_budget = parse_memory(budget)
+    _reported.clear()
+
+def get_memory_budget():
+    """
+    The memory budget in bytes set with set_memory_budget, or None.
+    """
+    return _mem_budget
+
+def _resolve_budget(mem_budget):
+    return _mem_budget if mem_budget is None else parse_memory(mem_budget)
+
+def _report_split(name, n, size):
+    """
+    Warn (once per computation and size) that a computation over n rows
+    is split into chunks of size rows to fit in the memory budget.
+    """
+    if size >= n or (name, n, size) in _reported: return
+    _reported.add((name, n, size))
+    warnings.warn('{}: {} rows processed in chunks of {} to fit in the '
+        'memory budget of {:.1f}MB'.format(
+        name, n, size, (_mem_budget or 0) / 2**20
+        ))
+
+def _tile_size(n1, n2, itemsize, mem_budget, n_temp=3, name=None):
+    """
+    Number of rows of x to process at once so that the Gram-shaped
+    temporaries of one tile (n_temp of them, each of shape (rows, n2)) fit in
+    mem_budget bytes (defaults to the global budget, see set_memory_budget).
+    Always returns at least 1.
+    """
+    explicit = mem_budget is not None
+    mem_budget = _resolve_budget(mem_budget)
+    if mem_budget is None: return n1
+    rows = max(1, min(n1, int(mem_budget // (n_temp * n2 * itemsize))))
+    if not explicit and name is not None: _report_split(name, n1, rows)
+    return rows
+
+def _square_tile(n, itemsize, mem_budget, n_temp=3, name=None):
+    """
+    Side of the square tiles of an (n, n) computation whose tiles have n_temp
+    temporaries each, see _tile_size. 512 without a budget.
+    """
+    explicit = mem_budget is not None
+    mem_budget = _resolve_budget(mem_budget)
+    if mem_budget is None: return min(512, n)
+    tile = max(1, min(n, int(m.sqrt(mem_budget // (n_temp * itemsize)))))
+    if not explicit and name is not None: _report_split(name, n, tile)
+    return tile
+
+def chunk_size(n, row_bytes, mem_budget=None, name=None):
+    """
+    Number of rows of an n-row computation to process at once so that the
+    memory of a chunk, row_bytes per row, fits in mem_budget bytes (defaults
+    to the global budget, see set_memory_budget). n without a budget.
+    """
+    return _tile_size(n, row_bytes, 1, mem_budget, n_temp=1, name=name)
+
+def sq_dist(x, y, mem_budget=None):
+    """
+    Pairwise squared Euclidean distances computed via the expansion
+        ||x_i-y_j||_2^2 = ||x_i||_2^2 + ||y_j||_2^2 - 2 <x_i, y_j>,
+    i.e., a single matrix product per tile instead of the
+    (n1_example, n2_example, dim) difference tensor. Rows of x are processed
+    in tiles so that the temporaries of each tile fit in mem_budget bytes.
+    Negative values caused by cancellation are clamped to 0.
+
+    Parameters
+    ----------
+
+    x : Tensor, shape (n1_example, dim)
+
+    y : Tensor, shape (n2_example, dim)
+
+    mem_budget (optional) : int
+        Memory budget for the temporaries of a single tile in bytes. If not
+        given, the global budget (see set_memory_budget) is used and without
+        one, x is processed in one tile.
+
+    Returns
+    -------
+
+    dist : Tensor, shape (n1_example, n2_example)
+    """
+    y_norm = y.pow(2).sum(dim=1).view(1, -1)
+    itemsize = _itemsize(x)
+    rows = _tile_size(x.shape[0], y.shape[0], itemsize, mem_budget,
+        name='sq_dist')
+
+    out = None
+    if rows < x.shape[0] and not _needs_graph(x, y):
+        out = (x.data if isinstance(x, Variable) else x)\
+        .new(x.shape[0], y.shape[0])
+        # NOTE: the tiles are written in place instead of being
+        # concatenated, which would hold the result twice
+
+    tiles = []
+    for i in range(0, x.shape[0], rows):
+        x_ = x[i: i+rows]
+        x_norm = x_.pow(2).sum(dim=1).view(-1, 1)
+        dist = x_norm + y_norm - 2 * x_.mm(y.t())
+        dist = dist.clamp(min=0)
+        # NOTE: x_norm + y_norm - 2 * x_.y may be slightly negative for
+        # (numerically) identical points
+        if out is None: tiles.append(dist)
+        else: out[i: i+rows] = dist.data if isinstance(dist, Variable) \
+        else dist
+
+    if out is not None:
+        if not isinstance(x, Variable): return out
+        return volatile(out) if _is_volatile(x) \
+        else Variable(out, requires_grad=False)
+    return tiles[0] if len(tiles)==1 else torch.cat(tiles, dim=0)
+
+def sym_sq_dist(x, mem_budget=None):
+    """
+    Pairwise squared Euclidean distances between the rows of x, see sq_dist.
+    Only the tiles on and above the diagonal are computed, the others are
+    mirrored, which takes roughly half the FLOPs of sq_dist(x, x). The
+    diagonal is exactly 0. Not differentiable.
+
+    Parameters
+    ----------
+
+    x : Tensor, shape (n_example, dim)
+
+    mem_budget (optional) : int
+        Memory budget for the temporaries of a single (square) tile in bytes.
+        If not given, the global budget (see set_memory_budget) is used and
+        without one, tiles of 512 rows.
+
+    Returns
+    -------
+
+    dist : Tensor, shape (n_example, n_example)
+    """
+    if isinstance(x, Variable): x = x.data
+    n_example = x.shape[0]
+    itemsize = _itemsize(x)
+    tile = _square_tile(n_example, itemsize, mem_budget, name='sym_sq_dist')
+
+    norm = x.pow(2).sum(dim=1)
+    dist = x.new(n_example, n_example)
+    for i in range(0, n_example, tile):
+        x_i = x[i: i+tile]
+        for j in range(i, n_example, tile):
+            x_j = x[j: j+tile]
+            block = norm[i: i+tile].view(-1, 1) + norm[j: j+tile].view(1, -1)
+            block.sub_(x_i.mm(x_j.t()).mul_(2)).clamp_(min=0)
+            if i==j: block.view(-1)[::block.shape[1]+1] = 0
+            dist[i: i+tile, j: j+tile] = block
+            if i!=j: dist[j: j+tile, i: i+tile] = block.t()
+
+    return dist
 
-def gaussianKer(x, y, sigma):
+class _GaussianKernel(torch.autograd.Function):
+    """
+    Gaussian kernel with analytic gradients. With A = grad_gram * gram,
+        grad_x = (A y - diag(A 1) x) / sigma^2,
+        grad_y = (A^T x - diag(A^T 1) y) / sigma^2,
+        grad_sigma = sum(A * D) / sigma^3,
+    where D holds the squared distances. Only x, y and the output gram (which
+    the caller holds anyway) are saved for backward, or, if recompute, only x
+    and y, in which case gram is recomputed tile by tile in backward. D is
+    recomputed tile by tile in backward if needed.
+    """
+    @staticmethod
+    def forward(ctx, x, y, sigma, mem_budget, recompute, symmetric):
+        s = float(sigma)
+        if symmetric: dist = sym_sq_dist(x, mem_budget=mem_budget)
+        else: dist = sq_dist(x, y, mem_budget=mem_budget)
+        gram = dist.mul_(-1./(2*s**2)).exp_()
+
+        ctx.sigma, ctx.mem_budget, ctx.recompute = s, mem_budget, recompute
+        ctx.sigma_shape = sigma.shape if torch.is_tensor(sigma) else None
+        if recompute: ctx.save_for_backward(x, y)
+        else: ctx.save_for_backward(x, y, gram)
+        return gram
+
+    @staticmethod
+    def backward(ctx, grad_gram):
+        s = ctx.sigma
+        saved = ctx.saved_tensors if hasattr(ctx, 'saved_tensors') \
+        else ctx.saved_variables
+        x, y = saved[:2]
+        if ctx.recompute or ctx.needs_input_grad[2]:
+            rows = _tile_size(x.shape[0], y.shape[0], _itemsize(x),
+                ctx.mem_budget, name='gaussianKer backward')
+        else: rows = x.shape[0]
+
+        grad_x, grad_y, grad_sigma = [], 0, 0
+        for i in range(0, x.shape[0], rows):
+            x_ = x[i: i+rows]
+            if ctx.recompute or ctx.needs_input_grad[2]:
+                dist = sq_dist(x_, y)
+                # NOTE: recovering it as -2 sigma^2 log(gram) loses precision
+                # where gram is small and fails where it underflows
+            if ctx.recompute: gram_ = dist.mul(-1./(2*s**2)).exp()
+            else: gram_ = saved[2][i: i+rows]
+            A = grad_gram[i: i+rows].mul(gram_)
+
+            if ctx.needs_input_grad[0]:
+                grad_x.append(
+                    (A.mm(y) - A.sum(dim=1).view(-1, 1).mul(x_)).div(s**2)
+                    )
+            if ctx.needs_input_grad[1]:
+                grad_y = grad_y + \
+                (A.t().mm(x_) - A.sum(dim=0).view(-1, 1).mul(y)).div(s**2)
+            if ctx.needs_input_grad[2]:
+                grad_sigma = grad_sigma + A.mul(dist).sum() / s**3
+
+        grad_x = torch.cat(grad_x, dim=0) if grad_x else None
+        if not ctx.needs_input_grad[1]: grad_y = None
+        if ctx.needs_input_grad[2]:
+            grad_sigma = grad_sigma.view(ctx.sigma_shape)
+        else: grad_sigma = None
+        return grad_x, grad_y, grad_sigma, None, None, None
+
+def gaussianKer(
+    x, y, sigma,
+    mode='fused',
+    mem_budget=None,
+    recompute=False,
+    symmetric=None):
     """
     Gaussian kernel: k(x, y) = exp(-||x-y||_2^2 / (2 * sigma^2)).
     Arguments must be matrices or 1darrays. 1darrays will be converted to
@@ -22,7 +337,32 @@ def gaussianKer(x, y, sigma):
 
     y : Tensor, shape (n2_example, dim)
 
-    sigma : scalar
+    sigma : scalar or Tensor of a single element
+        If sigma is a Tensor, gradient w.r.t. it is supported in 'fused' mode.
+
+    mode (optional) : str
+        'fused': compute the squared distances with sq_dist and
+        differentiate analytically (see _GaussianKernel), so that only x, y
+        and the output are kept for the backward pass. 'expand': compute the
+        squared distances with sq_dist and let autograd differentiate through
+        them, peak memory is O(n1_example * n2_example) but several such
+        intermediates are kept for backward. 'diff': compute them from the
+        (n1_example, n2_example, dim) difference tensor. All give identical
+        results up to floating point error.
+
+    mem_budget (optional) : int
+        Memory budget in bytes for the temporaries of a single tile in
+        'fused' and 'expand' modes, see sq_dist. Defaults to the global
+        budget, see set_memory_budget.
+
+    recompute (optional) : bool
+        In 'fused' mode, do not keep the output for backward but recompute it
+        tile by tile during the backward pass.
+
+    symmetric (optional) : bool
+        Whether x and y are the same set. In 'fused' mode, only half of the
+        Gram matrix is then computed, see sym_sq_dist. If not given, it is
+        True iff x is y. If True, y must be x.
 
     Returns
     -------
@@ -31,6 +371,7 @@ def gaussianKer(x, y, sigma):
         Technically not a Gram matrix when x!=y, only using this name for
         convenience.
     """
+    assert not symmetric or y is x, 'symmetric=True requires y to be x'
     if len(x.shape)==1: x.unsqueeze_(0)
     if len(y.shape)==1: y.unsqueeze_(0)
     assert len(x.shape)==2 and len(y.shape)==2 and x.shape[1]==y.shape[1]
@@ -42,22 +383,34 @@ def gaussianKer(x, y, sigma):
     # and which dimensions to sum out in this part:
     # y.sub(x.unsqueeze(1)).pow(2).sum(dim=-1)
 
-    gram = y.sub(x.unsqueeze(1)).pow(2).sum(dim=-1).mul(-1./(2*sigma**2)).exp()
-    # gram = y.sub(x.unsqueeze(1)).pow(2).sum(dim=-1).mul(-sigma).exp()
-    # TODO: this thing eats up memory like crazy, for those intermediate values
-    # that will not be used for gradient calculations, use in_place operations
-    # instead
+    if mode=='fused':
+        if symmetric is None: symmetric = x is y
+        return _GaussianKernel.apply(
+            x, y, sigma,
+            mem_budget, recompute, symmetric
+            )
+    elif mode=='expand':
+        dist = sq_dist(x, y, mem_budget=mem_budget)
+    elif mode=='diff':
+        dist = y.sub(x.unsqueeze(1)).pow(2).sum(dim=-1)
+        # NOTE: this eats up memory like crazy, kept as a reference
+        # implementation
+    else:
+        raise ValueError('unknown mode: {}'.format(mode))
+
+    gram = dist.mul(-1./(2*sigma**2)).exp()
+    # gram = dist.mul(-sigma).exp()
 
     return gram
 
 
-def kerMap(x, X, sigma):
+def kerMap(x, X, sigma, mem_budget=None, recompute=False, symmetric=None):
     """
     For all x_ \in x, computes the image of x_ under the mapping:
         f: f(x_) -> (k(x_1, x_), k(x_2, x_), ..., k(x_n, x_)),
-    where k is a kernel function and X = {x_1, x_2, ..., x_n}.
-    Currently only supports Gaussian kernel:
-    k(x, y) = exp(-||x-y||_2^2 / (2 * sigma^2)).
+    where k is a kernel function and X = {x_1, x_2, ..., x_n}: the
+    Gaussian kernel k(x, y) = exp(-||x-y||_2^2 / (2 * sigma^2)) or a kernel
+    of the registry (see get_kernel).
     Can be used to calculate Gram matrix.
 
     Parameters
@@ -67,18 +420,455 @@ def kerMap(x, X, sigma):
 
     X : Tensor, shape (n_example, dim)
 
-    sigma : scalar
+    sigma : scalar or Kernel
+        Width of the Gaussian kernel, or the kernel itself.
+
+    mem_budget (optional) : int
+        Memory budget in bytes for the temporaries of a single tile, see
+        gaussianKer.
+
+    recompute (optional) : bool
+        Recompute x_image in backward instead of keeping it, see gaussianKer.
+
+    symmetric (optional) : bool
+        Whether x and X are the same set, see gaussianKer. If not given, it
+        is True iff x is X.
 
     Returns
     -------
 
     x_image : Tensor, shape (batch_size, n_example)
     """
-    x_image = gaussianKer(x, X, sigma)
+    if callable(sigma):
+        return sigma(
+            x, X,
+            mem_budget=mem_budget,
+            recompute=recompute,
+            symmetric=symmetric
+            )
+    x_image = gaussianKer(
+        x, X, sigma,
+        mem_budget=mem_budget,
+        recompute=recompute,
+        symmetric=symmetric
+        )
 
     return x_image
 
-def one_hot(y, n_class):
+class _GaussianKernelLinear(torch.autograd.Function):
+    """
+    Gaussian kernel map followed by a linear map, y = k(x, X) W^T + b. The
+    kernel map is computed tile by tile (see sq_dist) in the type of x and
+    kept for backward in a storage type of its own, e.g., float16, so that
+    the Gram-shaped memory held between forward and backward shrinks
+    accordingly while all arithmetic runs in the type of x. With
+    A = (grad_y W) * gram, the gradients w.r.t. x and X are those of
+    _GaussianKernel and grad_W = grad_y^T gram.
+    """
+    @staticmethod
+    def forward(ctx, x, X, weight, bias, sigma, storage, mem_budget):
+        s = float(sigma)
+        rows = _tile_size(x.shape[0], X.shape[0], _itemsize(x), mem_budget,
+            name='kerLinearMap')
+        y, tiles = [], []
+        for i in range(0, x.shape[0], rows):
+            gram = sq_dist(x[i: i+rows], X, mem_budget=mem_budget)\
+            .mul_(-1./(2*s**2)).exp_()
+            y.append(gram.mm(weight.t()))
+            tiles.append(gram.type(storage))
+        y = y[0] if len(y)==1 else torch.cat(y, dim=0)
+        if bias is not None: y += bias.view(1, -1)
+
+        del gram
+        ctx.sigma, ctx.rows, ctx.tiles = s, rows, tiles
+        ctx.has_bias = bias is not None
+        ctx.save_for_backward(x, X, weight)
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        s, rows = ctx.sigma, ctx.rows
+        x, X, weight = ctx.saved_tensors if hasattr(ctx, 'saved_tensors') \
+        else ctx.saved_variables
+
+        grad_x, grad_X, grad_weight = [], 0, 0
+        for k, i in enumerate(range(0, x.shape[0], rows)):
+            x_, g = x[i: i+rows], grad_y[i: i+rows]
+            gram = ctx.tiles[k]
+            if isinstance(x_, Variable): gram = Variable(gram)
+            gram = gram.type_as(x_)
+
+            if ctx.needs_input_grad[2]:
+                grad_weight = grad_weight + g.t().mm(gram)
+            if ctx.needs_input_grad[0] or ctx.needs_input_grad[1]:
+                A = g.mm(weight)
+                A.mul_(gram)
+                del gram # NOTE: at most two Gram-shaped temporaries per tile
+                if ctx.needs_input_grad[0]:
+                    grad_x.append(
+                        (A.mm(X) - A.sum(dim=1).view(-1, 1).mul(x_))\
+                        .div(s**2)
+                        )
+                if ctx.needs_input_grad[1]:
+                    grad_X = grad_X + \
+                    (A.t().mm(x_) - A.sum(dim=0).view(-1, 1).mul(X)).div(s**2)
+
+        grad_x = torch.cat(grad_x, dim=0) if grad_x else None
+        if not ctx.needs_input_grad[1]: grad_X = None
+        if not ctx.needs_input_grad[2]: grad_weight = None
+        grad_bias = grad_y.sum(dim=0) \
+        if ctx.has_bias and ctx.needs_input_grad[3] else None
+        return grad_x, grad_X, grad_weight, grad_bias, None, None, None
+
+def kerLinearMap(x, X, sigma, weight, bias=None, storage='half',
+    mem_budget=None):
+    """
+    kerMap(x, X, sigma) followed by a linear map with weight and bias (as
+    torch.nn.functional.linear), keeping the kernel map in the precision
+    storage for the backward pass instead of the precision of x, see
+    _GaussianKernelLinear. E.g., with x in float32 and storage='half', the
+    distances and kernel values are computed in float32 but the image of x
+    held by autograd takes half the memory. Rounding the stored kernel
+    values only affects the gradients.
+
+    Parameters
+    ----------
+
+    x : Tensor, shape (batch_size, dim)
+
+    X : Tensor, shape (n_example, dim)
+
+    sigma : scalar
+        Not differentiable here.
+
+    weight : Tensor, shape (out_dim, n_example)
+
+    bias (optional) : Tensor, shape (out_dim,)
+
+    storage (optional) : str
+        Precision of the stored kernel map, see tensor_type.
+
+    mem_budget (optional) : int
+        Memory budget in bytes for the temporaries of a single tile, see
+        sq_dist.
+
+    Returns
+    -------
+
+    y : Tensor, shape (batch_size, out_dim)
+    """
+    assert not getattr(sigma, 'requires_grad', False), \
+    'kerLinearMap does not differentiate w.r.t. sigma'
+    return _GaussianKernelLinear.apply(
+        x, X, weight, bias, sigma,
+        tensor_type(storage, x.is_cuda), mem_budget
+        )
+
+def batchKerMap(x, X, sigma):
+    """
+    kerMap for a batch of n_member models with their own kernel widths and,
+    possibly, their own inputs and reference sets. If x and X are shared by
+    all members, the squared distances are computed once and, if all the
+    kernel widths are equal as well, so is the image, which is then returned
+    with a leading dimension of size 1 instead of n_member.
+
+    Parameters
+    ----------
+
+    x : Tensor, shape (batch_size, dim) or (n_member, batch_size, dim)
+
+    X : Tensor, shape (n_example, dim) or (n_member, n_example, dim)
+
+    sigma : list of n_member scalars
+
+    Returns
+    -------
+
+    x_image : Tensor, shape (n_member, batch_size, n_example) or
+        (1, batch_size, n_example)
+    """
+    n_member = len(sigma)
+    if len(x.shape)==2 and len(X.shape)==2:
+        if all(s==sigma[0] for s in sigma):
+            return kerMap(x, X, sigma[0]).unsqueeze(0)
+        dist = sq_dist(x, X).unsqueeze(0)
+    else:
+        if len(x.shape)==2: x = x.unsqueeze(0).expand(n_member, *x.shape)
+        if len(X.shape)==2: X = X.unsqueeze(0).expand(n_member, *X.shape)
+        dist = x.pow(2).sum(dim=2, keepdim=True) + \
+        X.pow(2).sum(dim=2, keepdim=True).transpose(1, 2) - \
+        2 * torch.bmm(x, X.transpose(1, 2))
+        dist = dist.clamp(min=0)
+
+    scale = x.data.new([-1 / (2 * s**2) for s in sigma]).view(-1, 1, 1)
+    if isinstance(dist, Variable): scale = Variable(scale)
+    return dist.mul(scale).exp()
+
+def kernel_radius(sigma, tol):
+    """
+    Distance beyond which the Gaussian kernel of width sigma is below tol,
+    i.e., sigma * sqrt(2 * ln(1/tol)).
+    """
+    assert 0 < tol < 1
+    return sigma * m.sqrt(2 * m.log(1 / tol))
+
+def build_index(X):
+    """
+    Spatial index over the rows of X for radius_neighbors: a KD-tree (for
+    dim <= 20) or a ball tree from scikit-learn. Without scikit-learn, X
+    itself is returned and the queries are answered by brute force.
+
+    Parameters
+    ----------
+    X : Tensor, shape (n_example, dim)
+
+    Returns
+    -------
+    index : object
+    """
+    if isinstance(X, Variable): X = X.data
+    if BallTree is None:
+        warnings.warn('scikit-learn is not installed, radius queries fall '
+            'back to brute force')
+        return X
+    X = X.cpu().numpy().astype(np.float64)
+    return KDTree(X) if X.shape[1] <= 20 else BallTree(X)
+
+def radius_neighbors(index, x, radius):
+    """
+    All pairs (i, j) such that ||x_i - X_j||_2 <= radius, where X is the set
+    index was built on (see build_index).
+
+    Parameters
+    ----------
+    index : object
+        See build_index.
+
+    x : Tensor, shape (n_example, dim)
+
+    radius : scalar
+
+    Returns
+    -------
+    rows, cols : LongTensor, shape (n_pair,)
+        Indices i into x and j into X.
+
+    dist : Tensor, shape (n_pair,)
+        Squared distances, of the same type as x.
+    """
+    if isinstance(x, Variable): x = x.data
+    if torch.is_tensor(index):
+        dist = sq_dist(x, index)
+        mask = dist <= radius**2
+        if not mask.any():
+            empty = torch.cuda.LongTensor() if x.is_cuda else torch.LongTensor()
+            return empty, empty, x.new()
+        pairs = mask.nonzero()
+        return pairs[:, 0], pairs[:, 1], dist.masked_select(mask)
+
+    cols, dist = index.query_radius(
+        x.cpu().numpy().astype(np.float64), radius, return_distance=True
+        )
+    counts = np.array([c.shape[0] for c in cols], dtype=np.int64)
+    rows = np.repeat(np.arange(x.shape[0], dtype=np.int64), counts)
+    cols = np.concatenate(cols).astype(np.int64) if len(cols) else \
+    np.zeros(0, dtype=np.int64)
+    dist = np.concatenate(dist) if len(dist) else np.zeros(0)
+    rows, cols = torch.from_numpy(rows), torch.from_numpy(cols)
+    dist = x.new(dist.shape[0]).copy_(torch.from_numpy(dist**2))
+    if x.is_cuda: rows, cols = rows.cuda(), cols.cuda()
+    return rows, cols, dist
+
+def rffMap(x, omega, phase, sigma):
+    """
+    Random Fourier features approximating the Gaussian kernel
+    k(x, y) = exp(-||x-y||_2^2 / (2 * sigma^2)), see
+    https://people.eecs.berkeley.edu/~brecht/papers/07.rah.rec.nips.pdf:
+        z(x_) = sqrt(2/n_feature) * cos(x_ omega / sigma + phase),
+    so that z(x_).z(y_) ~= k(x_, y_).
+
+    Parameters
+    ----------
+
+    x : Tensor, shape (batch_size, dim)
+
+    omega : Tensor, shape (dim, n_feature)
+        Frequencies drawn from the standard normal distribution.
+
+    phase : Tensor, shape (n_feature,)
+        Phases drawn uniformly from [0, 2*pi].
+
+    sigma : scalar
+
+    Returns
+    -------
+
+    x_image : Tensor, shape (batch_size, n_feature)
+    """
+    if len(x.shape)==1: x.unsqueeze_(0)
+    n_feature = omega.shape[1]
+    x_image = x.mm(omega).div(sigma).add(phase.view(1, -1)).cos()
+    return x_image.mul(m.sqrt(2./n_feature))
+
+def _solve(A, B):
+    """
+    Solve AX = B for X. A must be square.
+    """
+    if hasattr(torch, 'linalg'): return torch.linalg.solve(A, B)
+    X, _ = torch.gesv(B, A)
+    return X
+
+def _cholesky(A):
+    """
+    Lower-triangular Cholesky factor of a symmetric positive definite matrix.
+    """
+    if hasattr(torch, 'linalg'): return torch.linalg.cholesky(A)
+    return torch.potrf(A, upper=False)
+
+def _cholesky_solve(B, L):
+    """
+    Solve AX = B for X given the lower-triangular Cholesky factor L of A.
+    """
+    if hasattr(torch, 'cholesky_solve'): return torch.cholesky_solve(B, L)
+    return torch.potrs(B, L, upper=False)
+
+def _symeig(A):
+    """
+    Eigenvalues (ascending) and eigenvectors of a symmetric matrix.
+    """
+    if hasattr(torch, 'linalg'): return torch.linalg.eigh(A)
+    return torch.symeig(A, eigenvectors=True)
+
+@contextlib.contextmanager
+def _no_op():
+    yield
+
+def no_grad():
+    """
+    Context in which autograd does not record anything, for inference:
+    torch.no_grad where it exists (torch>=0.4), else a no-op as torch 0.3
+    relies on volatile Variables instead, see volatile.
+    """
+    if hasattr(torch, 'no_grad'): return torch.no_grad()
+    return _no_op()
+
+def volatile(x):
+    """
+    Variable of the data of x that autograd does not track. Volatile, so that
+    everything computed from it is too, only on torch 0.3: later versions
+    warn about volatile and ignore it, use no_grad there.
+    """
+    if isinstance(x, Variable): x = x.data
+    if hasattr(torch, 'no_grad'): return Variable(x, requires_grad=False)
+    return Variable(x, volatile=True)
+
+def _is_volatile(x):
+    """
+    Whether x is a volatile Variable, see volatile.
+    """
+    return not hasattr(torch, 'no_grad') and getattr(x, 'volatile', False)
+
+def _qr(A):
+    """
+    Reduced QR decomposition A = QR, Q with orthonormal columns.
+    """
+    if hasattr(torch, 'linalg'): return torch.linalg.qr(A)
+    return torch.qr(A)
+
+def inv_sqrt(A, eps=1e-8):
+    """
+    A^(-1/2) for a symmetric positive semi-definite matrix A. Eigenvalues
+    smaller than eps times the largest one are treated as zero, i.e., this is
+    the pseudo-inverse square root.
+
+    Parameters
+    ----------
+    A : Tensor, shape (n, n)
+
+    eps (optional) : scalar
+
+    Returns
+    -------
+    A_inv_sqrt : Tensor, shape (n, n)
+    """
+    e, v = _symeig(A)
+    thresh = eps * e.max()
+    e_inv_sqrt = e.clamp(min=thresh).rsqrt() * (e > thresh).type_as(e)
+    return v.mm(e_inv_sqrt.view(-1, 1) * v.t())
+
+def get_landmarks(X, n_center, method='uniform', sigma=None, reg=1e-3):
+    """
+    Choose n_center landmark points from X, e.g., to be used as the
+    reference set (centers) of a kerLinear instead of the entire training
+    set.
+
+    Parameters
+    ----------
+    X : Tensor, shape (n_example, dim)
+
+    n_center : int
+
+    method (optional) : str
+        'uniform': uniform sampling without replacement.
+        'kmeans++': k-means++ seeding, i.e., each new center is sampled with
+        probability proportional to its squared distance to the closest
+        center already chosen.
+        'leverage': sampling without replacement with probability
+        proportional to approximate ridge leverage scores of the Gaussian
+        kernel matrix of X, computed from a Nystrom approximation on a uniform
+        pilot sample of size 2*n_center.
+
+    sigma (optional) : scalar
+        Kernel width, required by 'leverage'.
+
+    reg (optional) : scalar
+        Ridge parameter for 'leverage'.
+
+    Returns
+    -------
+    index : LongTensor, shape (n_center,)
+        Indices of the landmarks in X.
+    """
+    if isinstance(X, Variable): X = X.data
+    n_example = X.shape[0]
+    assert 0 < n_center <= n_example
+
+    if method=='uniform':
+        index = torch.randperm(n_example)[:n_center]
+
+    elif method=='kmeans++':
+        index = [int(torch.randperm(n_example)[0])]
+        min_dist = sq_dist(X, X[index[0]: index[0]+1]).view(-1)
+        for _ in range(n_center-1):
+            new = int(torch.multinomial(min_dist + 1e-12, 1)[0])
+            # NOTE: the offset keeps multinomial valid once all remaining
+            # points coincide with some center
+            index.append(new)
+            min_dist = torch.min(
+                min_dist,
+                sq_dist(X, X[new: new+1]).view(-1)
+                )
+        index = torch.LongTensor(index)
+
+    elif method=='leverage':
+        assert sigma is not None
+        pilot = torch.randperm(n_example)[:min(n_example, 2*n_center)]
+        K_ns = gaussianKer(X, X[pilot], sigma)
+        K_ss = gaussianKer(X[pilot], X[pilot], sigma)
+        # leverage score of x_i is the i-th diagonal entry of
+        # K_ns (K_sn K_ns + reg * n * K_ss)^-1 K_sn
+        A = K_ns.t().mm(K_ns) + reg * n_example * K_ss
+        A = A + 1e-8 * A.diag().mean() * torch.eye(A.shape[0]).type_as(A)
+        scores = K_ns.t().mul(_solve(A, K_ns.t())).sum(dim=0)
+        index = torch.multinomial(scores.clamp(min=1e-12), n_center)
+
+    else:
+        raise ValueError('unknown method: {}'.format(method))
+
+    if X.is_cuda: index = index.cuda()
+    return index
+
+def one_hot(y, n_class, dtype=None):
     """
     Convert categorical labels to one-hot labels. Values of categorical labels
     must be in {0, 1, ..., n_class-1}. This function performs the most
@@ -92,10 +882,13 @@ def one_hot(y, n_class):
 
     n_class : int
 
+    dtype (optional) : str
+        Tensor type of y_onehot, e.g., 'torch.DoubleTensor'. Defaults to that
+        of y.
+
     Returns
     -------
     y_onehot : Tensor (n_example, n_class)
-        dtype of y_onehot is consistent with that of y.
     """
     # NOTE: this function is not differentiable
     assert n_class >= 2
@@ -104,7 +897,7 @@ def one_hot(y, n_class):
     if isinstance(y, Variable): y = y.data
     # NOTE: y cannot be a Variable because scatter_ does not support autograd
 
-    original_dtype = y.type()
+    if dtype is None: dtype = y.type()
 
     y=y.type(torch.cuda.LongTensor) if y.is_cuda else y.type(torch.LongTensor)
     # NOTE: this is because scatter_ only supports LongTensor for its index param
@@ -113,12 +906,12 @@ def one_hot(y, n_class):
 
     n_example = y.shape[0]
 
-    y_onehot = torch.FloatTensor(n_example, n_class).fill_(0)
-    ones = torch.FloatTensor(n_example, 1).fill_(1)
+    y_onehot = y.new(n_example, n_class).zero_()
+    y_onehot.scatter_(1, y, y.new(n_example, 1).fill_(1))
+    # NOTE: built in the (integer) type of y, which is exact and on the
+    # device of y, and only then cast
 
-    y_onehot.scatter_(1, y, ones)
-
-    return Variable(y_onehot.type(original_dtype), requires_grad=False)
+    return Variable(y_onehot.type(dtype), requires_grad=False)
     # NOTE: (for alignment) if this is not Variable, the following
     # calculation for F inner prod cannot be done since .mul only supports
     # Tensor*Tensor or Var*Var
@@ -187,6 +980,116 @@ def alignment(gram1, gram2):
         frobenius_inner_prod(gram2, gram2))
     return alignment
 
+def label_alignment(y, n_class, gram=None, feat=None):
+    """
+    Empirical alignment between a kernel and the ideal kernel of labels y (see
+    ideal_gram) computed without materializing the ideal Gram matrix. With
+    Y the one-hot labels and n_c the size of class c,
+        <K, YY^T>_F = trace(Y^T K Y),
+        ||YY^T||_F = sqrt(sum_c n_c^2).
+    If instead of the Gram matrix K a feature matrix F with K = FF^T (e.g.,
+    random Fourier features, see rffMap) is given,
+        <K, YY^T>_F = ||F^T Y||_F^2,
+        ||K||_F = ||F^T F||_F,
+    so nothing of size (n_example, n_example) is ever computed.
+
+    Parameters
+    ----------
+    y : Tensor, shape (n_example, 1) or (1,) (singleton)
+        Categorical labels. Values of categorical labels must be in
+        {0, 1, ..., n_class-1}.
+
+    n_class : int
+
+    gram (optional) : Tensor, shape (n_example, n_example)
+
+    feat (optional) : Tensor, shape (n_example, n_feature)
+        Exactly one of gram and feat must be given.
+
+    Returns
+    -------
+    alignment : scalar (wrapped in a Variable if gram or feat is)
+    """
+    assert (gram is None) != (feat is None)
+    like = gram if gram is not None else feat
+    y_onehot = one_hot(y, n_class).type_as(like)
+    class_size = y_onehot.sum(dim=0)
+    target_norm = class_size.pow(2).sum().sqrt()
+
+    if gram is not None:
+        inner = y_onehot.t().mm(gram).mul(y_onehot.t()).sum()
+        gram_norm = gram.pow(2).sum().sqrt()
+    else:
+        inner = feat.t().mm(y_onehot).pow(2).sum()
+        gram_norm = feat.t().mm(feat).pow(2).sum().sqrt()
+
+    return inner / (gram_norm * target_norm)
+
+def sigma_sweep(x, y, sigmas, n_class=None, mem_budget=None):
+    """
+    Alignment (see label_alignment) between the Gaussian kernel on x and the
+    ideal kernel of labels y for each kernel width in sigmas. The squared
+    distances do not depend on sigma, so each tile of them (upper triangular
+    tiles only, see sym_sq_dist) is computed once and only scaled and
+    exponentiated for every sigma. Neither the distance matrix nor any Gram
+    matrix is ever materialized. Not differentiable.
+
+    Parameters
+    ----------
+    x : Tensor, shape (n_example, dim)
+
+    y : Tensor, shape (n_example, 1) or (n_example,)
+        Categorical labels in {0, 1, ..., n_class-1}.
+
+    sigmas : list of float
+
+    n_class (optional) : int
+        Defaults to max(y)+1.
+
+    mem_budget (optional) : int
+        Memory budget for the temporaries of a single tile in bytes. If not
+        given, the global budget (see set_memory_budget) is used and without
+        one, tiles of 512 rows.
+
+    Returns
+    -------
+    alignments : Tensor, shape (len(sigmas),)
+    """
+    if isinstance(x, Variable): x = x.data
+    if isinstance(y, Variable): y = y.data
+    y = y.contiguous().view(-1, 1)
+    if n_class is None: n_class = int(y.max()) + 1
+    n_example = x.shape[0]
+    itemsize = _itemsize(x)
+    tile = _square_tile(n_example, itemsize, mem_budget, n_temp=4,
+        name='sigma_sweep')
+
+    y_onehot = one_hot(y, n_class).type_as(x)
+    target_norm = m.sqrt(y_onehot.sum(dim=0).pow(2).sum())
+    scales = [-1 / (2 * sigma**2) for sigma in sigmas]
+    inner = [0.] * len(sigmas)
+    gram_sq_norm = [0.] * len(sigmas)
+
+    norm = x.pow(2).sum(dim=1)
+    for i in range(0, n_example, tile):
+        x_i = x[i: i+tile]
+        for j in range(i, n_example, tile):
+            x_j = x[j: j+tile]
+            block = norm[i: i+tile].view(-1, 1) + norm[j: j+tile].view(1, -1)
+            block.sub_(x_i.mm(x_j.t()).mul_(2)).clamp_(min=0)
+            if i==j: block.view(-1)[::block.shape[1]+1] = 0
+            same_class = y_onehot[i: i+tile].mm(y_onehot[j: j+tile].t())
+            weight = 1 if i==j else 2 # NOTE: the mirrored tile is skipped
+            for k, scale in enumerate(scales):
+                gram = block.mul(scale).exp_()
+                inner[k] += weight * float(gram.mul(same_class).sum())
+                gram_sq_norm[k] += weight * float(gram.pow_(2).sum())
+
+    return x.new([
+        inner[k] / (m.sqrt(gram_sq_norm[k]) * target_norm)
+        for k in range(len(sigmas))
+        ])
+
 def get_batch(*sets, batch_size, shuffle=False):
     """
     Generator, break a random sample X into batches of size batch_size.
@@ -196,7 +1099,7 @@ def get_batch(*sets, batch_size, shuffle=False):
     This light-weight function is to be used for small, simple datasets.
     For large datasets and better management of memory and multiprocessing,
     consider wrap the data into a torch.utils.data.Dataset object and
-    use torch.utils.data.DataLoader.
+    use torch.utils.data.DataLoader, see get_loader.
 
     X1 : Tensor, shape (n_example, dim_1, ..., dim_d1)
 
@@ -222,15 +1125,84 @@ def get_batch(*sets, batch_size, shuffle=False):
 
     if shuffle:
         new_index = torch.randperm(lens[0])
-        sets = list(map(lambda x: x[new_index], sets))
-    n_batch = lens[0] // batch_size
-    last_batch = bool(lens[0] % batch_size)
-
-    for i in range(n_batch):
-        yield tuple(map(lambda x: x[i*batch_size: (i+1)*batch_size], sets))
-    if last_batch:
-        i += 1
-        yield tuple(map(lambda x: x[i*batch_size:], sets))
+        if sets[0].is_cuda: new_index = new_index.cuda()
+        # NOTE: only the index is permuted, each batch is gathered from the
+        # sets when it is needed instead of copying the entire sets at once
+
+    for i in range(0, lens[0], batch_size):
+        if shuffle:
+            index = new_index[i: i+batch_size]
+            yield tuple(map(lambda x: x[index], sets))
+        else:
+            yield tuple(map(lambda x: x[i: i+batch_size], sets))
+
+def is_stream(X):
+    """
+    Whether X is a torch.utils.data.Dataset or DataLoader rather than a
+    Tensor.
+    """
+    return isinstance(X, (Dataset, DataLoader))
+
+def get_loader(
+    data,
+    batch_size=None,
+    shuffle=False,
+    num_workers=0,
+    pin_memory=False):
+    """
+    Wrap a torch.utils.data.Dataset into a DataLoader. Shuffling is done by
+    sampling a permutation of the indices, the data is never copied as a
+    whole. A DataLoader is returned as is and the other parameters are then
+    ignored.
+
+    Parameters
+    ----------
+    data : Dataset or DataLoader
+
+    batch_size (optional) : int
+        If not specified, use full mode.
+
+    shuffle (optional) : bool
+
+    num_workers (optional) : int
+        Number of worker processes prefetching the batches.
+
+    pin_memory (optional) : bool
+        Copy the batches into page-locked memory, for faster transfers to GPU.
+
+    Returns
+    -------
+    loader : DataLoader
+    """
+    if isinstance(data, DataLoader): return data
+    if not batch_size or batch_size>len(data): batch_size = len(data)
+    return DataLoader(
+        data,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=pin_memory
+        )
+
+def get_stream_batch(loader):
+    """
+    Generator, counterpart of get_batch for a DataLoader. Yields tuples of
+    Variables, whether the underlying Dataset returns a single Tensor or a
+    tuple of them.
+
+    Parameters
+    ----------
+    loader : DataLoader
+
+    Returns
+    -------
+    x1 : Tensor, shape (batch_size, dim_1, ..., dim_d1)
+
+    ...
+    """
+    for batch in loader:
+        if not isinstance(batch, (tuple, list)): batch = (batch,)
+        yield tuple(map(lambda x: Variable(x, requires_grad=False), batch))
 
 if __name__=='__main__':
     x = torch.FloatTensor([[1, 2]])
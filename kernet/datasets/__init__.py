@@ -0,0 +1 @@
+from .mkl import *
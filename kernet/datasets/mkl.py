@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+MKL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mkl')
+
+def list_mkl():
+    """
+    Names of the bundled Multiple Kernel Learning benchmarks used in
+    https://arxiv.org/abs/1802.03774, i.e., the datasets in datasets/mkl.
+
+    Returns
+    -------
+    names : list of str
+    """
+    return sorted(
+        f[:-len('.npy')] for f in os.listdir(MKL_DIR)
+        if f.endswith('.npy') and not f.endswith('_labels.npy')
+        )
+
+def _open(name, mmap):
+    """
+    Open the arrays of dataset name, memory-mapped copy-on-write if mmap
+    (pages stay shared until written, writes are private to the process
+    and never reach the files).
+    """
+    if name not in list_mkl():
+        raise ValueError('unknown dataset: {}, available: {}'.format(
+            name, ', '.join(list_mkl())
+            ))
+    mmap_mode = 'c' if mmap else None
+    x = np.load(os.path.join(MKL_DIR, name+'.npy'), mmap_mode=mmap_mode)
+    y = np.load(os.path.join(MKL_DIR, name+'_labels.npy'), mmap_mode=mmap_mode)
+    return x, y
+
+def load_mkl(name, mmap=True, dtype=None):
+    """
+    Load a bundled MKL benchmark as Tensors. With mmap, the files are
+    memory-mapped and the Tensors share pages with the page cache (and with
+    every other process that loads the same dataset), so loading is
+    instantaneous and nothing is read until it is used. The data is stored
+    as float64 (labels as int64): asking for another dtype makes a copy.
+
+    Parameters
+    ----------
+    name : str
+        See list_mkl.
+
+    mmap (optional) : bool
+        Memory-map the files copy-on-write. The returned Tensors can be
+        modified in place, the files are never written to.
+
+    dtype (optional) : Tensor type, e.g., torch.FloatTensor
+        Type of the returned features. If not given, keep float64 (no copy).
+
+    Returns
+    -------
+    x : Tensor, shape (n_example, dim)
+
+    y : LongTensor, shape (n_example,)
+        Categorical labels in {0, 1, ..., n_class-1}.
+    """
+    x, y = _open(name, mmap)
+    x, y = torch.from_numpy(x), torch.from_numpy(y)
+    if dtype is not None: x = x.type(dtype)
+    return x, y
+
+def random_index(n_example, size):
+    """
+    Random subset of {0, 1, ..., n_example-1} of the given size, e.g., for the
+    'random subset of size n at each run' protocol of the paper.
+
+    Returns
+    -------
+    index : LongTensor, shape (size,)
+    """
+    assert 0 < size <= n_example
+    return torch.randperm(n_example)[:size]
+
+class MKLDataset(Dataset):
+    """
+    A bundled MKL benchmark as a torch.utils.data.Dataset. The arrays are
+    memory-mapped and an optional index selects a subset without copying
+    anything, so datasets and their subsets are cheap to create and to
+    send to DataLoader workers (each worker maps the files again instead of
+    receiving a copy of the data).
+
+    Parameters
+    ----------
+    name : str
+        See list_mkl.
+
+    index (optional) : LongTensor, shape (n_subset,)
+        Indices of the examples to use. If not given, use all of them.
+
+    dtype (optional) : Tensor type
+        Type of the features returned, defaults to torch.FloatTensor.
+    """
+    def __init__(self, name, index=None, dtype=torch.FloatTensor):
+        self.name = name
+        self.index = index
+        self.dtype = dtype
+        self._arrays = None
+
+    def _get_arrays(self):
+        if self._arrays is None: self._arrays = _open(self.name, mmap=True)
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None # NOTE: reopened lazily after unpickling
+        return state
+
+    def __len__(self):
+        if self.index is not None: return len(self.index)
+        return self._get_arrays()[1].shape[0]
+
+    def __getitem__(self, i):
+        x, y = self._get_arrays()
+        if self.index is not None: i = int(self.index[i])
+        return torch.from_numpy(np.array(x[i])).type(self.dtype), int(y[i])
+
+    @property
+    def n_class(self):
+        return int(self._get_arrays()[1].max()) + 1
+
+    def subset(self, index):
+        """
+        Dataset restricted to the given positions of this one.
+
+        Parameters
+        ----------
+        index : LongTensor, shape (n_subset,)
+            Positions in this dataset.
+
+        Returns
+        -------
+        dataset : MKLDataset
+        """
+        if self.index is not None: index = self.index[index]
+        return MKLDataset(self.name, index=index, dtype=self.dtype)
+
+    def random_subset(self, size):
+        """
+        Random subset of the given size, see random_index.
+        """
+        return self.subset(random_index(len(self), size))
+
+    def tensors(self):
+        """
+        Materialize the dataset (only the selected subset is read).
+
+        Returns
+        -------
+        x : Tensor, shape (n_example, dim)
+
+        y : LongTensor, shape (n_example,)
+        """
+        x, y = self._get_arrays()
+        if self.index is not None:
+            index = self.index.numpy()
+            x, y = x[index], y[index]
+        else: x, y = np.array(x), np.array(y)
+        return torch.from_numpy(x).type(self.dtype), torch.from_numpy(y)
@@ -1 +1,4 @@
 from .kerlinear import kerLinear
+from .rfflinear import rffLinear
+from .kerlinearensemble import kerLinearEnsemble
+from .kerlinearsharded import kerLinearSharded
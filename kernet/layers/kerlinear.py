@@ -9,7 +9,15 @@ import backend as K
 torch.manual_seed(1234)
 
 class kerLinear(torch.nn.Module):
-    def __init__(self, ker_dim, out_dim, sigma, bias=True):
+    needs_centers = True # NOTE: whether forward uses its X argument
+    def __init__(
+        self,
+        ker_dim,
+        out_dim,
+        sigma,
+        bias=True,
+        whiten=False,
+        kernel='gaussian'):
         """
         Building block for MLKN.
         A kernel linear layer first applies to input sample x a nonlinear map
@@ -21,9 +29,10 @@ class kerLinear(torch.nn.Module):
         where x_ \in x, k is a kernel function and X = {x_1, x_2, ..., x_n}.
         Then it linearly maps the image to some Euclidean space
         with dimension determined by the number of kernel machines in this
-        layer. Currently only supports Gaussian kernel:
-        k(x, y) = exp(-||x-y||_2^2 / (2 * sigma^2)). Currently only supports
-        1darrays or 2darrays as input.
+        layer. The kernel defaults to the Gaussian kernel
+        k(x, y) = exp(-||x-y||_2^2 / (2 * sigma^2)), others are picked from
+        the registry of the backend (see backend.get_kernel). Currently only
+        supports 1darrays or 2darrays as input.
 
         Parameters
         ----------
@@ -34,14 +43,30 @@ class kerLinear(torch.nn.Module):
             random sample X.
         bias (optional) : bool
             If True, add a bias term to the linear combination.
+        whiten (optional) : bool
+            If True, apply Nystrom whitening to the image of x, i.e., use
+            f(x_) K_XX^(-1/2) instead of f(x_), where K_XX is the Gram matrix
+            of X. Useful when X is a small set of landmarks rather than the
+            entire training set (see backend.get_landmarks). K_XX^(-1/2) is
+            treated as a constant by autograd.
+        kernel (optional) : str or backend.Kernel
+            Name of a registered kernel, e.g., 'laplacian', 'matern',
+            'polynomial', 'cosine' or 'ard', built with width sigma if it has
+            one (pass sigma=None otherwise), or a Kernel, e.g.,
+            K.MaternKernel(sigma=1, nu=2.5), in which case sigma must be
+            None.
 
         Attributes
         ----------
         """
         super(kerLinear, self).__init__()
 
-        self.sigma = sigma
+        self.kernel = K.get_kernel(kernel, sigma)
         self.ker_dim = ker_dim
+        self.whiten = whiten
+        self.storage = None # NOTE: see baseMLKN.set_precision
+        self._whitener_cache = None
+        self._index_cache = None
 
         self.kerMap = K.kerMap
         self.linear = torch.nn.Linear(ker_dim, out_dim, bias=bias)
@@ -51,6 +76,25 @@ class kerLinear(torch.nn.Module):
         self.weight = self.linear.weight
         self.bias = self.linear.bias
 
+    @property
+    def sigma(self):
+        """
+        Width of the kernel, None if it has none.
+        """
+        return getattr(self.kernel, 'sigma', None)
+
+    @sigma.setter
+    def sigma(self, sigma):
+        assert self.kernel.has_sigma, \
+        'kernel {} has no sigma'.format(self.kernel.name)
+        self.kernel.sigma = sigma
+
+    def __setstate__(self, state):
+        if 'kernel' not in state:
+            state['kernel'] = K.GaussianKernel(state.pop('sigma'))
+            # NOTE: layers pickled before the kernel registry
+        super(kerLinear, self).__setstate__(state)
+
     def forward(self, x, X):
         """
         Parameters
@@ -64,17 +108,138 @@ class kerLinear(torch.nn.Module):
         -------
         y : Tensor, shape (batch_size, out_dim)
         """
+        storage = getattr(self, 'storage', None)
+        if storage is not None and not self.whiten and \
+        isinstance(self.kernel, K.GaussianKernel) and any(
+            getattr(t, 'requires_grad', False) for t in (x, X, self.weight)
+            ):
+            x, X = self._inputs(x, X)
+            return K.kerLinearMap(
+                x, X, self.sigma,
+                self.linear.weight, self.linear.bias,
+                storage=storage
+                )
+            # NOTE: the image of x is kept for backward in the storage
+            # precision, see backend.kerLinearMap. Other kernels keep it in
+            # the compute precision
+
+        x_image = self.feature_map(x, X)
+        """
+        print('x_image', x_image)
+        """
+        y = self.linear(x_image)
+        return y
+
+    def _inputs(self, x, X):
+        """
+        Check x and X and return the arguments of the kernel map.
+        """
+        assert X is not None, 'kerLinear needs a reference set'
         if len(X.shape)==1: assert self.ker_dim==1 # does not modify the
         # dimension of X here as this will be done later in self.kerMap
         else: assert self.ker_dim==X.shape[0]
+        return x, X
 
-        x_image = self.kerMap(x, X, self.sigma)
+    def feature_map(self, x, X):
         """
-        print('x_image', x_image)
+        Image of x under f, i.e., the input of self.linear.
+
+        Parameters
+        ----------
+
+        x : Tensor, shape (batch_size, dim)
+
+        X : Tensor, shape (n_example, dim)
+
+        Returns
+        -------
+        x_image : Tensor, shape (batch_size, ker_dim)
         """
-        y = self.linear(x_image)
+        x, X = self._inputs(x, X)
+        x_image = self.kerMap(x, X, self.kernel)
+        if self.whiten: x_image = x_image.mm(self._get_whitener(X))
+        return x_image
+
+    def _get_whitener(self, X):
+        """
+        K_XX^(-1/2), cached as long as X and the kernel stay the same.
+        """
+        key = (getattr(X, '_version', None), self.kernel.key())
+        cached = self._whitener_cache
+        if cached is not None and cached[0] is X and cached[1]==key:
+            return cached[2]
+
+        X_ = X.detach()
+        whitener = K.inv_sqrt(self.kerMap(X_, X_, self.kernel).data)
+        whitener = Variable(whitener, requires_grad=False)
+        self._whitener_cache = (X, key, whitener)
+        return whitener
+
+    def sparse_forward(self, x, X, tol):
+        """
+        Approximate forward for inference: the kernel is only evaluated
+        between each row of x and the rows of X within the radius beyond which
+        the kernel is below tol (see backend.Kernel.radius), found with a
+        spatial index over X (see backend.build_index), and the resulting
+        sparse image is mapped by the weights. Each dropped kernel value is
+        below tol, so each output is within tol * ||w||_1 of forward's, where
+        w is the corresponding row of self.weight. The query cost grows with
+        the number of centers in range instead of with ker_dim, which pays off
+        for small sigma. Not differentiable and not supported with whiten.
+        Kernels without a radius, e.g., 'polynomial' or 'ard', fall back to
+        forward.
+
+        Parameters
+        ----------
+
+        x : Tensor, shape (batch_size, dim)
+
+        X : Tensor, shape (n_example, dim)
+
+        tol : scalar
+
+        Returns
+        -------
+        y : Tensor, shape (batch_size, out_dim)
+        """
+        assert not self.whiten, 'sparse_forward does not support whiten'
+        if self.kernel.radius(tol) is None: return self.forward(x, X)
+        y = self._sparse_linear(x, X, tol)
+        if self.bias is not None: y += self.bias.data.view(1, -1)
+        return Variable(y, requires_grad=False)
+
+    def _sparse_linear(self, x, X, tol):
+        """
+        Sparse image of x mapped by the weights (without the bias), see
+        sparse_forward. Returns a Tensor.
+        """
+        rows, cols, dist = K.radius_neighbors(
+            self._get_index(X), x, self.kernel.radius(tol)
+            )
+        x_ = x.data if isinstance(x, Variable) else x
+        weight = self.weight.data
+        y = weight.new(x_.shape[0], weight.shape[0]).zero_()
+        if rows.numel() > 0:
+            x_image = self.kernel.phi(dist)
+            y.index_add_(
+                0, rows,
+                weight.t().index_select(0, cols).mul_(x_image.view(-1, 1))
+                )
         return y
 
+    def _get_index(self, X):
+        """
+        Spatial index over X, cached as long as X stays the same.
+        """
+        version = getattr(X, '_version', None)
+        cached = getattr(self, '_index_cache', None)
+        if cached is not None and cached[0] is X and cached[1]==version:
+            return cached[2]
+
+        index = K.build_index(X)
+        self._index_cache = (X, version, index)
+        return index
+
 if __name__=='__main__':
 
     dtype = torch.FloatTensor
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+import math as m
+import torch
+
+import backend as K
+from layers.kerlinear import kerLinear
+
+class kerLinearEnsemble(torch.nn.Module):
+    needs_centers = True # NOTE: whether forward uses its X argument
+    def __init__(
+        self,
+        n_member,
+        ker_dim,
+        out_dim,
+        sigma,
+        bias=True,
+        weight_decay=0):
+        """
+        n_member kerLinear layers with the same shape stacked into batched
+        weights, so that all of them are evaluated (and trained) with a single
+        batched matrix product. Member k maps x[k] (or x, if x is shared)
+        using reference set X[k] (or X) and kernel width sigma[k]. Where the
+        inputs are shared, the kernel map is computed once for all members
+        (see backend.batchKerMap).
+
+        Parameters
+        ----------
+        n_member : int
+
+        ker_dim : int
+            See kerLinear.
+
+        out_dim : int
+            See kerLinear.
+
+        sigma : scalar or list of n_member scalars
+
+        bias (optional) : bool
+
+        weight_decay (optional) : scalar or list of n_member scalars
+            L2 penalty of each member, applied to its gradient (as done by the
+            weight_decay option of the optimizers) through decay_grad. Allows
+            members to differ in regularization while sharing an optimizer.
+        """
+        super(kerLinearEnsemble, self).__init__()
+
+        if not isinstance(sigma, (list, tuple)): sigma = [sigma] * n_member
+        if not isinstance(weight_decay, (list, tuple)):
+            weight_decay = [weight_decay] * n_member
+        assert len(sigma)==n_member and len(weight_decay)==n_member
+
+        self.n_member = n_member
+        self.ker_dim = ker_dim
+        self.out_dim = out_dim
+        self.sigma = list(sigma)
+        self.weight_decay = list(weight_decay)
+
+        self.weight = torch.nn.Parameter(
+            torch.FloatTensor(n_member, out_dim, ker_dim)
+            )
+        if bias:
+            self.bias = torch.nn.Parameter(torch.FloatTensor(n_member, out_dim))
+        else: self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        """
+        Same initialization as torch.nn.Linear, independently per member.
+        """
+        stdv = 1. / m.sqrt(self.ker_dim)
+        self.weight.data.uniform_(-stdv, stdv)
+        if self.bias is not None: self.bias.data.uniform_(-stdv, stdv)
+
+    def forward(self, x, X):
+        """
+        Parameters
+        ----------
+
+        x : Tensor, shape (batch_size, dim) or (n_member, batch_size, dim)
+
+        X : Tensor, shape (n_example, dim) or (n_member, n_example, dim)
+
+        Returns
+        -------
+        y : Tensor, shape (n_member, batch_size, out_dim)
+        """
+        x_image = self.feature_map(x, X)
+        if x_image.shape[0]==1:
+            # NOTE: shared image, one (batch_size, ker_dim) x
+            # (ker_dim, n_member * out_dim) product for all members
+            weight = self.weight.permute(2, 0, 1).contiguous()\
+            .view(self.ker_dim, -1)
+            y = x_image[0].mm(weight).view(-1, self.n_member, self.out_dim)\
+            .transpose(0, 1)
+        else: y = torch.bmm(x_image, self.weight.transpose(1, 2))
+
+        if self.bias is not None: y = y + self.bias.unsqueeze(1)
+        return y
+
+    def feature_map(self, x, X):
+        """
+        Image of x under the kernel maps of the members.
+
+        Returns
+        -------
+        x_image : Tensor, shape (n_member, batch_size, ker_dim) or
+            (1, batch_size, ker_dim) if shared by all members
+        """
+        assert X is not None, 'kerLinearEnsemble needs a reference set'
+        return K.batchKerMap(x, X, self.sigma)
+
+    def decay_grad(self):
+        """
+        Add the gradient of the L2 penalty of each member,
+        weight_decay[k] * param[k], to the gradients of the parameters.
+        """
+        if not any(self.weight_decay): return
+        decay = self.weight.data.new(self.weight_decay)
+        for param in self.parameters():
+            if param.grad is None: continue
+            shape = (-1,) + (1,) * (len(param.shape) - 1)
+            param.grad.data.add_(param.data * decay.view(*shape))
+
+    def get_member(self, k):
+        """
+        Copy of member k as a kerLinear.
+        """
+        layer = kerLinear(
+            self.ker_dim, self.out_dim, self.sigma[k],
+            bias=self.bias is not None
+            )
+        layer.weight.data.copy_(self.weight.data[k])
+        if self.bias is not None: layer.bias.data.copy_(self.bias.data[k])
+        return layer
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+import copy
+import math as m
+import torch
+from torch.autograd import Variable
+import torch.distributed as dist
+
+import backend as K
+from layers.kerlinear import kerLinear
+from utils.distributed import shard_range, all_reduce_sum, all_reduce_grad
+
+class kerLinearSharded(kerLinear):
+    def __init__(
+        self,
+        ker_dim,
+        out_dim,
+        sigma,
+        bias=True,
+        rank=None,
+        world_size=None,
+        kernel='gaussian'):
+        """
+        kerLinear whose reference set is split over the processes of the
+        default process group of torch.distributed (e.g., started with
+        utils.launch). Process rank owns a contiguous slice of the ker_dim
+        rows of the reference set (see utils.shard_range) and the matching
+        columns of the weights, computes the partial output
+        k(x, X_shard) W_shard^T and the partial outputs are summed over the
+        processes. The weights, the kernel map of a batch and the compute of
+        a step then scale as ker_dim / world_size per process.
+
+        All processes must run the same model on the same batches, e.g., the
+        same fit or evaluate calls with the same arguments (and seeds, if
+        shuffling): everything but the shards of this layer is replicated
+        and gets the same gradients everywhere, so the optimizers need no
+        further communication. Not to be combined with baseMLKN.distribute.
+        Whitening is not supported.
+
+        Parameters
+        ----------
+        ker_dim : int
+            Size of the entire reference set.
+
+        out_dim : int
+
+        sigma : scalar
+
+        bias (optional) : bool
+            The bias is replicated, it is broadcast from rank 0.
+
+        rank, world_size (optional) : int
+            Default to those of the default process group.
+
+        kernel (optional) : str or backend.Kernel
+            See kerLinear.
+        """
+        torch.nn.Module.__init__(self)
+        # NOTE: kerLinear.__init__ would allocate the full weights
+
+        if rank is None: rank = dist.get_rank()
+        if world_size is None: world_size = dist.get_world_size()
+        self.rank, self.world_size = rank, world_size
+        self.start, self.stop = shard_range(ker_dim, rank, world_size)
+
+        self.kernel = K.get_kernel(kernel, sigma)
+        self.ker_dim = ker_dim
+        self.whiten = False
+        self.storage = None
+        self._whitener_cache = None
+        self._index_cache = None
+
+        self.kerMap = K.kerMap
+        state = torch.get_rng_state()
+        self.linear = torch.nn.Linear(self.stop - self.start, out_dim,
+            bias=False)
+        torch.set_rng_state(state) # NOTE: see reset_parameters
+        self.weight = self.linear.weight
+        if bias:
+            self.bias = torch.nn.Parameter(torch.FloatTensor(out_dim))
+        else: self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        """
+        Same initialization as the full weights. The shards are drawn from a
+        generator seeded per rank, which leaves the global one in the same
+        state on every process, so that the replicated layers built after
+        this one agree.
+        """
+        stdv = 1. / m.sqrt(self.ker_dim)
+        seed = int(torch.rand(1)[0] * 2**24)
+        state = torch.get_rng_state()
+        torch.manual_seed(seed + self.rank)
+        self.weight.data.uniform_(-stdv, stdv)
+        torch.set_rng_state(state)
+        if self.bias is not None:
+            self.bias.data.uniform_(-stdv, stdv)
+            if self.world_size > 1: dist.broadcast(self.bias.data, 0)
+
+    @staticmethod
+    def from_layer(layer, rank=None, world_size=None):
+        """
+        Shard of the kerLinear layer (the same on every process), e.g., to
+        continue training a model on more centers than fit one process.
+
+        Returns
+        -------
+        sharded : kerLinearSharded
+        """
+        assert not layer.whiten, 'kerLinearSharded does not support whiten'
+        sharded = kerLinearSharded(
+            layer.ker_dim,
+            layer.weight.shape[0],
+            None,
+            bias=layer.bias is not None,
+            rank=rank,
+            world_size=world_size,
+            kernel=copy.deepcopy(layer.kernel)
+            )
+        sharded.weight.data.copy_(
+            layer.weight.data[:, sharded.start: sharded.stop]
+            )
+        if layer.bias is not None: sharded.bias.data.copy_(layer.bias.data)
+        return sharded
+
+    def _local(self, X):
+        """
+        Rows of the reference set X owned by this process. X is either the
+        entire reference set or already the shard.
+        """
+        if X.shape[0]==self.ker_dim:
+            if self.world_size > 1 and getattr(X, 'requires_grad', False):
+                X = all_reduce_grad(X)
+            # NOTE: the images of the reference set are replicated but each
+            # process only backpropagates through its rows
+            return X[self.start: self.stop]
+        assert X.shape[0]==self.stop - self.start and \
+        not getattr(X, 'requires_grad', False)
+        return X
+
+    def forward(self, x, X):
+        """
+        Parameters
+        ----------
+
+        x : Tensor, shape (batch_size, dim)
+
+        X : Tensor, shape (ker_dim, dim) or (stop - start, dim)
+            The entire reference set or the shard of this process.
+
+        Returns
+        -------
+        y : Tensor, shape (batch_size, out_dim)
+        """
+        y = kerLinear.forward(self, x, X) # NOTE: self.linear has no bias
+        if self.world_size > 1: y = all_reduce_sum(y)
+        if self.bias is not None: y = y + self.bias.view(1, -1)
+        return y
+
+    def _inputs(self, x, X):
+        """
+        x and the shard of X, see _local. The image of x under the kernel map
+        of the shard, i.e., feature_map, has shape (batch_size, stop - start).
+        """
+        assert X is not None, 'kerLinearSharded needs a reference set'
+        X = self._local(X)
+        if self.world_size > 1 and getattr(x, 'requires_grad', False):
+            x = all_reduce_grad(x)
+        return x, X
+
+    def sparse_forward(self, x, X, tol):
+        """
+        See kerLinear.sparse_forward, the partial outputs of the shards are
+        summed.
+        """
+        if self.kernel.radius(tol) is None: return self.forward(x, X)
+        y = self._sparse_linear(x, X, tol)
+        if self.world_size > 1: dist.all_reduce(y)
+        if self.bias is not None: y += self.bias.data.view(1, -1)
+        return Variable(y, requires_grad=False)
+
+    def _get_index(self, X):
+        """
+        Spatial index over the shard of X, cached as long as X stays the same.
+        """
+        version = getattr(X, '_version', None)
+        cached = self._index_cache
+        if cached is not None and cached[0] is X and cached[1]==version:
+            return cached[2]
+
+        index = K.build_index(self._local(X))
+        self._index_cache = (X, version, index)
+        return index
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+import math as m
+import torch
+from torch.autograd import Variable
+
+import backend as K
+from layers.kerlinear import kerLinear
+
+torch.manual_seed(1234)
+
+class rffLinear(kerLinear):
+    needs_centers = False
+
+    def __init__(self, in_dim, out_dim, sigma, n_feature, bias=True):
+        """
+        Drop-in replacement for kerLinear that approximates the Gaussian
+        kernel with random Fourier features, see backend.rffMap:
+
+            f : x -> R^n_feature
+            f : f(x_) -> z(x_), where z(x_).z(y_) ~= k(x_, y_).
+
+        Then it linearly maps the image to some Euclidean space
+        with dimension determined by the number of kernel machines in this
+        layer. Since f does not depend on the training set, this layer
+        never needs the reference set X and the cost per example is
+        O(n_feature * in_dim) instead of O(n_example * in_dim).
+
+        Parameters
+        ----------
+        in_dim : int
+            Dimension of the input.
+        out_dim : int
+            The number of kernel machines in this layer.
+        sigma : scalar
+            Width of the approximated Gaussian kernel.
+        n_feature : int
+            Number of random features, plays the role of ker_dim.
+        bias (optional) : bool
+            If True, add a bias term to the linear combination.
+
+        Attributes
+        ----------
+        omega : Tensor, shape (in_dim, n_feature)
+            Random frequencies (for sigma=1).
+        phase : Tensor, shape (n_feature,)
+            Random phases.
+        """
+        super(rffLinear, self).__init__(
+            ker_dim=n_feature,
+            out_dim=out_dim,
+            sigma=sigma,
+            bias=bias
+            )
+        self.in_dim = in_dim
+
+        self.register_buffer('omega', torch.randn(in_dim, n_feature))
+        self.register_buffer(
+            'phase',
+            torch.rand(n_feature).mul_(2 * m.pi)
+            )
+
+    def forward(self, x, X=None):
+        """
+        Parameters
+        ----------
+
+        x : Tensor, shape (batch_size, in_dim)
+
+        X (optional) : Tensor
+            Ignored, only here so that this layer can be used in place of
+            kerLinear.
+
+        Returns
+        -------
+        y : Tensor, shape (batch_size, out_dim)
+        """
+        x_image = self.feature_map(x, X)
+        y = self.linear(x_image)
+        return y
+
+    def feature_map(self, x, X=None):
+        """
+        Random Fourier features of x.
+
+        Parameters
+        ----------
+
+        x : Tensor, shape (batch_size, in_dim)
+
+        X (optional) : Tensor
+            Ignored.
+
+        Returns
+        -------
+        x_image : Tensor, shape (batch_size, n_feature)
+        """
+        return K.rffMap(
+            x,
+            Variable(self.omega, requires_grad=False),
+            Variable(self.phase, requires_grad=False),
+            self.sigma
+            )
+
+if __name__=='__main__':
+
+    x = Variable(torch.FloatTensor([[0, 7], [1, 2]]))
+    X = Variable(torch.FloatTensor([[1, 2], [3, 4], [5, 6]]))
+
+    l = rffLinear(in_dim=2, out_dim=1, sigma=5, n_feature=10000)
+    z = K.rffMap(x, Variable(l.omega), Variable(l.phase), l.sigma)
+    print('approx. gram', z.mm(z.t()))
+    print('gram', K.kerMap(x, x, l.sigma))
@@ -3,11 +3,25 @@
 
 from __future__ import print_function, division
 
+import contextlib
+import copy
+import io
+import struct
+import time
+import warnings
+
+import numpy as np
 import torch
 from torch.autograd import Variable
 
 import backend as K
 from layers.kerlinear import kerLinear
+from layers.rfflinear import rffLinear
+from layers.kerlinearensemble import kerLinearEnsemble
+from layers.kerlinearsharded import kerLinearSharded
+from utils.callbacks import LossLogger
+from utils.distributed import all_reduce_grads, all_reduce_sum, \
+    broadcast_tensors, shard_range
 
 # TODO: check GPU compatibility: move data and modules on GPU, see, for example,
 # https://github.com/pytorch/pytorch/issues/584
@@ -23,6 +37,20 @@ from layers.kerlinear import kerLinear
 
 torch.manual_seed(1234)
 
+_MAGIC = b'KERNET\x00\x01' # NOTE: file format of baseMLKN.save, version 1
+_ALIGN = 64 # NOTE: alignment of the centers in the file, in bytes
+
+def _load_pickle(f):
+    """
+    torch.load of a pickled object. Since torch 2.6, torch.load only
+    unpickles tensors unless weights_only=False, which older versions do not
+    accept.
+    """
+    try: return torch.load(f, weights_only=False)
+    except TypeError:
+        f.seek(0)
+        return torch.load(f)
+
 class baseMLKN(torch.nn.Module):
     """
     Model for fast implementations of MLKN. Do not use this base class, use
@@ -33,13 +61,23 @@ class baseMLKN(torch.nn.Module):
     as a set of bases to expand your kernel machine on. And this is why in a lot
     of methods of this class you see the parameter X. It is true that it
     can be highly memory-inefficient to carry this big chunk of data around,
-    we may add more functionalities to the class in the future to tackle with
-    this issue.
+    so one can instead fix a small set of landmarks (centers) drawn from X
+    with add_centers. The centers are then used as the reference set at every
+    layer and X is only needed for fitting.
     """
-    # TODO: see above documentation
     def __init__(self):
         super(baseMLKN, self).__init__()
         self._layer_counter = 0
+        self.centers = None
+        self._step_counter = 0
+        self._center_cache = {}
+        self._inference_plan = None
+        self.callbacks = [LossLogger()] # NOTE: see utils.callbacks
+        self._timing = False
+        self.sparse_tol = None
+        self._rank, self._world_size = 0, 1 # NOTE: see distribute
+        self.precision, self.storage = None, None # NOTE: see set_precision
+        self._cast_cache = {}
 
     def add_layer(self, layer):
         """
@@ -72,7 +110,262 @@ class baseMLKN(torch.nn.Module):
         """
         setattr(self, 'output_loss_fn', loss_fn)
 
-    def _forward(self, x, X, upto=None):
+    def add_callback(self, callback):
+        """
+        Add a callback to the training loops, e.g., a utils.Profiler. By
+        default, the model has a utils.LossLogger printing the loss of every
+        batch; replace or empty self.callbacks to change that.
+
+        Parameters
+        ----------
+        callback : utils.Callback
+        """
+        self.callbacks.append(callback)
+
+    def _emit(self, event, **info):
+        """
+        Send an event to the callbacks.
+        """
+        for callback in getattr(self, 'callbacks', []):
+            getattr(callback, event)(self, **info)
+
+    @contextlib.contextmanager
+    def _timer(self, name):
+        """
+        Time the enclosed block and send it to the callbacks as an
+        on_timing event, if any of them needs timings.
+        """
+        if not getattr(self, '_timing', False):
+            yield
+            return
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+        start = time.time()
+        yield
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+        self._emit('on_timing', name=name, seconds=time.time()-start)
+
+    def _begin_fit(self):
+        """
+        Set up the instrumentation of a fit, see _end_fit.
+        """
+        self._timing = any(getattr(callback, 'needs_timing', False)
+            for callback in getattr(self, 'callbacks', []))
+        if self._timing:
+            for i in range(self._layer_counter):
+                layer = getattr(self, 'layer'+str(i))
+                if 'kerMap' not in layer.__dict__: continue
+                layer.kerMap = self._timed(layer.kerMap, 'gram/layer'+str(i))
+                # NOTE: kerLinear calls its kernel map through this
+                # attribute, so Gram time is measured without touching it
+        self._emit('on_fit_begin')
+
+    def _end_fit(self):
+        self._emit('on_fit_end')
+        for i in range(self._layer_counter):
+            layer = getattr(self, 'layer'+str(i))
+            kerMap = layer.__dict__.get('kerMap')
+            if hasattr(kerMap, '__wrapped__'): layer.kerMap = kerMap.__wrapped__
+        self._timing = False
+
+    def _timed(self, fn, name):
+        """
+        fn with its calls timed, see _timer.
+        """
+        def timed(*args, **kwargs):
+            with self._timer(name): return fn(*args, **kwargs)
+        timed.__wrapped__ = fn
+        return timed
+
+    def add_centers(self, X, n_center=None, method='uniform', sigma=None):
+        """
+        Fix the reference set of the model to a set of landmarks chosen from
+        X. Once added, the centers are used in place of the X passed to the
+        other methods and every kerLinear must have ker_dim=n_center. The
+        cost of the network then scales linearly instead of quadratically
+        with the size of the training set.
+
+        Parameters
+        ----------
+        X : Tensor, shape (n_example, dim)
+            Training set.
+
+        n_center (optional) : int
+            Number of landmarks. If not passed, X itself is used as the set of
+            centers.
+
+        method (optional) : str
+            How the landmarks are chosen, see backend.get_landmarks.
+
+        sigma (optional) : scalar
+            Kernel width used by method 'leverage'. Defaults to that of the
+            first layer.
+        """
+        if n_center is not None:
+            if sigma is None: sigma = self.layer0.sigma
+            X = X[K.get_landmarks(X, n_center, method=method, sigma=sigma)]
+        self.centers = X
+        self._clear_cache()
+
+    def _reference_set(self, X):
+        """
+        Set to expand the kernel machines on: the centers if they have been
+        added, X otherwise. May be None if no layer needs a reference set,
+        e.g., when all layers are rffLinear.
+        """
+        if self.centers is not None: return self._cast(self.centers)
+        assert not K.is_stream(X), \
+        'add centers to the model to train it on a Dataset or DataLoader'
+        return self._cast(X)
+
+    def _to_precision(self, x):
+        """
+        x converted to the compute precision of the model, see set_precision.
+        """
+        precision = getattr(self, 'precision', None)
+        if precision is None or x is None: return x
+        dtype = K.tensor_type(precision, x.is_cuda)
+        data = x.data if isinstance(x, Variable) else x
+        return x if data.type()==dtype else x.type(dtype)
+
+    def _cast(self, X):
+        """
+        _to_precision for the sets the model keeps referring to (training
+        set, centers): the converted set is kept as long as X is not
+        modified, so that the caches keyed by the identity of the reference
+        set keep working.
+        """
+        if K.is_stream(X): return X
+        Y = self._to_precision(X)
+        if Y is X: return X
+        cache = getattr(self, '_cast_cache', None)
+        if cache is None: cache = self._cast_cache = {}
+        version = getattr(X, '_version', None)
+        cached = cache.get(id(X))
+        if cached is not None and cached[0] is X and cached[1]==version:
+            return cached[2]
+        cache[id(X)] = (X, version, Y)
+        return Y
+
+    def _get_inputs(self, X, i):
+        """
+        Image of X at the input of layer i. Layers 0, ..., i-1 must be frozen.
+        """
+        X = self._cast(X)
+        C = self._reference_set(X)
+        if C is X or X is None: return self._get_centers(C, i)
+        if i==0: return X
+        return self._chunked(
+            lambda x: self._forward(x, C, upto=i-1), X, C, 'forward'
+            )
+
+    def _row_bytes(self, n_ref):
+        """
+        Memory (in bytes) of the Gram-shaped intermediates of the forward
+        pass of one example against a reference set of n_ref examples: the
+        kernel map and the temporaries of its computation, at the widest
+        layer, in the compute precision (see set_precision).
+        """
+        precision = getattr(self, 'precision', None)
+        itemsize = K.itemsize(precision or 'float')
+        row_bytes = 0
+        for i in range(self._layer_counter):
+            layer = getattr(self, 'layer'+str(i))
+            if not getattr(layer, 'needs_centers', True): continue
+            row_bytes = max(
+                row_bytes,
+                3 * n_ref * itemsize * getattr(layer, 'n_member', 1)
+                )
+        return row_bytes
+
+    def _chunked(self, fn, x, C, name):
+        """
+        fn(x) computed on chunks of the examples of x sized to fit in the
+        memory budget (see backend.set_memory_budget), for a forward pass
+        against the reference set C. Examples are along the second to last
+        dimension of x.
+        """
+        dim = len(x.shape) - 2
+        n = x.shape[dim]
+        rows = K.chunk_size(n, self._row_bytes(C.shape[len(C.shape)-2]),
+            name=name) if C is not None else n
+        if rows >= n: return fn(x)
+        y = [fn(x.narrow(dim, j, min(rows, n-j))) for j in range(0, n, rows)]
+        return torch.cat(y, dim=len(y[0].shape)-2)
+
+    def _check_batch_size(self, X, batch_size):
+        """
+        Warn if a training batch does not fit in the memory budget. The
+        batch size is left as is since it is part of the optimization.
+        """
+        if K.get_memory_budget() is None or K.is_stream(X): return
+        C = self._reference_set(X)
+        if C is None: return
+        n = min(batch_size or X.shape[0], X.shape[0])
+        limit = K.chunk_size(n, self._row_bytes(C.shape[0]))
+        if limit < n:
+            warnings.warn('batches of {} examples exceed the memory budget '
+                'of {:.1f}MB with {} centers, consider batch_size={}'.format(
+                n, K.get_memory_budget() / 2**20, C.shape[0], limit
+                ))
+
+    def _get_batches(
+        self,
+        X, Y=None,
+        batch_size=None,
+        shuffle=False,
+        num_workers=0,
+        pin_memory=False):
+        """
+        Batches of (X, Y), or of X alone if Y is None, and their number. X may
+        also be a Dataset or a DataLoader (then Y is ignored), see
+        backend.get_loader.
+        """
+        if K.is_stream(X):
+            loader = K.get_loader(
+                X,
+                batch_size=batch_size,
+                shuffle=shuffle,
+                num_workers=num_workers,
+                pin_memory=pin_memory
+                )
+            batches = K.get_stream_batch(loader)
+            if getattr(self, 'precision', None) is not None:
+                batches = (
+                    (self._to_precision(batch[0]),) + tuple(batch[1:])
+                    for batch in batches
+                    )
+            return batches, len(loader)
+
+        X = self._to_precision(X)
+        if not batch_size or batch_size>X.shape[0]: batch_size = X.shape[0]
+        n_batch = -(-X.shape[0] // batch_size)
+        sets = (X,) if Y is None else (X, Y)
+        return K.get_batch(*sets, batch_size=batch_size, shuffle=shuffle), \
+        n_batch
+
+    def _prepare_target(self, Y):
+        """
+        Cast the target data to what the loss function expects.
+        """
+        if len(Y.shape)==2: Y=Y.view(-1,)
+        # NOTE: CrossEntropyLoss (and probably also MSELoss) requires label
+        # tensor to be of shape (n)
+
+        # TODO: what about multi-D MSELoss or CrossEntropyLoss?
+
+        if isinstance(self.output_loss_fn, torch.nn.CrossEntropyLoss):
+            Y=Y.type(torch.cuda.LongTensor)\
+            if Y.is_cuda else Y.type(torch.LongTensor)
+            # NOTE: required by CrossEntropyLoss
+
+        elif isinstance(self.output_loss_fn, torch.nn.MSELoss):
+            Y=Y.type(K.tensor_type(
+                getattr(self, 'precision', None) or 'float', Y.is_cuda
+                ))
+            # NOTE: required by MSELoss, in the precision of the outputs
+        return Y
+
+    def _forward(self, x, X, upto=None, sparse_tol=None):
         """
         Feedforward upto layer 'upto'. If 'upto' is not passed,
         this works as the standard forward function in PyTorch.
@@ -90,6 +383,10 @@ class baseMLKN(torch.nn.Module):
             Index for the layer upto (and including) which we will evaluate
             the model. 0-indexed.
 
+        sparse_tol (optional) : scalar
+            If given, use the sparse_forward of the layers that have one, see
+            set_sparse_inference.
+
         Returns
         -------
         y : Tensor, shape (batch_size, out_dim)
@@ -101,16 +398,241 @@ class baseMLKN(torch.nn.Module):
             counter = upto + 1
         else: counter = self._layer_counter
 
-        y_previous, Y_previous = x, X
-        # TODO: because we always need to compute F_i(X) at each layer i, this
-        # is a huge overhead
+        C = self._reference_set(X)
+        y_previous = x
         # feedforward
         for i in range(counter):
             layer = getattr(self, 'layer'+str(i))
-            y, Y = layer(y_previous, Y_previous), layer(Y_previous, Y_previous)
-            y_previous, Y_previous = y, Y
+            C_i = self._get_centers(C, i) \
+            if getattr(layer, 'needs_centers', True) else None
+            with self._timer('forward/layer'+str(i)):
+                if sparse_tol is not None and C_i is not None and \
+                hasattr(layer, 'sparse_forward') and \
+                not getattr(layer, 'whiten', False):
+                    y_previous = layer.sparse_forward(
+                        y_previous, C_i, sparse_tol
+                        )
+                else: y_previous = layer(y_previous, C_i)
+
+        return y_previous
+
+    def _param_version(self, upto):
+        """
+        Version of the parameters of layers 0, ..., upto-1. It changes whenever
+        an optimizer takes a step through _step, any of these parameters is
+        modified in-place or gets (un)frozen.
+        """
+        version = [self._step_counter]
+        for i in range(upto):
+            for param in getattr(self, 'layer'+str(i)).parameters():
+                version.append((getattr(param, '_version', None),
+                    param.requires_grad))
+        return tuple(version)
+
+    def _get_centers(self, X, i):
+        """
+        Get the image of X at the input of layer i, i.e., the output of layer
+        i-1 when X is fed into the network and X itself is used as the
+        reference set at every layer. The result is cached per layer and reused
+        as long as X and the parameters of layers 0, ..., i-1 stay the same,
+        which means it is computed once for frozen layers and once per
+        optimizer step for trainable ones.
+
+        If the layers below i are trainable, the cached Tensor keeps its graph
+        and backward passes through it must be done with retain_graph=True
+        when it is reused across batches.
+
+        Parameters
+        ----------
+
+        X : Tensor, shape (n_example, dim)
+            Reference set, i.e., the training set or the centers.
+
+        i : int
+            Index of the layer. 0-indexed.
+
+        Returns
+        -------
+        Y : Tensor, shape (n_example, layer_dim)
+        """
+        if i==0: return X
+        version = self._param_version(i)
+        plan = getattr(self, '_inference_plan', None)
+        if plan is not None and plan[0] is X and plan[1][i]==version:
+            return plan[2][i]
+        cached = self._center_cache.get(i)
+        if cached is not None and cached[0] is X and cached[1]==version:
+            return cached[2]
+
+        Y_previous = self._get_centers(X, i-1)
+        layer = getattr(self, 'layer'+str(i-1))
+        with self._timer('centers/layer'+str(i-1)):
+            Y = layer(Y_previous, Y_previous)
+        self._center_cache[i] = (X, version, Y)
+        return Y
+
+    def _clear_cache(self):
+        """
+        Drop all cached images of the training set, including the inference
+        plan.
+        """
+        self._center_cache = {}
+        self._inference_plan = None
+        self._cast_cache = {}
+
+    def prepare_inference(self, X=None):
+        """
+        Compute the image of the reference set at the input of every layer
+        once and keep it, detached from any graph, for get_repr, evaluate and
+        predict, which then only compute the kernels between each test batch
+        and these images. Called at the end of fit. The plan is used as long
+        as the layers below each image are frozen and unchanged and is
+        dropped by fit and add_centers.
+
+        Parameters
+        ----------
+        X (optional) : Tensor, shape (n_example, dim)
+            Training set. Not needed if centers have been added to the model.
+        """
+        C = self._reference_set(X)
+        if C is None: return
+        for i in range(self._layer_counter):
+            for param in getattr(self, 'layer'+str(i)).parameters():
+                assert not param.requires_grad, \
+                'the layers must be frozen to prepare inference'
+
+        Y = K.volatile(C)
+        images, versions = [C], [None]
+        with K.no_grad():
+            for i in range(1, self._layer_counter):
+                layer = getattr(self, 'layer'+str(i-1))
+                Y = self._chunked(
+                    lambda y, Y=Y: layer(y, Y), Y, Y, 'prepare_inference'
+                    )
+                images.append(Variable(Y.data, requires_grad=False))
+                versions.append(self._param_version(i))
+        self._center_cache = {}
+        self._inference_plan = (C, versions, images)
+
+    def distribute(self, seed=None):
+        """
+        Train data-parallel over the processes of the default process group
+        of torch.distributed (e.g., started with utils.launch): call this in
+        every process after building the model (and adding its optimizers and
+        centers), then call fit with the same arguments everywhere. Each
+        process computes the loss of its share of every batch against the
+        shared reference set and the gradients are summed over the processes
+        before each step, so training follows the same trajectory as in a
+        single process, for both settings of accumulate_grad. The hidden
+        layers of MLKNGreedy, whose alignment loss does not split over the
+        examples of a batch, gather the outputs of the shares before computing
+        it instead; see _forward_shared.
+
+        The parameters and centers are broadcast from rank 0, as is a seed
+        for torch so that all processes shuffle the data alike.
+
+        Parameters
+        ----------
+        seed (optional) : int
+            Defaults to a random seed drawn on rank 0.
+        """
+        import torch.distributed as dist
+        assert not any(
+            isinstance(module, kerLinearSharded) for module in self.modules()
+            ), 'distribute does not support kerLinearSharded layers'
+        self._rank, self._world_size = dist.get_rank(), dist.get_world_size()
+
+        if seed is None: seed = int(torch.rand(1)[0] * 2**24)
+        seed = torch.FloatTensor([seed % 2**24]) # NOTE: exact in float32
+        broadcast_tensors([seed])
+        torch.manual_seed(int(seed[0]))
+
+        tensors = [param.data for param in self.parameters()]
+        if self.centers is not None:
+            tensors.append(self.centers.data \
+            if isinstance(self.centers, Variable) else self.centers)
+        broadcast_tensors(tensors)
+        self._clear_cache()
+
+    def _shard(self, x, y):
+        """
+        Share of the batch (x, y) this process computes the loss of, see
+        distribute, and the fraction of the batch it holds. x and y are None
+        if the share is empty.
+        """
+        world_size = getattr(self, '_world_size', 1)
+        if world_size==1: return x, y, 1.
+        n = x.shape[0]
+        start = n * self._rank // world_size
+        stop = n * (self._rank+1) // world_size
+        if start==stop: return None, None, 0.
+        return x[start: stop], y[start: stop], (stop - start) / n
+
+    def _forward_shared(self, layer, x, C_in):
+        """
+        layer(x, C_in) for the whole batch x, of which each process computes
+        its share (see _shard) in data-parallel training. The output is
+        summed over the processes, each contributing its rows, so the
+        gradient of a loss of the whole output flows back to the share of
+        each process and summing the gradients of the parameters over the
+        processes gives that of a single process.
+        """
+        world_size = getattr(self, '_world_size', 1)
+        if world_size==1: return layer(x, C_in)
+        n = x.shape[0]
+        start, stop = shard_range(n, self._rank, world_size)
+        if start==stop:
+            output = layer(x[:1], C_in).mul(0)
+            output = output.expand(n, output.shape[1])
+            # NOTE: zero contribution, kept in the graph so that backward
+            # runs alike on every process
+        else:
+            output = layer(x[start: stop], C_in)
+            pieces = [output]
+            if start>0:
+                pieces.insert(0, Variable(
+                    output.data.new(start, output.shape[1]).zero_()
+                    ))
+            if stop<n:
+                pieces.append(Variable(
+                    output.data.new(n-stop, output.shape[1]).zero_()
+                    ))
+            output = torch.cat(pieces)
+        with self._timer('all_reduce'):
+            return all_reduce_sum(output)
+
+    def _scale_loss(self, loss, loss_fn, frac):
+        """
+        Weight the mean loss of a share of a batch so that the losses of the
+        shares sum to that of the batch.
+        """
+        if frac!=1. and getattr(loss_fn, 'size_average', True):
+            loss = loss * frac
+        return loss
 
-        return y
+    def _reduce_grads(self, optimizer, average=False):
+        """
+        Sum (or average) the gradients of the parameters of optimizer over the
+        processes, see distribute.
+        """
+        if getattr(self, '_world_size', 1) > 1:
+            with self._timer('all_reduce'):
+                all_reduce_grads([
+                    param for group in optimizer.param_groups
+                    for param in group['params']
+                    ], average=average)
+
+    def _step(self, optimizer, average=False):
+        """
+        Let optimizer take a step and invalidate the cached images of the
+        training set. In data-parallel training, the gradients are first
+        reduced over the processes.
+        """
+        self._reduce_grads(optimizer, average=average)
+        with self._timer('step'):
+            optimizer.step()
+            optimizer.zero_grad()
+        self._step_counter += 1
 
     def _forward_volatile(self, x, X, upto=None):
         """
@@ -137,9 +659,72 @@ class baseMLKN(torch.nn.Module):
             Batch output.
         """
         x.volatile = True
-        return self._forward(x, X, upto)
+        return self._forward(
+            x, X, upto,
+            sparse_tol=getattr(self, 'sparse_tol', None)
+            )
+
+    def set_sparse_inference(self, tol=1e-6):
+        """
+        Let get_repr, evaluate and predict evaluate the kernels of the
+        kerLinear layers only between each example and the centers within a
+        few sigma of it, found with a spatial index over the centers (see
+        kerLinear.sparse_forward). Each kernel value below tol is dropped.
+        Worth it when sigma is small compared to the spread of the centers,
+        e.g., on the hidden layers with sigma=.1 of the examples. Whitened
+        layers are still evaluated in full. Training is not affected.
 
-    def get_repr(self, X_test, X, layer=None, batch_size=None):
+        Parameters
+        ----------
+        tol (optional) : scalar
+            None turns the sparse mode off.
+        """
+        self.sparse_tol = tol
+
+    def set_precision(self, compute='float', storage=None):
+        """
+        Precision policy of the model. The parameters and centers are
+        converted to the compute precision, and so is every set given to the
+        model (the training set once per fit, see _cast), so that all kernel
+        computations run in it: 'double' for the ill-conditioned Gram
+        matrices of small kernel widths, 'float' for speed. If storage is
+        given, the kerLinear layers keep the kernel maps of the training
+        batches for backward in this (lower) precision, e.g., 'half' or
+        'bfloat16', while computing them in the compute precision, see
+        backend.kerLinearMap; inference is not affected. Call after adding
+        the layers and before adding the optimizers, whose state is not
+        converted.
+
+        Parameters
+        ----------
+        compute (optional) : str
+            'float' or 'double'.
+
+        storage (optional) : str
+            'half', 'bfloat16', 'float' or 'double', see backend.tensor_type.
+            None keeps the kernel maps in the compute precision.
+        """
+        assert compute in ('float', 'double'), \
+        'the compute precision must be float or double'
+        if storage is not None: K.tensor_type(storage) # NOTE: validates it
+
+        cuda = any(param.is_cuda for param in self.parameters())
+        self.type(K.tensor_type(compute, cuda))
+        self.precision, self.storage = compute, storage
+        if self.centers is not None:
+            self.centers = self._to_precision(self.centers)
+        for i in range(self._layer_counter):
+            layer = getattr(self, 'layer'+str(i))
+            if hasattr(layer, 'storage'): layer.storage = storage
+        self._clear_cache()
+
+    def get_repr(
+        self,
+        X_test, X=None,
+        layer=None,
+        batch_size=None,
+        num_workers=0,
+        pin_memory=False):
         """
         Feed random sample x into the network and get its representation at the
         output of a given layer. This is useful mainly for two reasons. First,
@@ -151,11 +736,13 @@ class baseMLKN(torch.nn.Module):
 
         Parameters
         ----------
-        X_test : Tensor, shape (n1_example, dim)
-            Random sample whose representation is of interest.
+        X_test : Tensor, shape (n1_example, dim), Dataset or DataLoader
+            Random sample whose representation is of interest. A DataLoader
+            must not shuffle.
 
-        X : Tensor, shape (n_example, dim)
-            Training set used for fitting the network.
+        X (optional) : Tensor, shape (n_example, dim)
+            Training set used for fitting the network. Not needed if centers
+            have been added to the model.
 
         layer (optional) : int
             Output of this layer is the hidden representation. Layers are
@@ -163,44 +750,66 @@ class baseMLKN(torch.nn.Module):
             If this parameter is not passed, evaluate the output of the entire
             network.
 
+        batch_size (optional) : int
+            If not specified, use full mode, or, if a memory budget is set
+            (see backend.set_memory_budget), the largest batches that fit in
+            it.
+
+        num_workers, pin_memory (optional)
+            If X_test is a Dataset, see backend.get_loader.
+
         Returns
         -------
         Y_test : Tensor, shape (n1_example, layer_dim)
             Hidden representation of X_test at the given layer.
         """
         # TODO: test
-        if not batch_size or batch_size>X_test.shape[0]: batch_size=X_test.shape[0]
         if layer is None: layer=self._layer_counter-1
         else: assert 0<=layer<=self._layer_counter-1
 
-        layer = getattr(self, 'layer'+str(layer))
-        out_dim = layer.weight.shape[0] # TODO: strangely, nn.Linear stores
-        # weights as [out_dim, in_dim]...or am I making a mistake somewhere
-
-        Y_test = torch.cuda.FloatTensor(X_test.shape[0], out_dim) if \
-        X_test.is_cuda else torch.FloatTensor(X_test.shape[0], out_dim)
-
+        if K.is_stream(X_test):
+            n_example = len(X_test.dataset) if \
+            isinstance(X_test, torch.utils.data.DataLoader) else len(X_test)
+        else: n_example = X_test.shape[0]
+        C = self._reference_set(X) if self.centers is not None or \
+        X is not None else None
+        if batch_size is None and C is not None and \
+        K.get_memory_budget() is not None:
+            batch_size = K.chunk_size(
+                n_example, self._row_bytes(C.shape[0]), name='get_repr'
+                )
+
+        Y_test = None
+
+        batches, _ = self._get_batches(
+            X_test,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=pin_memory
+            )
         i = 0
-        for x_test in K.get_batch(X_test, batch_size=batch_size):
+        for x_test in batches:
             x_test = x_test[0].clone() # NOTE: clone turns x_test into a leaf
             # Variable, which is required to set the volatile flag
 
-            # NOTE: when only one set is sent to get_batch,
-            # we need to use x_test[0] because no automatic unpacking has
-            # been done by Python
+            # NOTE: batches are always tuples, even with a single set
             y_test = self._forward_volatile(x_test, X, upto=layer)
 
-            if x_test.shape[0]<batch_size: # last batch
-                Y_test[i*batch_size:] = y_test.data[:]
-                break
-            Y_test[i*batch_size: (i+1)*batch_size] = y_test.data[:]
-            i += 1
+            dim = len(y_test.shape) - 2 # NOTE: examples are along the
+            # second to last dimension, e.g., (n_member, batch_size, out_dim)
+            # for an ensemble
+            if Y_test is None:
+                shape = list(y_test.shape)
+                shape[dim] = n_example
+                Y_test = y_test.data.new(*shape)
+            Y_test.narrow(dim, i, y_test.shape[dim]).copy_(y_test.data)
+            i += y_test.shape[dim]
 
         return Variable(Y_test, requires_grad=False)
         # NOTE: this is to make the type of Y_pred consistent with X_test since
         # X_test must be a Variable
 
-    def evaluate(self, X_test, X, batch_size=None):
+    def evaluate(self, X_test, X=None, batch_size=None):
         """
         Feed X_test into the network and get raw output.
 
@@ -210,8 +819,8 @@ class baseMLKN(torch.nn.Module):
         X_test : Tensor, shape (n1_example, dim)
             Set to be evaluated.
 
-        X : Tensor, shape (n_example, dim)
-            Training set.
+        X (optional) : Tensor, shape (n_example, dim)
+            Training set. Not needed if centers have been added to the model.
 
         Returns
         -------
@@ -221,12 +830,306 @@ class baseMLKN(torch.nn.Module):
         # TODO: test
         return self.get_repr(X_test, X, batch_size=batch_size)
 
+    def sweep_sigma(
+        self,
+        X, Y,
+        sigmas,
+        layer=0,
+        set_best=False,
+        batch_size=None,
+        mem_budget=None):
+        """
+        Score candidate kernel widths for a layer by the alignment between its
+        kernel on the image of X at its input and the ideal kernel of Y, see
+        backend.sigma_sweep. Layers before the given one must be trained.
+
+        Parameters
+        ----------
+        X : Tensor, shape (n_example, dim)
+            Training set, or a subset of it.
+
+        Y : Tensor, shape (n_example, 1)
+            Categorical labels.
+
+        sigmas : list of float
+
+        layer (optional) : int
+
+        set_best (optional) : bool
+            If True, set the sigma of the layer to the best scoring one. The
+            layer must use the Gaussian kernel.
+
+        batch_size (optional) : int
+            Batch size used to compute the image of X, see get_repr.
+
+        mem_budget (optional) : int
+            See backend.sigma_sweep.
+
+        Returns
+        -------
+        alignments : Tensor, shape (len(sigmas),)
+        """
+        assert 0<=layer<=self._layer_counter-1
+        if set_best:
+            assert isinstance(
+                getattr(getattr(self, 'layer'+str(layer)), 'kernel',
+                K.GaussianKernel()), K.GaussianKernel
+                ), 'sweep_sigma scores widths of the Gaussian kernel'
+        x = self._to_precision(X) if layer==0 else self.get_repr(
+            X, self._reference_set(X), layer=layer-1, batch_size=batch_size
+            )
+        alignments = K.sigma_sweep(x, Y, sigmas, mem_budget=mem_budget)
+        if set_best:
+            best = max(range(len(sigmas)), key=lambda k: alignments[k])
+            getattr(self, 'layer'+str(layer)).sigma = sigmas[best]
+            self._clear_cache()
+        return alignments
+
+    def _solve_output(self, X, Y, solver='cholesky', reg=1e-3, n_precond=100):
+        """
+        Fit the last layer in closed form as a (Nystrom) kernel ridge
+        regression on the image of X at its input, see backend.ridge_solve,
+        and write the solution into its weight and bias. All other layers must
+        be frozen. If the loss function is CrossEntropyLoss, the targets are
+        the one-hot codes of Y, otherwise Y itself.
+
+        Parameters
+        ----------
+        X : Tensor, shape (n_example, dim)
+            Training set.
+
+        Y : Tensor, shape (n_example, 1) or (n_example,)
+            Target data.
+
+        solver (optional) : str
+            'cholesky' or 'cg', see backend.ridge_solve.
+
+        reg (optional) : scalar
+            Ridge parameter.
+
+        n_precond (optional) : int
+            Rank of the preconditioner of the 'cg' solver.
+        """
+        assert not K.is_stream(X), 'closed-form fitting requires a Tensor'
+        assert X.shape[0]==Y.shape[0]
+        i = self._layer_counter-1
+        layer = getattr(self, 'layer'+str(i))
+        assert isinstance(layer, kerLinear) and \
+        not isinstance(layer, kerLinearSharded)
+
+        X_in = self._get_inputs(X, i)
+        C_in = self._get_centers(self._reference_set(X), i) \
+        if layer.needs_centers else None
+        phi = layer.feature_map(X_in, C_in).data
+
+        if isinstance(getattr(self, 'output_loss_fn', None),
+            torch.nn.CrossEntropyLoss):
+            target = K.one_hot(Y.view(-1, 1), layer.weight.shape[0])
+        else: target = Y.view(Y.shape[0], -1)
+        if isinstance(target, Variable): target = target.data
+        target = target.type_as(phi)
+
+        gram = None
+        if layer.needs_centers and not layer.whiten:
+            gram = layer.kerMap(C_in, C_in, layer.kernel).data
+            # NOTE: RKHS norm of the kernel machines, for the whitened and
+            # random feature maps this is just the Euclidean norm of the
+            # weights
+
+        if layer.bias is not None: # NOTE: the bias is not regularized
+            phi_mean = phi.mean(0).view(1, -1)
+            target_mean = target.mean(0).view(1, -1)
+            phi, target = phi - phi_mean, target - target_mean
+
+        w = K.ridge_solve(
+            phi, target, reg,
+            gram=gram,
+            solver=solver,
+            n_precond=n_precond
+            )
+
+        layer.linear.weight.data.copy_(w.t())
+        if layer.bias is not None:
+            layer.linear.bias.data.copy_(
+                (target_mean - phi_mean.mm(w)).view(-1)
+                )
+        self._step_counter += 1 # NOTE: invalidates the cache
+
     def fit(self):
         raise NotImplementedError('must be implemented by subclass')
 
-    def save(self):
-        pass
-        # TODO: wrap native PyTorch support for save
+    def save(self, path, X=None, half=False, dedup=False):
+        """
+        Save the model (architecture, weights, kernel widths, loss function
+        and optimizers) together with its reference set into a single file,
+        so that the loaded model needs no X for inference. The file is made of
+        a magic string, a small header holding the pickled model without the
+        reference set and the reference set itself as a raw C-contiguous
+        array, aligned so that load can memory-map it.
+
+        Parameters
+        ----------
+        path : str
+
+        X (optional) : Tensor, shape (n_example, dim)
+            Training set. Not needed if centers have been added to the model,
+            otherwise it is saved as the centers of the model.
+
+        half (optional) : bool
+            Store the reference set as float16, which halves the file. The
+            loaded reference set is then a float32 copy instead of a
+            memory-mapped array.
+
+        dedup (optional) : bool
+            Store repeated rows of the reference set once and merge the
+            corresponding columns of the weights, which leaves the outputs of
+            the model unchanged. Not supported for whitened layers. The
+            optimizers of the loaded model must then be added again before
+            training it further.
+        """
+        needs_centers = any(
+            getattr(getattr(self, 'layer'+str(i)), 'needs_centers', True)
+            for i in range(self._layer_counter)
+            )
+        C = self._reference_set(X) if needs_centers else None
+
+        state = self._pop_data()
+        # NOTE: the pickled model must not hold references to the training
+        # set, which may be huge, through its caches
+        try:
+            model = copy.deepcopy(self) if dedup else self
+            centers = None
+            if C is not None:
+                centers = C.data if isinstance(C, Variable) else C
+                centers = centers.cpu().numpy()
+                if dedup: centers = model._dedup_centers(centers)
+                if half: centers = centers.astype(np.float16)
+                centers = np.ascontiguousarray(centers)
+
+            buf = io.BytesIO()
+            torch.save({
+                'model': model,
+                'centers_dtype': None if C is None else centers.dtype.str,
+                'centers_shape': None if C is None else centers.shape,
+                'centers_is_variable': isinstance(C, Variable)
+                }, buf)
+            header = buf.getvalue()
+        finally: self._push_data(state)
+
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            if centers is not None:
+                f.write(b'\x00' * (-f.tell() % _ALIGN))
+                f.write(centers.tobytes())
+
+    def _pop_data(self):
+        """
+        Detach the reference set and every cached image of it (including the
+        inference plan) from the model and return them, see _push_data.
+        """
+        layer_caches = {}
+        for i in range(self._layer_counter):
+            layer = getattr(self, 'layer'+str(i))
+            for name in ('_whitener_cache', '_index_cache'):
+                if getattr(layer, name, None) is not None:
+                    layer_caches[i, name] = getattr(layer, name)
+                    setattr(layer, name, None)
+        state = self.centers, self._center_cache, \
+        getattr(self, '_inference_plan', None), \
+        getattr(self, '_cast_cache', {}), layer_caches
+        self.centers, self._center_cache, self._inference_plan = None, {}, None
+        self._cast_cache = {}
+        return state
+
+    def _push_data(self, state):
+        """
+        Undo _pop_data.
+        """
+        self.centers, self._center_cache, self._inference_plan, \
+        self._cast_cache, layer_caches = state
+        for (i, name), cache in layer_caches.items():
+            setattr(getattr(self, 'layer'+str(i)), name, cache)
+
+    def _dedup_centers(self, centers):
+        """
+        Drop the repeated rows of the reference set and sum the weight
+        columns of each group of identical rows into one. Modifies the model.
+        """
+        centers, inverse = np.unique(centers, axis=0, return_inverse=True)
+        inverse = torch.from_numpy(inverse.astype(np.int64).ravel())
+        for i in range(self._layer_counter):
+            layer = getattr(self, 'layer'+str(i))
+            if not getattr(layer, 'needs_centers', True): continue
+            assert not getattr(layer, 'whiten', False) and \
+            not isinstance(layer, kerLinearSharded), \
+            'dedup is not supported for whitened or sharded layers'
+            weight = layer.weight.data
+            dim = len(weight.shape) - 1
+            shape = list(weight.shape)
+            shape[dim] = centers.shape[0]
+            index = inverse.cuda() if weight.is_cuda else inverse
+            layer.weight.data = weight.new(*shape).zero_()\
+            .index_add_(dim, index, weight)
+            layer.ker_dim = centers.shape[0]
+        return centers
+
+    @staticmethod
+    def load(path, mmap=True, prepare=False):
+        """
+        Load a model saved with save. The reference set becomes the centers of
+        the model.
+
+        Parameters
+        ----------
+        path : str
+
+        mmap (optional) : bool
+            Memory-map the reference set (copy-on-write) instead of reading
+            it. The pages are then loaded lazily and shared by all processes
+            loading the same file.
+
+        prepare (optional) : bool
+            Call prepare_inference on the loaded model. This reads the whole
+            reference set, otherwise the images of the reference set are only
+            computed (and cached) by the first call of get_repr, evaluate or
+            predict, which keeps cold start short.
+
+        Returns
+        -------
+        model : baseMLKN
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC))!=_MAGIC:
+                raise ValueError('not a saved MLKN: {}'.format(path))
+            header_len, = struct.unpack('<Q', f.read(8))
+            header = _load_pickle(io.BytesIO(f.read(header_len)))
+            offset = f.tell()
+            offset += -offset % _ALIGN
+
+            model = header['model']
+            if header['centers_dtype'] is None: return model
+            dtype = np.dtype(header['centers_dtype'])
+            shape = tuple(header['centers_shape'])
+            if mmap and shape[0]:
+                centers = np.memmap(
+                    f, dtype=dtype, mode='c', offset=offset, shape=shape
+                    )
+            else:
+                f.seek(offset)
+                count = int(np.prod(shape))
+                centers = np.fromfile(f, dtype=dtype, count=count)\
+                .reshape(shape)
+
+        if dtype==np.float16: centers = centers.astype(np.float32)
+        centers = torch.from_numpy(centers)
+        if header['centers_is_variable']:
+            centers = Variable(centers, requires_grad=False)
+        model.centers = centers
+        model._rank, model._world_size = 0, 1
+        if prepare: model.prepare_inference()
+        return model
 
 class MLKN(baseMLKN):
     """
@@ -240,24 +1143,33 @@ class MLKN(baseMLKN):
         assert isinstance(optimizer, torch.optim.Optimizer)
         setattr(self, 'optimizer', optimizer)
 
+    def _loss(self, output, y):
+        """
+        Loss of a batch.
+        """
+        return self.output_loss_fn(output, y)
+
     def fit(
         self,
         n_epoch,
-        X, Y,
+        X, Y=None,
         batch_size=None,
         shuffle=False,
-        accumulate_grad=True):
+        accumulate_grad=True,
+        num_workers=0,
+        pin_memory=False):
         """
         Parameters
         ----------
         n_epoch : int
             The number of epochs to train the model.
 
-        X : Tensor, shape (n_example, dim)
-            Training set.
+        X : Tensor, shape (n_example, dim), Dataset or DataLoader
+            Training set. A Dataset or DataLoader must yield (x, y) pairs and
+            centers must have been added to the model (see add_centers).
 
-        Y : Tensor, shape (n_example, 1) or (n_example,)
-            Target data.
+        Y (optional) : Tensor, shape (n_example, 1) or (n_example,)
+            Target data. Required if X is a Tensor.
 
         batch_size (optional) : int
             If not specified, use full mode.
@@ -268,63 +1180,204 @@ class MLKN(baseMLKN):
         accumulate_grad (optional) : bool
             If True, accumulate gradient from each batch and only update the
             weights after each epoch.
-        """
-        assert X.shape[0]==Y.shape[0]
 
-        if not batch_size or batch_size>X.shape[0]: batch_size = X.shape[0]
-        n_batch = X.shape[0] // batch_size
-        last_batch = bool(X.shape[0] % batch_size)
-
-        if len(Y.shape)==2: Y=Y.view(-1,)
-        # NOTE: CrossEntropyLoss requires label tensor to be of
-        # shape (n)
-        # TODO: what about multi-D MSELoss or CrossEntropyLoss?
-        if isinstance(self.output_loss_fn, torch.nn.CrossEntropyLoss):
-            Y=Y.type(torch.cuda.LongTensor)\
-            if Y.is_cuda else Y.type(torch.LongTensor)
-            # NOTE: required by CrossEntropyLoss
+        num_workers, pin_memory (optional)
+            If X is a Dataset, see backend.get_loader.
+        """
+        if not K.is_stream(X): assert X.shape[0]==Y.shape[0]
+        X = self._cast(X) # NOTE: once for the entire fit, see set_precision
+        self._check_batch_size(X, batch_size)
 
-        elif isinstance(self.output_loss_fn, torch.nn.MSELoss):
-            Y=Y.type(torch.cuda.FloatTensor)\
-            if Y.is_cuda else Y.type(torch.FloatTensor)
-            # NOTE: required by MSELoss
+        self._begin_fit()
+        try: self._fit(
+            n_epoch,
+            X, Y,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            accumulate_grad=accumulate_grad,
+            num_workers=num_workers,
+            pin_memory=pin_memory
+            )
+        finally: self._end_fit()
 
+    def _fit(
+        self,
+        n_epoch,
+        X, Y,
+        batch_size=None,
+        shuffle=False,
+        accumulate_grad=True,
+        num_workers=0,
+        pin_memory=False):
+        """
+        Training loop of fit, which wraps it with the instrumentation.
+        """
         for param in self.parameters(): param.requires_grad=True # unfreeze
         for _ in range(n_epoch):
             __ = 0
             self.optimizer.zero_grad()
-            for x, y in K.get_batch(
+            batches, n_batch = self._get_batches(
                 X, Y,
                 batch_size=batch_size,
-                shuffle=shuffle
-                ):
+                shuffle=shuffle,
+                num_workers=num_workers,
+                pin_memory=pin_memory
+                )
+            for x, y in batches:
                 __ += 1
-                output = self._forward(x, X)
-
-                loss = self.output_loss_fn(output, y)
-                # NOTE: L2 regulatization
-                # is taken care of by setting the weight_decay param in the
-                # optimizer, see
-                # https://discuss.pytorch.org/t/simple-l2-regularization/139
-
-                print('epoch: {}/{}, batch: {}/{}, loss({}): {:.3f}'.format(
-                    _+1, n_epoch, __, n_batch+int(last_batch),
-                    self.output_loss_fn.__class__.__name__,
-                    loss.data[0]
-                    ))
+                x, y, frac = self._shard(x, y)
+                if x is not None:
+                    y = self._prepare_target(y)
+                    output = self._forward(x, X)
+
+                    with self._timer('loss'): loss = self._loss(output, y)
+                    # NOTE: L2 regulatization
+                    # is taken care of by setting the weight_decay param in
+                    # the optimizer, see
+                    # https://discuss.pytorch.org/t/simple-l2-regularization/139
+
+                    self._emit(
+                        'on_batch_end',
+                        layer=None,
+                        epoch=_+1, n_epoch=n_epoch,
+                        batch=__, n_batch=n_batch,
+                        batch_size=x.shape[0],
+                        loss=loss,
+                        loss_name=self.output_loss_fn.__class__.__name__
+                        )
 
-                loss.backward()
+                    loss = self._scale_loss(loss, self.output_loss_fn, frac)
+                    with self._timer('backward'):
+                        loss.backward(retain_graph=accumulate_grad)
+                # NOTE: with an empty share, this process still takes part in
+                # the reduction of the gradients
+                # NOTE: the cached images of X at the hidden layers are shared
+                # by all batches until the next step
                 if not accumulate_grad:
-                    self.optimizer.step()
-                    self.optimizer.zero_grad()
+                    self._step(self.optimizer)
 
             if accumulate_grad:
-                self.optimizer.step()
-                self.optimizer.zero_grad()
+                self._step(self.optimizer)
 
-        print('\n' + '#'*10 + '\n')
+        self._emit('on_stage_end', layer=None)
         for param in self.parameters(): param.requires_grad=False # freeze
         # the model
+        self._clear_cache() # NOTE: drop the graphs held by the cache
+        if self.centers is not None or not K.is_stream(X):
+            self.prepare_inference(X)
+
+    def fit_output(self, X, Y, solver='cholesky', reg=1e-3, n_precond=100):
+        """
+        Refit the last layer in closed form with the other layers fixed, e.g.,
+        after fit, instead of many epochs of first-order optimization. The
+        last layer must be a kerLinear and the loss function should be
+        MSELoss or CrossEntropyLoss (in which case the layer is fitted to the
+        one-hot codes of Y).
+
+        Parameters
+        ----------
+        X : Tensor, shape (n_example, dim)
+            Training set.
+
+        Y : Tensor, shape (n_example, 1) or (n_example,)
+            Target data.
+
+        solver (optional) : str
+            'cholesky' for small training sets (or few centers), 'cg' for
+            large ones, see backend.ridge_solve.
+
+        reg (optional) : scalar
+            Ridge parameter.
+
+        n_precond (optional) : int
+            Rank of the preconditioner of the 'cg' solver.
+        """
+        for param in self.parameters(): param.requires_grad=False # freeze
+        self._solve_output(X, Y, solver=solver, reg=reg, n_precond=n_precond)
+
+class MLKNEnsemble(MLKN):
+    """
+    n_member MLKNs with the same architecture (but, e.g., different initial
+    weights, kernel widths or weight decays) trained simultaneously with
+    backpropagation. All layers must be kerLinearEnsemble with the same
+    n_member. The output of the model has shape (n_member, batch_size,
+    out_dim) and the loss is the sum of the losses of the members, so
+    training the ensemble amounts to training each member on its own with the
+    same batches, while the kernel maps of the shared inputs are computed once
+    and the Python overhead is paid once per batch instead of once per member.
+    Set per-member weight decays on the layers (see kerLinearEnsemble) rather
+    than on the optimizer.
+    """
+    def __init__(self, n_member):
+        super(MLKNEnsemble, self).__init__()
+        self.n_member = n_member
+
+    def add_layer(self, layer):
+        assert isinstance(layer, kerLinearEnsemble) and \
+        layer.n_member==self.n_member
+        super(MLKNEnsemble, self).add_layer(layer)
+
+    def _loss(self, output, y):
+        """
+        Sum of the losses of the members.
+        """
+        n_member, n_example = output.shape[0], output.shape[1]
+        loss = self.output_loss_fn(
+            output.contiguous().view(n_member * n_example, -1),
+            y.repeat(n_member)
+            )
+        if getattr(self.output_loss_fn, 'size_average', True):
+            loss = loss * n_member
+        return loss
+
+    def _reduce_grads(self, optimizer, average=False):
+        super(MLKNEnsemble, self)._reduce_grads(optimizer, average=average)
+        for i in range(self._layer_counter):
+            getattr(self, 'layer'+str(i)).decay_grad()
+        # NOTE: after the reduction, which would multiply the decay by the
+        # number of processes
+
+    def predict(self, X_test, X=None, batch_size=None, vote=True):
+        """
+        Get predictions from the ensemble, assuming it is a classifier.
+
+        Parameters
+        ----------
+
+        X_test : Tensor, shape (n1_example, dim)
+            Test set.
+
+        X (optional) : Tensor, shape (n_example, dim)
+            Training set. Not needed if centers have been added to the model.
+
+        vote (optional) : bool
+            If True, predict the class with the highest softmax probability
+            averaged over the members, otherwise return the predictions of
+            each member.
+
+        Returns
+        -------
+        Y_pred : Tensor, shape (n1_example,) or (n_member, n1_example)
+            Predicted labels.
+        """
+        Y_raw = self.evaluate(X_test, X, batch_size=batch_size)
+        if vote:
+            prob = torch.nn.functional.softmax(Y_raw, dim=2).mean(dim=0)
+            _, Y_pred = torch.max(prob, dim=1)
+        else: _, Y_pred = torch.max(Y_raw, dim=2)
+
+        return Y_pred
+
+    def get_member(self, k):
+        """
+        Copy of member k as a standalone MLKN (without optimizer).
+        """
+        model = MLKN()
+        for i in range(self._layer_counter):
+            model.add_layer(getattr(self, 'layer'+str(i)).get_member(k))
+        if hasattr(self, 'output_loss_fn'): model.add_loss(self.output_loss_fn)
+        model.centers = self.centers
+        return model
 
 class MLKNGreedy(baseMLKN):
     """
@@ -374,24 +1427,20 @@ class MLKNGreedy(baseMLKN):
         n_group,
         batch_size=None,
         shuffle=False,
-        accumulate_grad=True):
+        accumulate_grad=True,
+        num_workers=0,
+        pin_memory=False):
         """
         Fit the representation learning layers, i.e., all layers but the last.
         """
-
-        assert len(Y.shape) <= 2
-        # NOTE: this model only supports hard class labels
-        assert X.shape[0]==Y.shape[0]
-
-        if not batch_size or batch_size>X.shape[0]: batch_size = X.shape[0]
-        n_batch = X.shape[0] // batch_size
-        last_batch = bool(X.shape[0] % batch_size)
+        streaming = K.is_stream(X)
+        if not streaming:
+            assert len(Y.shape) <= 2
+            # NOTE: this model only supports hard class labels
+            assert X.shape[0]==Y.shape[0]
+        C = self._reference_set(X)
 
         # train the representation-learning layers #############################
-        if len(Y.shape)==1: Y=Y.view(-1, 1)
-        # NOTE: ideal_gram() requires label tensor to be of shape
-        # (n, 1)
-        loss_fn = torch.nn.CosineSimilarity() # NOTE: equivalent to alignment
         for i in range(self._layer_counter-1):
             optimizer = getattr(self, 'optimizer'+str(i))
             next_layer = getattr(self, 'layer'+str(i+1))
@@ -402,61 +1451,94 @@ class MLKNGreedy(baseMLKN):
             # torch.nn.Linear cannot pass this. We do this check because each
             # layer uses the kernel function from the next layer to calculate
             # loss but nn.Linear does not have a kernel so it cannot be the
-            # next layer for any layer
+            # next layer for any layer. rffLinear passes as it approximates
+            # the Gaussian kernel with width next_layer.sigma, the others
+            # align with their kernel object (see backend.get_kernel)
+
+            X_in = X if streaming else self._get_inputs(X, i)
+            C_in = self._get_centers(C, i) \
+            if getattr(layer, 'needs_centers', True) else None
+            # NOTE: layers 0, ..., i-1 are frozen so the images of X and of
+            # the reference set at the input of layer i are computed once here
+            # and the batches are drawn from them directly instead of being
+            # fed through these layers at every step. A stream cannot be
+            # materialized so its batches are still fed through them
 
             for param in layer.parameters(): param.requires_grad=True # unfreeze
 
             for _ in range(n_epoch[i]):
                 __ = 0
                 optimizer.zero_grad()
-                for x, y in K.get_batch(
-                    X, Y,
+                batches, n_batch = self._get_batches(
+                    X_in, Y,
                     batch_size=batch_size,
-                    shuffle=shuffle
-                    ):
+                    shuffle=shuffle,
+                    num_workers=num_workers,
+                    pin_memory=pin_memory
+                    )
+                for x, y in batches:
                     __ += 1
-                    # get ideal gram matrix ####################################
-                    ideal_gram = K.ideal_gram(y, y, n_group)
-                    ideal_gram=ideal_gram.type(torch.cuda.FloatTensor)\
-                    if ideal_gram.is_cuda else ideal_gram.type(torch.FloatTensor)
-                    # NOTE: required by CosineSimilarity
+                    if streaming and i>0: x = self._forward(x, C, upto=i-1)
+                    y = y.view(-1, 1)
+                    # NOTE: label_alignment() requires label tensor to be of
+                    # shape (n, 1)
 
                     # get output ###############################################
-                    output = self._forward(x, X, upto=i)
+                    with self._timer('forward/layer'+str(i)):
+                        output = self._forward_shared(layer, x, C_in)
+                    # NOTE: the alignment of a batch does not split over its
+                    # examples, so in data-parallel training (see distribute)
+                    # each process computes the output of its share of the
+                    # batch and the whole output is gathered everywhere
                     # output.register_hook(print)
                     # print('output', output) # NOTE: layer0 initial feedforward
                     # passed
 
-                    gram = K.kerMap(
-                        output,
-                        output,
-                        next_layer.sigma
-                        )
-                    # print(gram) # NOTE: initial feedforward passed
-                    # gram.register_hook(print) # NOTE: (for torch_backend.alignment)
-                    # gradient here is inconsistent using the alignment loss from
-                    # torch_backend: hand-calculated_grad*n_example =
-                    # pytorch_grad
-
                     # compute loss and optimizer takes a step###################
-                    loss = -loss_fn(gram.view(1, -1), ideal_gram.view(1, -1))
+                    with self._timer('loss'):
+                        if isinstance(next_layer, rffLinear) and \
+                        next_layer.ker_dim < output.shape[0]:
+                            alignment = K.label_alignment(
+                                y, n_group,
+                                feat=next_layer.feature_map(output)
+                                )
+                            # NOTE: cheaper than the (batch_size, batch_size)
+                            # Gram matrix, and this is the kernel the next
+                            # layer uses
+                        else:
+                            gram = K.kerMap(
+                                output,
+                                output,
+                                getattr(next_layer, 'kernel', next_layer.sigma)
+                                )
+                            # print(gram) # NOTE: initial feedforward passed
+                            alignment = K.label_alignment(
+                                y, n_group, gram=gram
+                                )
+                            # NOTE: equivalent to the cosine similarity
+                            # between gram and K.ideal_gram(y, y, n_group),
+                            # without computing the latter
+                        loss = -alignment
                     # NOTE: negative alignment
                     # NOTE: L2 regulatization
                     # is taken care of by setting the weight_decay param in the
                     # optimizer, see
                     # https://discuss.pytorch.org/t/simple-l2-regularization/139
 
-                    print('epoch: {}/{}, batch: {}/{}, loss({}): {:.3f}'.format(
-                        _+1, n_epoch[i], __, n_batch+int(last_batch),
-                        'Alignment',
-                        -loss.data[0]
-                        ))
+                    self._emit(
+                        'on_batch_end',
+                        layer=i,
+                        epoch=_+1, n_epoch=n_epoch[i],
+                        batch=__, n_batch=n_batch,
+                        batch_size=x.shape[0],
+                        loss=alignment,
+                        loss_name='Alignment'
+                        )
 
-                    loss.backward()
+                    with self._timer('backward'): loss.backward()
                     # train the layer
                     if not accumulate_grad:
-                        optimizer.step()
-                        optimizer.zero_grad()
+                        self._step(optimizer)
 
                     #########
                     # check gradient
@@ -465,10 +1547,9 @@ class MLKNGreedy(baseMLKN):
                     #########
 
                 if accumulate_grad:
-                    optimizer.step()
-                    optimizer.zero_grad()
+                    self._step(optimizer)
 
-            print('\n' + '#'*10 + '\n')
+            self._emit('on_stage_end', layer=i)
             for param in layer.parameters(): param.requires_grad=False # freeze
             # this layer again
 
@@ -478,74 +1559,84 @@ class MLKNGreedy(baseMLKN):
         X, Y,
         batch_size=None,
         shuffle=False,
-        accumulate_grad=True
+        accumulate_grad=True,
+        solver=None,
+        reg=1e-3,
+        num_workers=0,
+        pin_memory=False
         ):
         """
-        Fit the last layer.
+        Fit the last layer. If solver is given, the layer is fitted in closed
+        form instead of with its optimizer, see baseMLKN._solve_output.
         """
+        if solver is not None:
+            self._solve_output(X, Y, solver=solver, reg=reg)
+            return
 
-        assert len(Y.shape) <= 2 # NOTE: this model only supports hard class labels
-        assert X.shape[0]==Y.shape[0]
-
-        if not batch_size or batch_size>X.shape[0]: batch_size = X.shape[0]
-        n_batch = X.shape[0] // batch_size
-        last_batch = bool(X.shape[0] % batch_size)
-
+        streaming = K.is_stream(X)
+        if not streaming:
+            assert len(Y.shape) <= 2
+            # NOTE: this model only supports hard class labels
+            assert X.shape[0]==Y.shape[0]
+        C = self._reference_set(X)
 
         # train the last layer as a RBFN classifier ############################
         i = self._layer_counter-1
         optimizer = getattr(self, 'optimizer'+str(i))
         layer = getattr(self, 'layer'+str(i))
 
-        if len(Y.shape)==2: Y=Y.view(-1,)
-        # NOTE: CrossEntropyLoss (and probably also MSELoss) requires label
-        # tensor to be of shape (n)
-
-        # TODO: what about multi-D MSELoss or CrossEntropyLoss?
-
-        if isinstance(self.output_loss_fn, torch.nn.CrossEntropyLoss):
-            Y=Y.type(torch.cuda.LongTensor)\
-            if Y.is_cuda else Y.type(torch.LongTensor)
-            # NOTE: required by CrossEntropyLoss
-
-        elif isinstance(self.output_loss_fn, torch.nn.MSELoss):
-            Y=Y.type(torch.cuda.FloatTensor)\
-            if Y.is_cuda else Y.type(torch.FloatTensor)
-            # NOTE: required by MSELoss
-
+        X_in = X if streaming else self._get_inputs(X, i)
+        C_in = self._get_centers(C, i) \
+        if getattr(layer, 'needs_centers', True) else None
+        # NOTE: all layers but the last are frozen, see _fit_rep_learners
 
         for param in layer.parameters(): param.requires_grad=True # unfreeze
         for _ in range(n_epoch[i]):
             __ = 0
             optimizer.zero_grad()
-            for x, y in K.get_batch(
-                X, Y,
+            batches, n_batch = self._get_batches(
+                X_in, Y,
                 batch_size=batch_size,
-                shuffle=shuffle
-                ):
+                shuffle=shuffle,
+                num_workers=num_workers,
+                pin_memory=pin_memory
+                )
+            for x, y in batches:
                 __ += 1
-                # compute loss
-                output = self._forward(x, X, upto=i)
-                # print(output) # NOTE: layer1 initial feedforward passed
-
-                loss = self.output_loss_fn(output, y)
-                # print(loss) # NOTE: initial feedforward passed
-                # NOTE: L2 regulatization
-                # is taken care of by setting the weight_decay param in the
-                # optimizer, see
-                # https://discuss.pytorch.org/t/simple-l2-regularization/139
-
-                print('epoch: {}/{}, batch: {}/{}, loss({}): {:.3f}'.format(
-                    _+1, n_epoch[i], __, n_batch+int(last_batch),
-                    self.output_loss_fn.__class__.__name__,
-                    loss.data[0]
-                    ))
+                x, y, frac = self._shard(x, y)
+                if x is not None:
+                    # NOTE: an empty share still takes part in the reduction
+                    # of the gradients, see distribute
+                    if streaming and i>0: x = self._forward(x, C, upto=i-1)
+                    y = self._prepare_target(y)
+                    # compute loss
+                    with self._timer('forward/layer'+str(i)):
+                        output = layer(x, C_in)
+                    # print(output) # NOTE: layer1 initial feedforward passed
+
+                    with self._timer('loss'):
+                        loss = self.output_loss_fn(output, y)
+                    # print(loss) # NOTE: initial feedforward passed
+                    # NOTE: L2 regulatization
+                    # is taken care of by setting the weight_decay param in
+                    # the optimizer, see
+                    # https://discuss.pytorch.org/t/simple-l2-regularization/139
+
+                    self._emit(
+                        'on_batch_end',
+                        layer=i,
+                        epoch=_+1, n_epoch=n_epoch[i],
+                        batch=__, n_batch=n_batch,
+                        batch_size=x.shape[0],
+                        loss=loss,
+                        loss_name=self.output_loss_fn.__class__.__name__
+                        )
 
-                loss.backward()
+                    loss = self._scale_loss(loss, self.output_loss_fn, frac)
+                    with self._timer('backward'): loss.backward()
                 # train the layer
                 if not accumulate_grad:
-                    optimizer.step()
-                    optimizer.zero_grad()
+                    self._step(optimizer)
 
                 #########
                 # define crossentropy loss to test gradient
@@ -559,10 +1650,9 @@ class MLKNGreedy(baseMLKN):
                 # print('bias gradient', layer.bias.grad.data)
                 #########
             if accumulate_grad:
-                optimizer.step()
-                optimizer.zero_grad()
+                self._step(optimizer)
 
-        print('\n' + '#'*10 + '\n')
+        self._emit('on_stage_end', layer=i)
         for param in layer.parameters(): param.requires_grad=False # freeze
         # this layer again
 
@@ -580,7 +1670,7 @@ class MLKNClassifier(MLKNGreedy):
     def __init__(self):
         super(MLKNClassifier, self).__init__()
 
-    def predict(self, X_test, X, batch_size=None):
+    def predict(self, X_test, X=None, batch_size=None):
         """
         Get predictions from the classifier.
 
@@ -590,15 +1680,14 @@ class MLKNClassifier(MLKNGreedy):
         X_test : Tensor, shape (n1_example, dim)
             Test set.
 
-        X : Tensor, shape (n_example, dim)
-            Training set.
+        X (optional) : Tensor, shape (n_example, dim)
+            Training set. Not needed if centers have been added to the model.
 
         Returns
         -------
         Y_pred : Tensor, shape (n1_example,)
             Predicted labels.
         """
-        if not batch_size or batch_size>X_test.shape[0]: batch_size=X_test.shape[0]
         Y_raw = self.evaluate(X_test, X, batch_size=batch_size)
         _, Y_pred = torch.max(Y_raw, dim=1)
 
@@ -624,7 +1713,8 @@ class MLKNClassifier(MLKNGreedy):
         """
         assert y_pred.shape==y.shape
         y_pred = y_pred.type_as(y)
-        err = (y_pred!=y).sum().type(torch.FloatTensor).div_(y.shape[0])
+        err = (y_pred!=y).sum().type(K.tensor_type('float', y.is_cuda))\
+        .div_(y.shape[0])
         return err
 
     def fit(
@@ -634,7 +1724,11 @@ class MLKNClassifier(MLKNGreedy):
         n_class,
         batch_size=None,
         shuffle=False,
-        accumulate_grad=True):
+        accumulate_grad=True,
+        output_solver=None,
+        output_reg=1e-3,
+        num_workers=0,
+        pin_memory=False):
         """
         Parameters
         ----------
@@ -644,11 +1738,13 @@ class MLKNClassifier(MLKNGreedy):
             Even if there is only one layer, this parameter must be a tuple (
             may be of of a scalar, e.g., (1,)).
 
-        X : Tensor, shape (n_example, dim)
-            Training set.
+        X : Tensor, shape (n_example, dim), Dataset or DataLoader
+            Training set. A Dataset or DataLoader must yield (x, y) pairs and
+            centers must have been added to the model (see add_centers).
 
         Y : Variable of shape (n_example, 1) or (n_example,)
-            Categorical labels for the set.
+            Categorical labels for the set. Ignored (may be None) if X is a
+            Dataset or DataLoader.
 
         n_class : int
 
@@ -661,27 +1757,80 @@ class MLKNClassifier(MLKNGreedy):
         accumulate_grad (optional) : bool
             If True, accumulate gradient from each batch and only update the
             weights after each epoch.
+
+        output_solver (optional) : str
+            If given ('cholesky' or 'cg'), fit the output layer in closed form
+            as a kernel ridge regression on the one-hot labels instead of with
+            its optimizer, see backend.ridge_solve. The number of epochs for
+            the output layer is then ignored.
+
+        output_reg (optional) : scalar
+            Ridge parameter for output_solver. output_solver requires X to be
+            a Tensor.
+
+        num_workers, pin_memory (optional)
+            If X is a Dataset, see backend.get_loader.
         """
         assert len(n_epoch) >= self._layer_counter
         self._compile()
+        X = self._cast(X) # NOTE: once for the entire fit, see set_precision
+        self._check_batch_size(X, batch_size)
+        self._begin_fit()
+        try: self._fit(
+            n_epoch,
+            X, Y,
+            n_class,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            accumulate_grad=accumulate_grad,
+            output_solver=output_solver,
+            output_reg=output_reg,
+            num_workers=num_workers,
+            pin_memory=pin_memory
+            )
+        finally: self._end_fit()
+
+    def _fit(
+        self,
+        n_epoch,
+        X, Y,
+        n_class,
+        batch_size=None,
+        shuffle=False,
+        accumulate_grad=True,
+        output_solver=None,
+        output_reg=1e-3,
+        num_workers=0,
+        pin_memory=False):
+        """
+        Training of fit, which wraps it with the instrumentation.
+        """
         self._fit_rep_learners(
             n_epoch,
             X, Y,
             n_class,
             batch_size=batch_size,
             shuffle=shuffle,
-            accumulate_grad=accumulate_grad
+            accumulate_grad=accumulate_grad,
+            num_workers=num_workers,
+            pin_memory=pin_memory
             )
-        print('Representation-learning layers trained.')
+        self._emit('on_message', msg='Representation-learning layers trained.')
 
         self._fit_output(
             n_epoch,
             X, Y,
             batch_size=batch_size,
             shuffle=shuffle,
-            accumulate_grad=accumulate_grad
+            accumulate_grad=accumulate_grad,
+            solver=output_solver,
+            reg=output_reg,
+            num_workers=num_workers,
+            pin_memory=pin_memory
             )
-        print('Classifier trained.')
+        self._emit('on_message', msg='Classifier trained.')
+        if self.centers is not None or not K.is_stream(X):
+            self.prepare_inference(X)
 
 if __name__=='__main__':
     pass
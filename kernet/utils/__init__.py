@@ -0,0 +1,5 @@
+from .parallel import *
+from .server import MicroBatcher, make_server
+from .callbacks import Callback, LossLogger, Profiler, peak_rss
+from .distributed import launch, all_reduce_grads, broadcast_tensors, \
+    shard_range, all_reduce_sum, all_reduce_grad
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import resource
+import sys
+import time
+
+import torch
+
+def peak_rss():
+    """
+    Peak resident set size of this process so far, in MB.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NOTE: kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform=='darwin' else rss / 2**10
+
+class Callback(object):
+    """
+    Base class of the callbacks of the training loops, see
+    baseMLKN.callbacks. Each hook receives the model and keyword arguments
+    describing the event; override the ones of interest.
+
+    Events
+    ------
+    on_fit_begin, on_fit_end : start and end of fit.
+
+    on_batch_end : after the loss of a batch has been computed. Arguments:
+        layer (index of the layer being trained, None for the entire model),
+        epoch, n_epoch, batch, n_batch (all 1-indexed), batch_size, loss
+        (Variable, the reported quantity, e.g., the alignment for the hidden
+        layers of MLKNGreedy) and loss_name.
+
+    on_stage_end : after a layer (or the entire model, layer=None) has been
+        trained.
+
+    on_message : a message from the model (msg).
+
+    on_timing : time (seconds) spent in a section (name) of the training
+        loop, e.g., 'forward/layer0', 'gram/layer0', 'loss', 'backward',
+        'step'. Only sent if some callback has needs_timing=True, as the
+        timing adds synchronizations on GPU.
+    """
+    needs_timing = False
+
+    def on_fit_begin(self, model, **info): pass
+
+    def on_fit_end(self, model, **info): pass
+
+    def on_batch_end(self, model, **info): pass
+
+    def on_stage_end(self, model, **info): pass
+
+    def on_message(self, model, **info): pass
+
+    def on_timing(self, model, **info): pass
+
+class LossLogger(Callback):
+    def __init__(self, sink=print, every=1, min_interval=0.):
+        """
+        Report the loss of the batches, e.g., to stdout (the default, which
+        reproduces the former output of the models) or to a logger, say,
+        sink=logging.getLogger('kernet').info. A line costs a device-to-host
+        copy of the loss and a write, so on small batches rate-limit it.
+
+        Parameters
+        ----------
+        sink (optional) : callable
+            Called with each line.
+
+        every (optional) : int
+            Report one batch in every.
+
+        min_interval (optional) : scalar
+            Minimum time (in seconds) between two reported batches. The last
+            batch of each epoch is always reported if its predecessors were
+            skipped by this limit.
+        """
+        self.sink = sink
+        self.every = every
+        self.min_interval = min_interval
+        self._count = 0
+        self._last = None
+
+    def on_batch_end(self, model, **info):
+        self._count += 1
+        if self._count % self.every: return
+        now = time.time()
+        last_batch = info['batch']==info['n_batch']
+        if self._last is not None and now - self._last < self.min_interval \
+        and not last_batch: return
+        self._last = now
+        self.sink('epoch: {}/{}, batch: {}/{}, loss({}): {:.3f}'.format(
+            info['epoch'], info['n_epoch'], info['batch'], info['n_batch'],
+            info['loss_name'],
+            float(info['loss'])
+            ))
+
+    def on_stage_end(self, model, **info):
+        self.sink('\n' + '#'*10 + '\n')
+
+    def on_message(self, model, **info):
+        self.sink(info['msg'])
+
+class Profiler(Callback):
+    needs_timing = True
+    def __init__(self, trace_path=None):
+        """
+        Record where the time of fit goes: per-layer forward time (including
+        the images of the reference set), Gram computations, loss, backward
+        and optimizer steps, together with batch throughput and memory
+        peaks. See summary and report.
+
+        Parameters
+        ----------
+        trace_path (optional) : str
+            If given, fit also runs under the autograd profiler and its trace
+            is exported there in the Chrome trace format
+            (chrome://tracing).
+        """
+        self.trace_path = trace_path
+        self.timings = {}
+        self.n_batch = 0
+        self.n_example = 0
+        self.fit_time = 0.
+        self.peak_rss_mb = 0.
+        self.peak_cuda_mb = 0.
+        self._start = None
+        self._prof = None
+
+    def on_fit_begin(self, model, **info):
+        self._start = time.time()
+        if self.trace_path is not None:
+            self._prof = torch.autograd.profiler.profile()
+            self._prof.__enter__()
+
+    def on_fit_end(self, model, **info):
+        if self._prof is not None:
+            self._prof.__exit__(None, None, None)
+            self._prof.export_chrome_trace(self.trace_path)
+            self._prof = None
+        self.fit_time += time.time() - self._start
+        self._update_memory()
+
+    def on_batch_end(self, model, **info):
+        self.n_batch += 1
+        self.n_example += info['batch_size']
+        self._update_memory()
+
+    def on_timing(self, model, **info):
+        count, total = self.timings.get(info['name'], (0, 0.))
+        self.timings[info['name']] = (count + 1, total + info['seconds'])
+
+    def _update_memory(self):
+        self.peak_rss_mb = max(self.peak_rss_mb, peak_rss())
+        if torch.cuda.is_available() and \
+        hasattr(torch.cuda, 'max_memory_allocated'):
+            self.peak_cuda_mb = max(
+                self.peak_cuda_mb, torch.cuda.max_memory_allocated() / 2**20
+                )
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary : dict
+            For each timed section, its count and total and mean time (in
+            seconds), under 'timings'; total fit time, numbers of batches and
+            examples, examples per second and memory peaks (in MB).
+        """
+        return {
+            'timings': {
+                name: {'count': count, 'total': total, 'mean': total / count}
+                for name, (count, total) in self.timings.items()
+                },
+            'fit_time': self.fit_time,
+            'n_batch': self.n_batch,
+            'n_example': self.n_example,
+            'examples_per_sec': self.n_example / self.fit_time \
+            if self.fit_time else 0.,
+            'peak_rss_mb': self.peak_rss_mb,
+            'peak_cuda_mb': self.peak_cuda_mb
+            }
+
+    def report(self):
+        """
+        summary as a table, sections sorted by total time.
+        """
+        s = self.summary()
+        lines = ['{:<24}{:>8}{:>12}{:>12}{:>8}'.format(
+            'section', 'count', 'total (s)', 'mean (ms)', '%'
+            )]
+        for name, t in sorted(s['timings'].items(),
+            key=lambda item: -item[1]['total']):
+            lines.append('{:<24}{:>8}{:>12.4f}{:>12.4f}{:>8.1f}'.format(
+                name, t['count'], t['total'], t['mean'] * 1e3,
+                100 * t['total'] / s['fit_time'] if s['fit_time'] else 0.
+                ))
+        lines.append('fit: {:.4f}s, {} batches, {:.1f} examples/s, '
+            'peak RSS {:.1f}MB, peak CUDA {:.1f}MB'.format(
+            s['fit_time'], s['n_batch'], s['examples_per_sec'],
+            s['peak_rss_mb'], s['peak_cuda_mb']
+            ))
+        return '\n'.join(lines)
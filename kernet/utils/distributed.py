@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import multiprocessing
+import socket
+import traceback
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+def _free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _worker(
+    fn, args, rank, world_size, port, backend, n_thread, results, done):
+    torch.set_num_threads(n_thread)
+    try:
+        dist.init_process_group(
+            backend,
+            init_method='tcp://127.0.0.1:{}'.format(port),
+            rank=rank,
+            world_size=world_size
+            )
+        results.put((rank, True, fn(*args)))
+    except Exception:
+        results.put((rank, False, traceback.format_exc()))
+        raise
+    done.wait()
+    # NOTE: tensors are sent through shared memory, which has to outlive
+    # their unpickling by the parent
+
+def launch(fn, world_size, args=(), backend='gloo', n_thread=None):
+    """
+    Run fn(*args) in world_size local processes forming the default process
+    group of torch.distributed, e.g., to train a model data-parallel (see
+    baseMLKN.distribute). Inside fn, torch.distributed.get_rank() tells the
+    processes apart. fn must be defined at the top level of a module.
+
+    Parameters
+    ----------
+    fn : callable
+
+    world_size : int
+
+    args (optional) : tuple
+
+    backend (optional) : str
+
+    n_thread (optional) : int
+        Threads per process, defaults to the number of CPUs divided by
+        world_size.
+
+    Returns
+    -------
+    results : list
+        Return values of fn, by rank.
+    """
+    if n_thread is None:
+        n_thread = max(1, multiprocessing.cpu_count() // world_size)
+    port = _free_port()
+    results = mp.SimpleQueue()
+    done = mp.Event()
+    processes = []
+    for rank in range(world_size):
+        p = mp.Process(
+            target=_worker,
+            args=(
+                fn, args, rank, world_size, port, backend, n_thread, results,
+                done
+                )
+            )
+        p.start()
+        processes.append(p)
+
+    outputs = {}
+    for _ in range(world_size):
+        rank, ok, output = results.get()
+        if not ok:
+            for p in processes: p.terminate()
+            raise RuntimeError('rank {} failed:\n{}'.format(rank, output))
+        outputs[rank] = output
+    done.set()
+    for p in processes: p.join()
+    return [outputs[rank] for rank in range(world_size)]
+
+def all_reduce_grads(params, average=False):
+    """
+    Sum (or average) the gradients of params over all processes, in a single
+    all_reduce on a flattened buffer. A missing gradient counts as 0.
+
+    Parameters
+    ----------
+    params : iterable of Parameters
+        Must be the same, in the same order, on every process.
+
+    average (optional) : bool
+    """
+    params = [p for p in params if p.requires_grad]
+    if not params: return
+    grads = [
+        p.grad.data.view(-1) if p.grad is not None else
+        p.data.new(p.numel()).zero_() for p in params
+        ]
+    buf = torch.cat(grads)
+    dist.all_reduce(buf)
+    if average: buf.div_(dist.get_world_size())
+
+    offset = 0
+    for p in params:
+        grad = buf[offset: offset+p.numel()].view_as(p.data)
+        if p.grad is None: p.grad = torch.autograd.Variable(grad.clone())
+        else: p.grad.data.copy_(grad)
+        offset += p.numel()
+
+def broadcast_tensors(tensors, src=0):
+    """
+    Overwrite tensors with their values on process src.
+    """
+    for t in tensors: dist.broadcast(t, src)
+
+def shard_range(n, rank=None, world_size=None):
+    """
+    Contiguous slice [start, stop) of range(n) owned by process rank out of
+    world_size (default to those of the default process group). The sizes of
+    the slices differ by at most 1.
+    """
+    if rank is None: rank = dist.get_rank()
+    if world_size is None: world_size = dist.get_world_size()
+    return n * rank // world_size, n * (rank+1) // world_size
+
+class _AllReduceSum(torch.autograd.Function):
+    """
+    Sum over the processes in forward, identity in backward: every process
+    consumes the sum alike, so each already holds its full gradient.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output
+
+class _AllReduceGrad(torch.autograd.Function):
+    """
+    Identity in forward, sum of the gradients over the processes in backward:
+    for an input replicated on every process of which each process only uses
+    a part, e.g., to compute a partial sum.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        return x.clone()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad = grad_output.clone()
+        dist.all_reduce(grad.data)
+        return grad
+
+def all_reduce_sum(x):
+    """
+    Differentiable sum of x over all processes, see _AllReduceSum.
+    """
+    return _AllReduceSum.apply(x)
+
+def all_reduce_grad(x):
+    """
+    x, with its gradient summed over all processes, see _AllReduceGrad.
+    """
+    return _AllReduceGrad.apply(x)
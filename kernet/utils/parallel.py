@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import itertools
+import multiprocessing
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+_shared = {} # NOTE: per-worker, set by _init_worker
+
+def _init_worker(n_thread, shared):
+    torch.set_num_threads(n_thread)
+    _shared.clear()
+    _shared.update(shared)
+
+def _call(args):
+    fn, task = args
+    task = dict(task)
+    seed = task.pop('seed', None)
+    if seed is not None:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+    kwargs = dict(_shared)
+    kwargs.update(task)
+    return fn(**kwargs)
+
+def make_tasks(grid=None, n_run=1, seed=0):
+    """
+    All combinations of the values in grid, each repeated n_run times with a
+    different seed, e.g., the random splits of the paper's 20-run protocol
+    for every point of a hyperparameter grid.
+
+    Parameters
+    ----------
+    grid (optional) : dict
+        Maps parameter names to lists of values.
+
+    n_run (optional) : int
+
+    seed (optional) : int
+        Seed of the first run, the others use seed+1, seed+2, ...
+
+    Returns
+    -------
+    tasks : list of dict
+        Each has the parameters of one combination plus 'run' and 'seed'.
+    """
+    grid = grid or {}
+    names = sorted(grid)
+    tasks = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        for run in range(n_run):
+            task = dict(zip(names, values))
+            task['run'] = run
+            task['seed'] = seed + run
+            tasks.append(task)
+    return tasks
+
+def run_parallel(fn, tasks, n_worker=None, n_thread=None, shared=None):
+    """
+    Call fn(**task) for every task in a pool of processes, e.g., to fit many
+    independent MLKNs (splits, seeds, hyperparameters) at once. Each worker
+    uses n_thread threads for torch so that the pool does not oversubscribe
+    the CPU.
+
+    fn must be defined at the top level of a module so that it can be sent to
+    the workers. If a task has a 'seed' entry, it is removed from the task and
+    used to seed torch and numpy before the call. For data, prefer passing
+    dataset names and loading them with datasets.load_mkl (memory-mapped, so
+    the pages are shared by all workers) or passing Tensors through shared.
+
+    Parameters
+    ----------
+    fn : callable
+
+    tasks : list of dict
+        Keyword arguments for fn, see make_tasks.
+
+    n_worker (optional) : int
+        Defaults to the number of CPUs.
+
+    n_thread (optional) : int
+        Threads per worker, defaults to the number of CPUs divided by
+        n_worker.
+
+    shared (optional) : dict
+        Tensors moved to shared memory and passed to every call of fn as
+        additional keyword arguments, without being copied into each task.
+
+    Returns
+    -------
+    results : list
+        Return values of fn, in the order of tasks.
+    """
+    n_cpu = multiprocessing.cpu_count()
+    if n_worker is None: n_worker = n_cpu
+    n_worker = max(1, min(n_worker, len(tasks)))
+    if n_thread is None: n_thread = max(1, n_cpu // n_worker)
+
+    shared = dict(shared or {})
+    for value in shared.values():
+        if torch.is_tensor(value): value.share_memory_()
+        elif hasattr(value, 'data') and torch.is_tensor(value.data):
+            value.data.share_memory_() # NOTE: Variable
+
+    pool = mp.Pool(
+        n_worker,
+        initializer=_init_worker,
+        initargs=(n_thread, shared)
+        )
+    try:
+        results = pool.map(_call, [(fn, task) for task in tasks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def aggregate(results, by=None):
+    """
+    Mean and standard deviation of the numeric entries of a list of results
+    (dicts), optionally grouped by the values of some of their entries.
+
+    Parameters
+    ----------
+    results : list of dict
+
+    by (optional) : list of str
+        Entries to group the results by, e.g., ['dataset', 'sigma'].
+
+    Returns
+    -------
+    summary : list of dict
+        One dict per group with the grouping entries, 'n_run', and for each
+        numeric entry a dict {'mean': ..., 'std': ...}.
+    """
+    by = list(by or [])
+    groups = {}
+    for r in results:
+        groups.setdefault(tuple(r[key] for key in by), []).append(r)
+
+    summary = []
+    for key in sorted(groups, key=str):
+        rs = groups[key]
+        entry = dict(zip(by, key))
+        entry['n_run'] = len(rs)
+        for name in sorted(rs[0]):
+            if name in by or name in ('run', 'seed'): continue
+            values = [r.get(name) for r in rs]
+            if not all(isinstance(v, (int, float)) and \
+                not isinstance(v, bool) for v in values): continue
+            values = np.array(values, dtype=float)
+            entry[name] = {
+                'mean': float(values.mean()),
+                'std': float(values.std())
+                }
+        summary.append(entry)
+    return summary
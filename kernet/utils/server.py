@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# torch 0.3.1
+
+from __future__ import division, print_function
+
+import argparse
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+class MicroBatcher(object):
+    def __init__(
+        self,
+        model,
+        max_batch_size=64,
+        max_latency=5e-3,
+        n_worker=2,
+        method=None,
+        window=1000):
+        """
+        Coalesce concurrent inference requests into micro-batches. Requests
+        are queued, a collector thread groups them into a batch as soon as
+        max_batch_size examples are waiting or the first of them has waited
+        max_latency seconds, and a pool of worker threads runs each batch
+        through the model in a single call.
+
+        Parameters
+        ----------
+        model : baseMLKN
+            Trained model. Its inference plan is prepared if needed (see
+            baseMLKN.prepare_inference), so it must have centers, e.g.,
+            because it was loaded with baseMLKN.load.
+
+        max_batch_size (optional) : int
+
+        max_latency (optional) : scalar
+            Longest time (in seconds) a request waits for others to join its
+            batch.
+
+        n_worker (optional) : int
+            Number of batches run concurrently.
+
+        method (optional) : str
+            Method of model applied to the batches, 'predict' (labels) or
+            'evaluate' (raw outputs). Defaults to 'predict' if the model has
+            it.
+
+        window (optional) : int
+            Number of most recent requests the latency statistics are
+            computed over.
+        """
+        if method is None:
+            method = 'predict' if hasattr(model, 'predict') else 'evaluate'
+        if getattr(model, '_inference_plan', None) is None:
+            model.prepare_inference()
+
+        plan = getattr(model, '_inference_plan', None)
+        self.in_dim = plan[0].shape[1] if plan is not None else \
+        getattr(model.layer0, 'in_dim', None)
+        # NOTE: checked in submit, a request of the wrong shape would fail
+        # the whole batch it joins
+        self.model = model
+        self.method = getattr(model, method)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._pool = ThreadPoolExecutor(max_workers=n_worker)
+
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._n_request = 0
+        self._n_example = 0
+        self._n_batch = 0
+        self._n_error = 0
+        self._latency = collections.deque(maxlen=window)
+
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def submit(self, x):
+        """
+        Queue x for inference.
+
+        Parameters
+        ----------
+        x : Tensor, shape (n_example, dim)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to the output for x, a Tensor of shape (n_example,) or
+            (n_example, out_dim).
+
+        Raises
+        ------
+        ValueError
+            If x is not of shape (n_example, dim) with the input dimension of
+            the model.
+        """
+        if isinstance(x, Variable): x = x.data
+        if x.dim()!=2 or \
+        (self.in_dim is not None and x.shape[1]!=self.in_dim):
+            raise ValueError(
+                'expected input of shape (n_example, {}), got {}'.format(
+                    self.in_dim, tuple(x.shape)
+                    ))
+        future = Future()
+        with self._cond:
+            if self._closed: raise RuntimeError('batcher is closed')
+            self._queue.append((x, future, time.time()))
+            self._cond.notify()
+        return future
+
+    def __call__(self, x):
+        """
+        Blocking version of submit.
+        """
+        return self.submit(x).result()
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed: self._cond.wait()
+                if not self._queue: return # NOTE: closed and drained
+
+                deadline = self._queue[0][2] + self.max_latency
+                size = sum(item[0].shape[0] for item in self._queue)
+                while size < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0: break
+                    self._cond.wait(remaining)
+                    size = sum(item[0].shape[0] for item in self._queue)
+
+                batch, size = [], 0
+                while self._queue and (not batch or
+                    size + self._queue[0][0].shape[0] <= self.max_batch_size):
+                    batch.append(self._queue.popleft())
+                    size += batch[-1][0].shape[0]
+
+            self._pool.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            x = torch.cat([item[0] for item in batch], dim=0)
+            y = self.method(Variable(x), batch_size=x.shape[0])
+            y = y.data if isinstance(y, Variable) else y
+        except Exception as e:
+            with self._lock: self._n_error += len(batch)
+            for _, future, _ in batch: future.set_exception(e)
+            return
+
+        now = time.time()
+        with self._lock:
+            self._n_batch += 1
+            self._n_request += len(batch)
+            self._n_example += x.shape[0]
+            self._latency.extend(now - item[2] for item in batch)
+
+        i = 0
+        for x_, future, _ in batch:
+            future.set_result(y[i: i+x_.shape[0]])
+            i += x_.shape[0]
+
+    def stats(self):
+        """
+        Throughput and latency counters.
+
+        Returns
+        -------
+        stats : dict
+            Numbers of requests, examples, batches and failed requests,
+            throughput since start (requests and examples per second), mean
+            batch size and latency percentiles (in seconds) over the most
+            recent requests.
+        """
+        with self._lock:
+            elapsed = time.time() - self._start
+            latency = np.array(self._latency) if self._latency else \
+            np.zeros(1)
+            stats = {
+                'n_request': self._n_request,
+                'n_example': self._n_example,
+                'n_batch': self._n_batch,
+                'n_error': self._n_error,
+                'queued': len(self._queue),
+                'uptime': elapsed,
+                'requests_per_sec': self._n_request / elapsed,
+                'examples_per_sec': self._n_example / elapsed,
+                'mean_batch_size': self._n_example / max(1, self._n_batch)
+                }
+        for q in (50, 95, 99):
+            stats['latency_p{}'.format(q)] = float(np.percentile(latency, q))
+        stats['latency_mean'] = float(latency.mean())
+        return stats
+
+    def close(self):
+        """
+        Stop accepting requests, finish the queued ones and stop the workers.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._collector.join()
+        self._pool.shutdown(wait=True)
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # NOTE: the default backlog of 5 resets
+    # connections under the bursts of concurrent clients batching is for
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    POST /predict with body {"x": [[...], ...]} returns {"y": [...]};
+    GET /stats returns the counters of the batcher; GET /health returns
+    {"status": "ok"}.
+    """
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path=='/stats': self._reply(200, self.server.batcher.stats())
+        elif self.path=='/health': self._reply(200, {'status': 'ok'})
+        else: self._reply(404, {'error': 'not found: {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path!='/predict':
+            return self._reply(404, {
+                'error': 'not found: {}'.format(self.path)
+                })
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            x = json.loads(self.rfile.read(length).decode('utf-8'))['x']
+            x = torch.FloatTensor(np.array(x, dtype=np.float32, ndmin=2))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'error': 'bad request: {}'.format(e)})
+        try: future = self.server.batcher.submit(x)
+        except ValueError as e:
+            return self._reply(400, {'error': 'bad request: {}'.format(e)})
+        try: y = future.result()
+        except Exception as e:
+            return self._reply(500, {'error': '{}: {}'.format(
+                e.__class__.__name__, e
+                )})
+        self._reply(200, {'y': y.cpu().numpy().tolist()})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def make_server(batcher, host='127.0.0.1', port=8000, verbose=False):
+    """
+    HTTP server answering inference requests through batcher, see _Handler
+    for the endpoints. Each connection is handled in its own thread, so
+    concurrent requests get batched together. Call serve_forever on the
+    returned server to start it (port 0 picks a free port, see
+    server.server_address).
+
+    Parameters
+    ----------
+    batcher : MicroBatcher
+
+    host, port (optional)
+
+    verbose (optional) : bool
+        Log every request to stderr.
+
+    Returns
+    -------
+    server : socketserver.TCPServer
+    """
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    server.batcher = batcher
+    server.verbose = verbose
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a saved MLKN model '
+        '(see baseMLKN.save) over HTTP, batching concurrent requests.')
+    parser.add_argument('model', help='file written by baseMLKN.save')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=5.)
+    parser.add_argument('--n-worker', type=int, default=2)
+    parser.add_argument('--method', choices=['predict', 'evaluate'],
+        default=None)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    from models.mlkn import baseMLKN
+    model = baseMLKN.load(args.model, prepare=True)
+    batcher = MicroBatcher(
+        model,
+        max_batch_size=args.max_batch_size,
+        max_latency=args.max_latency_ms / 1000,
+        n_worker=args.n_worker,
+        method=args.method
+        )
+    server = make_server(batcher, args.host, args.port, args.verbose)
+    print('serving {} on http://{}:{}'.format(
+        args.model, *server.server_address
+        ))
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+if __name__=='__main__':
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..'))
+    main()
@@ -3,20 +3,591 @@
 
 from __future__ import division, print_function
 
+import json
+import math as m
+import threading
 import numpy as np
 import torch
-from torch.autograd import Variable
+from torch.autograd import Variable, gradcheck
+from torch.utils.data import TensorDataset
 from sklearn.datasets import load_iris, load_breast_cancer, load_digits
 from sklearn.preprocessing import StandardScaler
 
+import os
 import sys
-sys.path.append('../kernet/')
+import tempfile
+from urllib.error import HTTPError
+from urllib.request import urlopen
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '../kernet/')
+    )
 import backend as K
-from models.mlkn import MLKNClassifier
+from datasets.mkl import load_mkl, MKLDataset
+from models.mlkn import MLKN, MLKNClassifier, MLKNEnsemble
 from layers.kerlinear import kerLinear
+from layers.kerlinearensemble import kerLinearEnsemble
+from layers.kerlinearsharded import kerLinearSharded
+from layers.rfflinear import rffLinear
+from utils import aggregate, make_tasks, run_parallel, MicroBatcher, \
+    make_server, LossLogger, Profiler, launch, all_reduce_sum, all_reduce_grad
 
 torch.manual_seed(1234)
 
+def test_center_cache_is_keyed_on_versions():
+    torch.manual_seed(0)
+    X = Variable(torch.randn(40, 4))
+    mlkn = MLKNClassifier()
+    mlkn.add_layer(kerLinear(ker_dim=40, out_dim=3, sigma=2))
+    mlkn.add_layer(kerLinear(ker_dim=40, out_dim=2, sigma=1))
+    Y = mlkn._get_centers(X, 1)
+    assert mlkn._get_centers(X, 1) is Y
+    assert mlkn._get_centers(Variable(X.data.clone()), 1) is not Y
+    mlkn.layer0.weight.requires_grad = False
+    assert mlkn._get_centers(X, 1) is not Y
+    # NOTE: freezing a layer changes the key as well
+    Y = mlkn._get_centers(X, 1)
+    mlkn.layer0.weight.mul_(2)
+    # NOTE: the in-place update through the Variable bumps its version
+    Y_new = mlkn._get_centers(X, 1)
+    assert Y_new is not Y
+    assert float((Y_new - mlkn.layer0(X, X)).abs().max()) < 1e-6
+
+def test_greedy_evaluates_frozen_layers_once_per_stage():
+    torch.manual_seed(0)
+    X = torch.randn(100, 4)
+    Y = (X[:, 0] * X[:, 1] > 0).float()
+    counts = []
+    for n_epoch in (1, 3):
+        mlkn = MLKNClassifier()
+        mlkn.callbacks = []
+        mlkn.add_layer(kerLinear(ker_dim=100, out_dim=4, sigma=2))
+        mlkn.add_layer(kerLinear(ker_dim=100, out_dim=2, sigma=1))
+        mlkn.add_optimizer(torch.optim.SGD(params=mlkn.parameters(), lr=.1))
+        mlkn.add_optimizer(torch.optim.SGD(params=mlkn.parameters(), lr=.1))
+        mlkn.add_loss(torch.nn.CrossEntropyLoss())
+        calls = []
+        mlkn.layer0.register_forward_hook(lambda *args: calls.append(1))
+        mlkn.fit(n_epoch=(0, n_epoch), X=X, Y=Y, n_class=2, batch_size=10)
+        counts.append(len(calls))
+    # NOTE: 10 batches per epoch, the frozen layer0 is only evaluated on the
+    # training set (and the reference set) at the start of the stage
+    assert 1 <= counts[0]==counts[1] <= 2
+
+def test_landmarks_and_whitener():
+    torch.manual_seed(0)
+    X = torch.randn(300, 3).double()
+    for method in ('uniform', 'kmeans++', 'leverage'):
+        index = K.get_landmarks(X, 20, method=method, sigma=1.)
+        assert isinstance(index, torch.LongTensor) and len(index)==20
+        assert len(set(index.tolist()))==20
+        assert 0 <= index.min() and index.max() < 300
+    C = Variable(X.index_select(0, index))
+    layer = kerLinear(ker_dim=20, out_dim=2, sigma=1., whiten=True)
+    whitener = layer._get_whitener(C)
+    gram = K.kerMap(C, C, 1.)
+    identity = whitener.mm(gram).mm(whitener)
+    assert float((identity - Variable(torch.eye(20).double())).abs().max()) \
+    < 1e-6
+    assert layer._get_whitener(C) is whitener
+    assert layer._get_whitener(Variable(C.data.clone())) is not whitener
+
+def test_rff_layers():
+    torch.manual_seed(0)
+    x = Variable(torch.randn(20, 3).double())
+    layer = rffLinear(in_dim=3, out_dim=2, sigma=2., n_feature=20000).double()
+    z = K.rffMap(x, Variable(layer.omega), Variable(layer.phase), layer.sigma)
+    assert float((z.mm(z.t()) - K.kerMap(x, x, 2.)).abs().max()) < .05
+    assert float((layer(x) - layer.linear(z)).abs().max()) < 1e-12
+
+    X = torch.randn(100, 3)
+    Y = (X[:, 0] > 0).float()
+    mlkn = MLKNClassifier()
+    mlkn.callbacks = []
+    mlkn.add_layer(rffLinear(in_dim=3, out_dim=4, sigma=2., n_feature=200))
+    mlkn.add_layer(rffLinear(in_dim=4, out_dim=2, sigma=1., n_feature=200))
+    mlkn.add_optimizer(torch.optim.Adam(params=mlkn.parameters(), lr=1e-2))
+    mlkn.add_optimizer(torch.optim.Adam(params=mlkn.parameters(), lr=1e-2))
+    mlkn.add_loss(torch.nn.CrossEntropyLoss())
+    mlkn.fit(n_epoch=(2, 2), X=X, Y=Y, n_class=2, batch_size=50)
+    X_test = torch.randn(30, 3)
+    # NOTE: no reference set needed
+    assert (mlkn.predict(X_test=X_test)==mlkn.predict(X_test=X_test, X=X))\
+    .all()
+
+def test_label_alignment_matches_dense():
+    torch.manual_seed(0)
+    x = torch.randn(40, 3).double()
+    y = torch.rand(40, 1).mul(3).floor().double()
+    ideal = K.ideal_gram(y, y, 3).double()
+    feat = torch.randn(40, 5).double()
+    for gram, kwargs in (
+        (K.kerMap(x, x, 1.5), {'gram': K.kerMap(x, x, 1.5)}),
+        (feat.mm(feat.t()), {'feat': feat})
+        ):
+        dense = (gram * ideal).sum() / (gram.norm() * ideal.norm())
+        assert abs(float(K.label_alignment(y, 3, **kwargs)) - float(dense)) \
+        < 1e-12
+
+def test_ridge_solve_cg_matches_cholesky():
+    # NOTE: n_precond < n_center, i.e., the Nystrom preconditioner
+    for seed in range(4):
+        torch.manual_seed(seed)
+        C, X = torch.randn(400, 5), torch.randn(2000, 5)
+        phi, gram = K.kerMap(X, C, 1.), K.kerMap(C, C, 1.)
+        target = X[:, :1].sin()
+        w_chol = K.ridge_solve(phi, target, 1e-4, gram, solver='cholesky')
+        w_cg = K.ridge_solve(
+            phi, target, 1e-4, gram,
+            solver='cg', n_precond=100, max_iter=500, tol=1e-8
+            )
+        assert not (w_cg!=w_cg).any()
+        assert float((phi.mm(w_cg) - phi.mm(w_chol)).abs().max()) < 1e-2
+
+def test_conjugate_gradient_raises_if_indefinite():
+    A = torch.DoubleTensor([[1, 0], [0, -1]])
+    b = torch.DoubleTensor([[1], [1]])
+    try:
+        K.conjugate_gradient(lambda v: A.mm(v), b)
+    except RuntimeError: pass
+    else: assert False, 'expected a RuntimeError'
+
+def test_gaussian_kernel_gradcheck():
+    torch.manual_seed(0)
+    x = Variable(torch.randn(7, 3).double(), requires_grad=True)
+    y = Variable(torch.randn(5, 3).double(), requires_grad=True)
+    sigma = Variable(torch.DoubleTensor([1.3]), requires_grad=True)
+    for kwargs in ({}, {'recompute': True}, {'mem_budget': 3 * 8 * 5 * 2}):
+        assert gradcheck(
+            lambda x, y, sigma: K.gaussianKer(x, y, sigma, **kwargs),
+            (x, y, sigma), eps=1e-6, atol=1e-5
+            )
+    gram = K.gaussianKer(x, y, sigma)
+    reference = K.gaussianKer(x, y, 1.3, mode='diff')
+    assert float((gram - reference).abs().max()) < 1e-10
+    # NOTE: nearby points in float32, where the kernel values round to
+    # about 1 and the distances cannot be recovered from them
+    x_near, y_near = x.data * 1e-3, y.data * 1e-3
+    grads = []
+    for cast in (lambda t: t.float(), lambda t: t):
+        s = Variable(cast(torch.DoubleTensor([1.3])), requires_grad=True)
+        K.gaussianKer(cast(x_near), cast(y_near), s).sum().backward()
+        grads.append(float(s.grad))
+    assert abs(grads[0] / grads[1] - 1) < 1e-4
+
+def test_symmetric_gram():
+    torch.manual_seed(0)
+    x = Variable(torch.randn(9, 3).double(), requires_grad=True)
+    gram = K.gaussianKer(x, x, 1.3, mem_budget=3 * 8 * 9 * 4)
+    reference = K.gaussianKer(x, x, 1.3, symmetric=False)
+    assert float((gram - reference).abs().max()) < 1e-12
+    assert gradcheck(
+        lambda x: K.gaussianKer(x, x, 1.3), (x,), eps=1e-6, atol=1e-5
+        )
+    try: K.gaussianKer(x, x.clone(), 1.3, symmetric=True)
+    except AssertionError: pass
+    else: assert False, 'expected an AssertionError'
+
+def _fit_stream(greedy, stream):
+    torch.manual_seed(0)
+    X = torch.randn(120, 4)
+    Y = (X[:, 0] * X[:, 1] > 0).float()
+    mlkn = MLKNClassifier() if greedy else MLKN()
+    mlkn.callbacks = []
+    mlkn.add_layer(kerLinear(ker_dim=30, out_dim=4, sigma=2))
+    mlkn.add_layer(kerLinear(ker_dim=30, out_dim=2, sigma=1))
+    for _ in range(2 if greedy else 1):
+        mlkn.add_optimizer(torch.optim.SGD(params=mlkn.parameters(), lr=.1))
+    mlkn.add_loss(torch.nn.CrossEntropyLoss())
+    mlkn.add_centers(X, n_center=30)
+    data = TensorDataset(X, Y) if stream else X
+    Y = None if stream else Y
+    if greedy:
+        mlkn.fit(n_epoch=(2, 2), X=data, Y=Y, n_class=2, batch_size=40)
+    else: mlkn.fit(n_epoch=2, X=data, Y=Y, batch_size=40)
+    return [param.data.clone() for param in mlkn.parameters()]
+
+def test_stream_fit_matches_in_memory():
+    for greedy in (False, True):
+        in_memory = _fit_stream(greedy, False)
+        for p, q in zip(in_memory, _fit_stream(greedy, True)):
+            assert float((p - q).abs().max()) < 1e-5, greedy
+
+    X, Y = torch.randn(20, 3), torch.randn(20)
+    batches = list(K.get_stream_batch(K.get_loader(
+        TensorDataset(X, Y), batch_size=7
+        )))
+    assert len(batches)==3
+    assert all(isinstance(t, Variable) for batch in batches for t in batch)
+    assert float((torch.cat([x.data for x, _ in batches]) - X).abs().max())==0
+    assert float((torch.cat([y.data for _, y in batches]) - Y).abs().max())==0
+
+def test_load_mkl_in_place():
+    x, y = load_mkl('heart')
+    x0 = x.clone()
+    x -= x.mean(0) # NOTE: copy-on-write, must not segfault
+    assert float(x.mean(0).abs().max()) < 1e-8
+    x1, _ = load_mkl('heart', mmap=False)
+    assert float((x0 - x1).abs().max()) == 0 # NOTE: the file is untouched
+    xd, yd = MKLDataset('heart').tensors()
+    assert xd.size() == x.size() and (yd == y).all()
+
+def _parallel_task(a, run, x):
+    return {
+        'a': a, 'run': run, 'u': float(torch.rand(1)[0]),
+        's': float(x.sum()) * a
+        }
+
+def test_run_parallel_and_aggregate():
+    x = torch.randn(5)
+    tasks = make_tasks({'a': [1, 2]}, n_run=3, seed=10)
+    assert len(tasks)==6
+    results = run_parallel(_parallel_task, tasks, n_worker=2, shared={'x': x})
+    for r, task in zip(results, tasks):
+        assert (r['a'], r['run'])==(task['a'], task['run'])
+        torch.manual_seed(task['seed'])
+        assert r['u']==float(torch.rand(1)[0])
+        assert abs(r['s'] - float(x.sum()) * task['a']) < 1e-6
+    summary = aggregate(results, by=['a'])
+    assert [(s['a'], s['n_run']) for s in summary]==[(1, 3), (2, 3)]
+    for s in summary:
+        u = [r['u'] for r in results if r['a']==s['a']]
+        assert abs(s['u']['mean'] - np.mean(u)) < 1e-12
+        assert abs(s['u']['std'] - np.std(u)) < 1e-12
+        assert 'run' not in s and 'seed' not in s
+
+def test_sigma_sweep_matches_per_sigma_loop():
+    torch.manual_seed(0)
+    x = torch.randn(50, 3).double()
+    y = torch.rand(50, 1).mul(3).floor().double()
+    sigmas = [.3, 1., 3.]
+    sweep = K.sigma_sweep(x, y, sigmas, mem_budget=4 * 8 * 16 * 16)
+    for k, sigma in enumerate(sigmas):
+        alignment = K.label_alignment(y, 3, gram=K.kerMap(x, x, sigma))
+        assert abs(float(sweep[k]) - float(alignment)) < 1e-10
+
+    X, Y = x.float(), y.float()
+    mlkn = MLKNClassifier()
+    mlkn.add_layer(kerLinear(ker_dim=50, out_dim=4, sigma=1))
+    mlkn.add_layer(kerLinear(ker_dim=50, out_dim=3, sigma=1))
+    for param in mlkn.parameters(): param.requires_grad = False
+    sweep = mlkn.sweep_sigma(X, Y, sigmas, layer=1, set_best=True)
+    x1 = mlkn.get_repr(X, X, layer=0)
+    x1 = x1.data if isinstance(x1, Variable) else x1
+    reference = K.sigma_sweep(x1, Y, sigmas)
+    assert float((sweep - reference).abs().max()) < 1e-5
+    assert mlkn.layer1.sigma==sigmas[max(range(3), key=lambda k: sweep[k])]
+
+def test_ensemble_matches_members():
+    torch.manual_seed(0)
+    X = torch.randn(60, 4)
+    Y = (X[:, 0] > 0).float()
+    decays = [0., 1e-2]
+    ensemble = MLKNEnsemble(2)
+    ensemble.callbacks = []
+    ensemble.add_layer(kerLinearEnsemble(
+        2, ker_dim=60, out_dim=3, sigma=[2., 3.], weight_decay=decays
+        ))
+    ensemble.add_layer(kerLinearEnsemble(
+        2, ker_dim=60, out_dim=2, sigma=[1., 2.], weight_decay=decays
+        ))
+    members = []
+    for k in range(2):
+        mlkn = MLKN()
+        mlkn.callbacks = []
+        for i in range(2):
+            mlkn.add_layer(getattr(ensemble, 'layer'+str(i)).get_member(k))
+        mlkn.add_optimizer(torch.optim.SGD(
+            params=mlkn.parameters(), lr=.1, weight_decay=decays[k]
+            ))
+        mlkn.add_loss(torch.nn.CrossEntropyLoss())
+        members.append(mlkn)
+    ensemble.add_optimizer(
+        torch.optim.SGD(params=ensemble.parameters(), lr=.1)
+        )
+    ensemble.add_loss(torch.nn.CrossEntropyLoss())
+    for mlkn in [ensemble] + members:
+        mlkn.fit(n_epoch=3, X=X, Y=Y, batch_size=20, accumulate_grad=False)
+
+    X_test = torch.randn(10, 4)
+    output = ensemble.evaluate(X_test, X=X)
+    for k, mlkn in enumerate(members):
+        for i in range(2):
+            layer = getattr(ensemble, 'layer'+str(i)).get_member(k)
+            member = getattr(mlkn, 'layer'+str(i))
+            for p, q in zip(layer.parameters(), member.parameters()):
+                assert float((p - q).abs().max()) < 1e-5, (k, i)
+        assert float((output[k] - mlkn.evaluate(X_test, X=X)).abs().max()) \
+        < 1e-5
+
+def _toy_classifier(n_center=None, seed=0):
+    torch.manual_seed(seed)
+    X = torch.randn(200, 4)
+    Y = (X[:, 0] * X[:, 1] > 0).float()
+    mlkn = MLKNClassifier()
+    mlkn.callbacks = []
+    mlkn.add_layer(kerLinear(ker_dim=n_center or 200, out_dim=4, sigma=2))
+    mlkn.add_layer(kerLinear(ker_dim=n_center or 200, out_dim=2, sigma=1))
+    mlkn.add_optimizer(torch.optim.Adam(params=mlkn.parameters(), lr=1e-2))
+    mlkn.add_optimizer(torch.optim.Adam(params=mlkn.parameters(), lr=1e-2))
+    mlkn.add_loss(torch.nn.CrossEntropyLoss())
+    if n_center is not None: mlkn.add_centers(X, n_center=n_center)
+    mlkn.fit(n_epoch=(2, 2), X=X, Y=Y, n_class=2, batch_size=50)
+    return mlkn, X, Y
+
+def test_save_load_round_trip():
+    mlkn, X, _ = _toy_classifier()
+    X_test = torch.randn(30, 4)
+    y_pred = mlkn.predict(X_test=X_test, X=X)
+    path = os.path.join(tempfile.mkdtemp(), 'mlkn.kn')
+    for kwargs in ({}, {'dedup': True}, {'half': True}):
+        mlkn.save(path, X=X, **kwargs)
+        for mmap in (True, False):
+            loaded = MLKNClassifier.load(path, mmap=mmap)
+            assert loaded.centers.shape[1]==X.shape[1]
+            assert (loaded.predict(X_test=X_test)==y_pred).all()
+
+def test_inference_plan_follows_the_parameters():
+    mlkn, X, _ = _toy_classifier(n_center=50)
+    X_test = torch.randn(30, 4)
+    for param in mlkn.parameters(): param.requires_grad = False
+    mlkn.prepare_inference()
+    y_plan = mlkn.evaluate(X_test).data
+    mlkn._clear_cache()
+    assert float((mlkn.evaluate(X_test).data - y_plan).abs().max()) < 1e-6
+
+    mlkn.prepare_inference()
+    mlkn.layer0.weight.mul_(2)
+    # NOTE: an in-place update bumps the version of the weights, which must
+    # invalidate the plan for the layers above
+    y_updated = mlkn.evaluate(X_test).data
+    mlkn._clear_cache()
+    y_fresh = mlkn.evaluate(X_test).data
+    assert float((y_updated - y_fresh).abs().max()) < 1e-6
+    assert float((y_updated - y_plan).abs().max()) > 1e-3
+
+def test_server_round_trip():
+    mlkn, X, _ = _toy_classifier(n_center=50)
+    X_test = torch.randn(30, 4)
+    y_pred = mlkn.predict(X_test=X_test)
+    batcher = MicroBatcher(mlkn, max_batch_size=16, max_latency=1e-2)
+    futures = [batcher.submit(X_test[i: i+3]) for i in range(0, 30, 3)]
+    assert (torch.cat([f.result() for f in futures])==y_pred).all()
+    try:
+        batcher.submit(torch.randn(2, 3))
+        assert False, 'accepted the wrong input dimension'
+    except ValueError: pass
+
+    server = make_server(batcher, port=0)
+    threading.Thread(target=server.serve_forever).start()
+    url = 'http://{}:{}/predict'.format(*server.server_address)
+    post = lambda x: urlopen(url, json.dumps({'x': x}).encode('utf-8'))
+    try:
+        y = json.loads(post(X_test[:5].numpy().tolist()).read())['y']
+        assert y==y_pred[:5].numpy().tolist()
+        for x in ([[1., 2.]], [[[1., 2., 3., 4.]]]):
+            try:
+                post(x)
+                assert False, 'accepted {}'.format(x)
+            except HTTPError as e:
+                assert e.code==400
+                assert 'expected input of shape' in \
+                json.loads(e.read())['error']
+        assert batcher.stats()['n_error']==0
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+
+def test_loss_logger_and_profiler():
+    torch.manual_seed(0)
+    X = torch.randn(100, 4)
+    Y = (X[:, 0] > 0).float()
+    lines, profiler = [], Profiler()
+    mlkn = MLKNClassifier()
+    mlkn.callbacks = [LossLogger(sink=lines.append, every=2), profiler]
+    mlkn.add_layer(kerLinear(ker_dim=100, out_dim=4, sigma=2))
+    mlkn.add_layer(kerLinear(ker_dim=100, out_dim=2, sigma=1))
+    mlkn.add_optimizer(torch.optim.SGD(params=mlkn.parameters(), lr=.1))
+    mlkn.add_optimizer(torch.optim.SGD(params=mlkn.parameters(), lr=.1))
+    mlkn.add_loss(torch.nn.CrossEntropyLoss())
+    mlkn.fit(n_epoch=(2, 3), X=X, Y=Y, n_class=2, batch_size=25)
+    # NOTE: 4 batches per epoch, 20 in total, every other one is logged
+    losses = [line for line in lines if line.startswith('epoch')]
+    assert len(losses)==10
+    assert 'loss(Alignment)' in losses[0] and 'Alignment' not in losses[-1]
+    assert 'Classifier trained.' in lines
+
+    summary = profiler.summary()
+    assert summary['n_batch']==20 and summary['n_example']==500
+    assert summary['timings']['backward']['count']==20
+    assert 'forward/layer0' in summary['timings']
+    assert summary['fit_time'] > 0 and summary['peak_rss_mb'] > 0
+    assert 'backward' in profiler.report()
+
+def test_sparse_forward_within_bound():
+    torch.manual_seed(0)
+    C = Variable(torch.rand(2000, 3))
+    x = Variable(torch.rand(64, 3))
+    for kernel in ('gaussian', 'laplacian', 'matern'):
+        layer = kerLinear(ker_dim=2000, out_dim=4, sigma=.05, kernel=kernel)
+        dense = layer(x, C).data
+        for tol in (1e-2, 1e-4, 1e-6):
+            error = (layer.sparse_forward(x, C, tol).data - dense).abs()
+            bound = tol * layer.weight.data.abs().sum(1).view(1, -1)
+            assert (error <= bound + 1e-5).all(), (kernel, tol)
+    layer = kerLinear(ker_dim=2000, out_dim=4, sigma=None, kernel='cosine')
+    # NOTE: no radius, falls back to forward
+    assert (layer.sparse_forward(x, C, 1e-6).data==layer(x, C).data).all()
+
+def _train_data_parallel(greedy, accumulate_grad, distributed):
+    torch.manual_seed(0)
+    X = torch.randn(60, 5)
+    Y = (X[:, 0] > 0).float()
+    mlkn = MLKNClassifier() if greedy else MLKN()
+    mlkn.callbacks = []
+    mlkn.add_layer(kerLinear(ker_dim=60, out_dim=6, sigma=2))
+    mlkn.add_layer(kerLinear(ker_dim=60, out_dim=2, sigma=1))
+    for _ in range(2 if greedy else 1):
+        mlkn.add_optimizer(torch.optim.SGD(params=mlkn.parameters(), lr=.1))
+    mlkn.add_loss(torch.nn.CrossEntropyLoss())
+    if distributed: mlkn.distribute(seed=5)
+    else: torch.manual_seed(5)
+    if greedy:
+        mlkn.fit(
+            n_epoch=(3, 3), X=X, Y=Y, n_class=2, batch_size=25,
+            accumulate_grad=accumulate_grad, shuffle=True
+            )
+    else:
+        mlkn.fit(
+            n_epoch=3, X=X, Y=Y, batch_size=25,
+            accumulate_grad=accumulate_grad, shuffle=True
+            )
+    return [param.data.clone() for param in mlkn.parameters()]
+
+def test_data_parallel_matches_single_process():
+    for greedy in (False, True):
+        for accumulate_grad in (True, False):
+            args = (greedy, accumulate_grad)
+            results = launch(_train_data_parallel, 3, args + (True,))
+            single = _train_data_parallel(*(args + (False,)))
+            for params in results:
+                for p, q in zip(single, params):
+                    assert float((p - q).abs().max()) < 1e-5, args
+
+def _collectives():
+    rank = torch.distributed.get_rank()
+    x = Variable(torch.randn(3, 2).double() + rank, requires_grad=True)
+    total = all_reduce_sum(x)
+    total.pow(2).sum().backward()
+    grad_sum = x.grad.data.clone()
+    x.grad = None
+    all_reduce_grad(x).mul(rank + 1).sum().backward()
+    return x.data, total.data, grad_sum, x.grad.data
+
+def test_collectives():
+    # NOTE: gradcheck does not apply, as every process perturbs its input at
+    # once. Every process computes the same loss of the sum, whose gradient
+    # w.r.t. each input is that w.r.t. the sum
+    results = launch(_collectives, 2)
+    total = results[0][0] + results[1][0]
+    for _, t, grad_sum, grad in results:
+        assert float((t - total).abs().max()) < 1e-12
+        assert float((grad_sum - 2 * total).abs().max()) < 1e-12
+        assert float((grad - 3).abs().max()) < 1e-12
+        # NOTE: the gradients 1 and 2 of the processes are summed
+
+def _train_sharded(sharded):
+    torch.manual_seed(0)
+    X = torch.randn(61, 5)
+    Y = (X[:, 0] > 0).float()
+    mlkn = MLKN()
+    mlkn.callbacks = []
+    layers = [
+        kerLinear(ker_dim=61, out_dim=out_dim, sigma=sigma)
+        for out_dim, sigma in ((6, 2), (2, 1))
+        ]
+    # NOTE: built before sharding, which draws from the generator as well
+    for layer in layers:
+        if sharded: layer = kerLinearSharded.from_layer(layer)
+        mlkn.add_layer(layer)
+    mlkn.add_optimizer(torch.optim.SGD(params=mlkn.parameters(), lr=.1))
+    mlkn.add_loss(torch.nn.CrossEntropyLoss())
+    torch.manual_seed(5)
+    mlkn.fit(n_epoch=3, X=X, Y=Y, batch_size=25, shuffle=True)
+    return mlkn.evaluate(X[:9], X).data, mlkn.layer0.weight.data.clone(), \
+    getattr(mlkn.layer0, 'start', 0)
+
+def test_sharded_layer_matches_single_process():
+    y, weight, _ = _train_sharded(False)
+    for y_shard, weight_shard, start in launch(_train_sharded, 2, (True,)):
+        assert float((y - y_shard).abs().max()) < 1e-5
+        weight_ = weight[:, start: start + weight_shard.shape[1]]
+        assert float((weight_ - weight_shard).abs().max()) < 1e-5
+
+def test_row_bytes_follows_precision():
+    mlkn = MLKNClassifier()
+    mlkn.add_layer(kerLinear(ker_dim=100, out_dim=2, sigma=1))
+    row_bytes = mlkn._row_bytes(100)
+    mlkn.set_precision('double')
+    assert mlkn._row_bytes(100)==2 * row_bytes
+
+def test_kernel_linear_map_gradcheck():
+    torch.manual_seed(0)
+    x = Variable(torch.randn(7, 3).double(), requires_grad=True)
+    X = Variable(torch.randn(9, 3).double(), requires_grad=True)
+    weight = Variable(torch.randn(4, 9).double(), requires_grad=True)
+    bias = Variable(torch.randn(4).double(), requires_grad=True)
+    f = lambda x, X, weight, bias: K.kerLinearMap(
+        x, X, 1.3, weight, bias, storage='double', mem_budget=200
+        )
+    assert gradcheck(f, (x, X, weight, bias), eps=1e-6, atol=1e-5)
+    y = torch.nn.functional.linear(K.kerMap(x, X, 1.3), weight, bias)
+    assert float((f(x, X, weight, bias) - y).abs().max()) < 1e-12
+
+def test_registered_kernels_gradcheck():
+    torch.manual_seed(0)
+    x = Variable(torch.randn(7, 3).double(), requires_grad=True)
+    y = Variable(torch.randn(5, 3).double(), requires_grad=True)
+    kernels = [
+        K.get_kernel('laplacian', 1.3),
+        K.MaternKernel(sigma=1.3, nu=1.5),
+        K.MaternKernel(sigma=1.3, nu=2.5),
+        K.PolynomialKernel(degree=3, gamma=.5),
+        K.CosineKernel(),
+        K.ARDGaussianKernel([.5, 1., 2.])
+        ]
+    for kernel in kernels:
+        for mem_budget in (None, 3 * 8 * 5 * 2):
+            assert gradcheck(
+                lambda x, y: kernel(x, y, mem_budget=mem_budget),
+                (x, y), eps=1e-6, atol=1e-5
+                ), kernel
+    # NOTE: coincident points, where the gradient of the Laplacian kernel is
+    # taken to be 0
+    assert gradcheck(
+        lambda x: K.LaplacianKernel(1.)(x, x + 0).sum(1), (x,),
+        eps=1e-6, atol=1e-4
+        )
+
+def test_registered_kernel_values():
+    torch.manual_seed(0)
+    x, y = torch.randn(7, 3).double(), torch.randn(5, 3).double()
+    r = K.sq_dist(x, y).sqrt()
+    a = m.sqrt(5) / 1.3
+    matern = (1 + a * r + a**2 * r.pow(2) / 3) * (-a * r).exp()
+    assert float((K.MaternKernel(1.3, nu=2.5)(x, y) - matern).abs().max()) \
+    < 1e-12
+    ard = K.gaussianKer(x / 2, y / 2, 1.)
+    assert float((K.ARDGaussianKernel([2.] * 3)(x, y) - ard).abs().max()) \
+    < 1e-12
+    cosine = (x / x.norm(2, 1, keepdim=True)).mm(
+        (y / y.norm(2, 1, keepdim=True)).t()
+        )
+    assert float((K.CosineKernel()(x, y, mem_budget=3 * 8 * 5 * 2) - cosine)
+        .abs().max()) < 1e-12
+    for kernel in (K.GaussianKernel(1.3), K.MaternKernel(1.3, nu=1.5)):
+        assert abs(kernel.value(kernel.radius(1e-3)) - 1e-3) < 1e-9
+
 if __name__=='__main__':
     # toy data
     # X = Variable(torch.FloatTensor([[1, 2], [3, 4]]).type(dtype), requires_grad=False)